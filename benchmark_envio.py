@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark offline do sistema de envio (sender.py)
+
+Executa ciclos completos do SistemaEnvioEmails sem tocar no SQL Server de produção
+nem em caixa postal real:
+- servidor SMTP local (coletor) com latência e injeção de erros configuráveis
+- banco substituto em SQLite com ControleEmailPedidos, CabecalhoPedido, Cliente,
+  Representante e ConfiguracaoSistemaEmail (o T-SQL usado pelo sender é traduzido)
+- pasta de PDFs gerada com N pedidos e M versões
+
+Para cada quantidade de pedidos informa pedidos/s, tempo por fase e pico de memória.
+Os números servem para comparar versões do sender.py na mesma máquina; o SQLite e o
+coletor local não reproduzem a latência do SQL Server nem do Office365/Gmail, e o
+STARTTLS é desativado (o custo do handshake TLS não entra na medição).
+
+Uso:
+    python benchmark_envio.py
+    python benchmark_envio.py --pedidos 100 10000 100000 --versoes 2 --trabalhadores 4
+    python benchmark_envio.py --latencia-ms 50 --taxa-erro 0.01 --json resultado.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import sqlite3
+import smtplib
+import logging
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import socketserver
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+
+# ---------------------------------------------------------------------------
+# Servidor SMTP local
+# ---------------------------------------------------------------------------
+
+class ManipuladorSmtp(socketserver.StreamRequestHandler):
+    """Sessão SMTP mínima: aceita qualquer login e descarta as mensagens"""
+    def responder(self, linha):
+        self.wfile.write(linha.encode('ascii') + b'\r\n')
+
+    def receber_dados(self):
+        tamanho = 0
+        for linha in iter(self.rfile.readline, b''):
+            if linha == b'.\r\n':
+                return tamanho
+            tamanho += len(linha)
+        return None
+
+    def handle(self):
+        coletor = self.server
+        self.responder('220 coletor-benchmark ESMTP')
+        for linha in iter(self.rfile.readline, b''):
+            comando = linha[:4].upper()
+            if comando == b'EHLO':
+                self.responder('250-coletor-benchmark')
+                self.responder('250-AUTH PLAIN LOGIN')
+                self.responder('250 8BITMIME')
+            elif comando == b'AUTH':
+                self.responder('235 2.7.0 Authentication successful')
+            elif comando in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                self.responder('250 2.0.0 OK')
+            elif comando == b'DATA':
+                self.responder('354 End data with <CR><LF>.<CR><LF>')
+                tamanho = self.receber_dados()
+                if tamanho is None:
+                    return
+                if coletor.latencia_segundos:
+                    time.sleep(coletor.latencia_segundos)
+                sorteio = random.random()
+                if sorteio < coletor.taxa_throttling:
+                    coletor.contar('throttling')
+                    self.responder('421 4.7.0 Too many messages (simulado)')
+                    return
+                if sorteio < coletor.taxa_throttling + coletor.taxa_erro:
+                    coletor.contar('erros')
+                    self.responder('451 4.3.0 Erro temporario (simulado)')
+                    continue
+                coletor.contar('mensagens', bytes_recebidos=tamanho)
+                self.responder('250 2.0.0 OK queued')
+            elif comando == b'QUIT':
+                self.responder('221 2.0.0 Bye')
+                return
+            else:
+                self.responder('502 5.5.2 Command not implemented')
+
+
+class ColetorSmtp(socketserver.ThreadingTCPServer):
+    """Servidor SMTP em 127.0.0.1 (porta livre) com latência e erros injetados"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latencia_ms=0, taxa_erro=0.0, taxa_throttling=0.0):
+        super().__init__(('127.0.0.1', 0), ManipuladorSmtp)
+        self.latencia_segundos = latencia_ms / 1000
+        self.taxa_erro = taxa_erro
+        self.taxa_throttling = taxa_throttling
+        self.lock = threading.Lock()
+        self.zerar()
+
+    @property
+    def porta(self):
+        return self.server_address[1]
+
+    def zerar(self):
+        with self.lock:
+            self.contadores = {'mensagens': 0, 'erros': 0, 'throttling': 0, 'bytes_recebidos': 0}
+
+    def contar(self, chave, bytes_recebidos=0):
+        with self.lock:
+            self.contadores[chave] += 1
+            self.contadores['bytes_recebidos'] += bytes_recebidos
+
+    def iniciar(self):
+        threading.Thread(target=self.serve_forever, name='coletor-smtp', daemon=True).start()
+
+
+# ---------------------------------------------------------------------------
+# Banco substituto (SQLite com interface compatível com o pyodbc usado pelo sender)
+# ---------------------------------------------------------------------------
+
+ESQUEMA = """
+CREATE TABLE ContadorVersao (Valor INTEGER NOT NULL);
+INSERT INTO ContadorVersao VALUES (0);
+
+CREATE TABLE ConfiguracaoSistemaEmail (
+    Id INTEGER PRIMARY KEY,
+    SqlServidor TEXT DEFAULT '127.0.0.1', SqlBancoDados TEXT DEFAULT 'SRPP',
+    SqlUsuario TEXT DEFAULT 'sa', SqlSenha TEXT DEFAULT '', SqlDriver TEXT DEFAULT 'SQLite',
+    PdfsCaminho TEXT NOT NULL,
+    EmailSmtpServidor TEXT NOT NULL, EmailSmtpPorta INTEGER NOT NULL,
+    EmailUsuario TEXT NOT NULL, EmailSenhaApp TEXT NOT NULL, EmailRemetente TEXT,
+    EmailAssunto TEXT, EmailCorpo TEXT, EmailResponderPara TEXT, EmailExpositor TEXT,
+    EmailSmtpMensagensPorConexao INTEGER DEFAULT 100, EmailSmtpOciosidadeSegundos INTEGER DEFAULT 60,
+    EmailLimiteMensagensPorSegundo REAL DEFAULT 0, EmailLimiteDestinatariosPorMinuto INTEGER DEFAULT 0,
+    SistemaVerificacaoInicial INTEGER DEFAULT 1, SistemaAguardarSegundosAposArquivo INTEGER DEFAULT 5,
+    SistemaVerificacaoPeriodicaAtiva INTEGER DEFAULT 0, SistemaVerificacaoPeriodicaMinutos INTEGER DEFAULT 30,
+    SistemaCooldownTentativa1 INTEGER DEFAULT 2, SistemaCooldownTentativa2 INTEGER DEFAULT 5,
+    SistemaCooldownTentativa3 INTEGER DEFAULT 10, SistemaCooldownTentativa4 INTEGER DEFAULT 20,
+    SistemaCooldownTentativa5Mais INTEGER DEFAULT 30,
+    SistemaTrabalhadoresEnvio INTEGER DEFAULT 1, SistemaTamanhoPaginaBusca INTEGER DEFAULT 200,
+    SistemaMetricasPorta INTEGER DEFAULT 0, SistemaTrabalhadoresEntrega INTEGER DEFAULT 2,
+    SistemaMinutosReserva INTEGER DEFAULT 30, SistemaNivelLog TEXT DEFAULT 'INFO',
+    SistemaLogTamanhoMaximoMB INTEGER DEFAULT 20, SistemaLogArquivosMantidos INTEGER DEFAULT 10,
+    Ativo INTEGER NOT NULL DEFAULT 1,
+    VersaoConfiguracao BLOB
+);
+
+CREATE TABLE ConfiguracaoSistemaEmailContaSmtp (
+    Id INTEGER PRIMARY KEY, ConfiguracaoId INTEGER NOT NULL,
+    SmtpServidor TEXT NOT NULL, SmtpPorta INTEGER NOT NULL DEFAULT 587,
+    Usuario TEXT NOT NULL, SenhaApp TEXT NOT NULL, Ativo INTEGER NOT NULL DEFAULT 1
+);
+
+CREATE TABLE Cliente (CodCliente INTEGER PRIMARY KEY, EMAIL TEXT, NomeContato TEXT);
+CREATE TABLE Representante (CodRepresentante INTEGER PRIMARY KEY, EmailRepresentante TEXT);
+CREATE TABLE CabecalhoPedido (
+    NroPedido INTEGER PRIMARY KEY, CodCliente INTEGER NOT NULL,
+    CodRepresentante INTEGER, SituacaoAtual TEXT NOT NULL
+);
+
+CREATE TABLE ControleEmailPedidos (
+    Id INTEGER PRIMARY KEY, NroPedido INTEGER NOT NULL, CodCliente INTEGER,
+    DataPedidoFechado DATETIME, EmailsCopia TEXT, EnviarEmailCliente INTEGER DEFAULT 1,
+    StatusProcessamento TEXT NOT NULL DEFAULT 'PENDENTE', EmailEnviado INTEGER NOT NULL DEFAULT 0,
+    VersaoPdfEnviada INTEGER, VersaoPdfDisponivel INTEGER, HashPdfEnviado TEXT,
+    DataEnvio DATETIME, UltimoErro TEXT, TentativasEnvio INTEGER NOT NULL DEFAULT 0,
+    ProximaTentativa DATETIME, StatusAnterior TEXT, ProcessandoPor TEXT, ProcessandoAte DATETIME,
+    VersaoLinha BLOB
+);
+CREATE INDEX IX_ControleEmailPedidos_NroPedido ON ControleEmailPedidos(NroPedido);
+CREATE INDEX IX_ControleEmailPedidos_Reenvio ON ControleEmailPedidos(StatusProcessamento, EmailEnviado);
+CREATE INDEX IX_ControleEmailPedidos_VersaoLinha ON ControleEmailPedidos(VersaoLinha);
+
+-- ROWVERSION: contador global gravado a cada INSERT/UPDATE
+CREATE TRIGGER ControleEmailPedidos_VersaoInsert AFTER INSERT ON ControleEmailPedidos BEGIN
+    UPDATE ContadorVersao SET Valor = Valor + 1;
+    UPDATE ControleEmailPedidos SET VersaoLinha = rowversion((SELECT Valor FROM ContadorVersao)) WHERE Id = NEW.Id;
+END;
+CREATE TRIGGER ControleEmailPedidos_VersaoUpdate AFTER UPDATE ON ControleEmailPedidos BEGIN
+    UPDATE ContadorVersao SET Valor = Valor + 1;
+    UPDATE ControleEmailPedidos SET VersaoLinha = rowversion((SELECT Valor FROM ContadorVersao)) WHERE Id = NEW.Id;
+END;
+CREATE TRIGGER ConfiguracaoSistemaEmail_VersaoInsert AFTER INSERT ON ConfiguracaoSistemaEmail BEGIN
+    UPDATE ContadorVersao SET Valor = Valor + 1;
+    UPDATE ConfiguracaoSistemaEmail SET VersaoConfiguracao = rowversion((SELECT Valor FROM ContadorVersao)) WHERE Id = NEW.Id;
+END;
+"""
+
+
+class ChecksumAgg:
+    """CHECKSUM_AGG do SQL Server (XOR dos checksums)"""
+    def __init__(self):
+        self.valor = None
+
+    def step(self, checksum):
+        if checksum is not None:
+            self.valor = (self.valor or 0) ^ checksum
+
+    def finalize(self):
+        return self.valor
+
+
+def _binary_checksum(*valores):
+    return zlib.crc32(repr(valores).encode('utf-8'))
+
+
+def _rowversion(valor):
+    return None if valor is None else int(valor).to_bytes(8, 'big')
+
+
+def _converter_datetime(valor):
+    return datetime.fromisoformat(valor.decode('utf-8'))
+
+
+sqlite3.register_converter('DATETIME', _converter_datetime)
+
+
+class CursorSubstituto:
+    """Cursor com a interface do pyodbc (linhas com acesso por atributo, fetchmany, fast_executemany)"""
+    TRADUCOES = [
+        (re.compile(r'SELECT\s+MIN_ACTIVE_ROWVERSION\(\)', re.I), 'SELECT rowversion((SELECT Valor FROM ContadorVersao) + 1)'),
+        (re.compile(r'\bDATEADD\(MINUTE,\s*\?,\s*GETDATE\(\)\)', re.I), "strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime', ? || ' minutes')"),
+        (re.compile(r'\bGETDATE\(\)', re.I), "strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime')"),
+        (re.compile(r'\bISNULL\(', re.I), 'IFNULL('),
+        (re.compile(r'\bWITH\s*\(\s*(?:READPAST|UPDLOCK|ROWLOCK|NOLOCK)(?:\s*,\s*\w+)*\s*\)', re.I), ''),
+        # UPDATE alias SET ... OUTPUT inserted.X FROM Tabela alias WHERE ... -> UPDATE ... RETURNING (SQLite 3.35+)
+        (re.compile(r'\bUPDATE\s+(\w+)\s+SET\b(.*?)\bOUTPUT\s+inserted\.(\w+)\s+FROM\s+(\w+)\s+\1\b(.*)$', re.I | re.S),
+         r'UPDATE \4 AS \1 SET\2\5 RETURNING \3'),
+    ]
+    TOP = re.compile(r'\bSELECT\s+TOP\s*\(?\s*(\d+)\s*\)?', re.I)
+    traduzidas = {}
+    classes_linha = {}
+
+    def __init__(self, conexao):
+        self._cursor = conexao.cursor()
+        self.fast_executemany = False
+        self._classe_linha = None
+
+    @classmethod
+    def traduzir(cls, sql):
+        traduzida = cls.traduzidas.get(sql)
+        if traduzida is None:
+            traduzida = sql
+            for padrao, substituto in cls.TRADUCOES:
+                traduzida = padrao.sub(substituto, traduzida)
+            topo = cls.TOP.search(traduzida)
+            if topo:
+                traduzida = cls.TOP.sub('SELECT ', traduzida, count=1).rstrip() + f' LIMIT {topo.group(1)}'
+            cls.traduzidas[sql] = traduzida
+        return traduzida
+
+    def _preparar_linhas(self):
+        if not self._cursor.description:
+            self._classe_linha = None
+            return
+        nomes = tuple(coluna[0] for coluna in self._cursor.description)
+        classe = self.classes_linha.get(nomes)
+        if classe is None:
+            classe = self.classes_linha[nomes] = namedtuple('Row', nomes, rename=True)
+        self._classe_linha = classe
+
+    def execute(self, sql, *parametros):
+        if len(parametros) == 1 and isinstance(parametros[0], (tuple, list)):
+            parametros = parametros[0]
+        self._cursor.execute(self.traduzir(sql), parametros)
+        self._preparar_linhas()
+        return self
+
+    def executemany(self, sql, linhas):
+        self._cursor.executemany(self.traduzir(sql), linhas)
+        self._classe_linha = None
+
+    def _montar(self, linha):
+        return None if linha is None else self._classe_linha._make(linha)
+
+    def fetchone(self):
+        return self._montar(self._cursor.fetchone())
+
+    def fetchmany(self, tamanho=1):
+        return [self._classe_linha._make(linha) for linha in self._cursor.fetchmany(tamanho)]
+
+    def fetchall(self):
+        return [self._classe_linha._make(linha) for linha in self._cursor.fetchall()]
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+
+class ConexaoSubstituta:
+    def __init__(self, caminho):
+        self._conexao = sqlite3.connect(caminho, timeout=60, check_same_thread=False,
+                                        detect_types=sqlite3.PARSE_DECLTYPES)
+        self._conexao.create_function('rowversion', 1, _rowversion)
+        self._conexao.create_function('BINARY_CHECKSUM', -1, _binary_checksum)
+        self._conexao.create_aggregate('CHECKSUM_AGG', 1, ChecksumAgg)
+        self.autocommit = False
+
+    def cursor(self):
+        return CursorSubstituto(self._conexao)
+
+    def commit(self):
+        self._conexao.commit()
+
+    def rollback(self):
+        self._conexao.rollback()
+
+    def close(self):
+        self._conexao.close()
+
+
+class BancoSubstituto:
+    """Arquivo SQLite com o esquema usado pelo sender e um módulo 'pyodbc' que conecta nele"""
+    def __init__(self):
+        self.caminho = None
+        self.conexoes = 0
+
+    def criar(self, caminho):
+        self.caminho = caminho
+        conexao = ConexaoSubstituta(caminho)
+        conexao._conexao.execute('PRAGMA journal_mode=WAL')
+        conexao._conexao.executescript(ESQUEMA)
+        return conexao
+
+    def modulo_pyodbc(self):
+        banco = self
+        modulo = types.ModuleType('pyodbc')
+
+        class Error(Exception):
+            pass
+
+        def connect(*args, **kwargs):
+            banco.conexoes += 1
+            try:
+                return ConexaoSubstituta(banco.caminho)
+            except sqlite3.Error as e:
+                raise Error(str(e)) from e
+
+        modulo.Error = Error
+        modulo.connect = connect
+        modulo.drivers = lambda: ['ODBC Driver 17 for SQL Server']
+        return modulo
+
+
+# ---------------------------------------------------------------------------
+# Massa de dados
+# ---------------------------------------------------------------------------
+
+def gerar_pdf(caminho, numero, versao, tamanho_bytes):
+    """PDF mínimo válido com conteúdo único por pedido/versão"""
+    preenchimento = (f'% Pedido {numero} versao {versao}\n' * (tamanho_bytes // 32 + 1))[:tamanho_bytes]
+    conteudo = f'BT /F1 12 Tf 72 720 Td (Pedido {numero} v{versao}) Tj ET\n{preenchimento}'.encode('latin-1')
+    objetos = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R >>',
+        b'<< /Length ' + str(len(conteudo)).encode() + b' >>\nstream\n' + conteudo + b'\nendstream',
+    ]
+    saida = bytearray(b'%PDF-1.4\n')
+    posicoes = []
+    for indice, objeto in enumerate(objetos, start=1):
+        posicoes.append(len(saida))
+        saida += f'{indice} 0 obj\n'.encode() + objeto + b'\nendobj\n'
+    inicio_xref = len(saida)
+    saida += f'xref\n0 {len(objetos) + 1}\n0000000000 65535 f \n'.encode()
+    for posicao in posicoes:
+        saida += f'{posicao:010d} 00000 n \n'.encode()
+    saida += f'trailer\n<< /Size {len(objetos) + 1} /Root 1 0 R >>\nstartxref\n{inicio_xref}\n%%EOF\n'.encode()
+    with open(caminho, 'wb') as arquivo:
+        arquivo.write(saida)
+
+
+def gerar_massa(conexao, pasta_pdfs, quantidade, versoes, fracao_reenvio, tamanho_pdf_kb, args, porta_smtp):
+    """Popula o banco substituto e a pasta de PDFs com N pedidos e M versões"""
+    os.makedirs(pasta_pdfs, exist_ok=True)
+    cursor = conexao._conexao.cursor()
+    cursor.execute(
+        "INSERT INTO ConfiguracaoSistemaEmail (PdfsCaminho, EmailSmtpServidor, EmailSmtpPorta, EmailUsuario, "
+        "EmailSenhaApp, EmailRemetente, EmailExpositor, SistemaTrabalhadoresEnvio, SistemaTamanhoPaginaBusca, "
+        "EmailLimiteMensagensPorSegundo, EmailLimiteDestinatariosPorMinuto, SistemaTrabalhadoresEntrega) VALUES (?, '127.0.0.1', ?, "
+        "'benchmark@exemplo.com.br', 'senha', 'nao-responda@exemplo.com.br', 'expositor@exemplo.com.br', ?, ?, ?, ?, ?)",
+        (os.path.abspath(pasta_pdfs), porta_smtp, args.trabalhadores, args.tamanho_pagina,
+         args.limite_mensagens_por_segundo, args.limite_destinatarios_por_minuto, args.trabalhadores_entrega)
+    )
+    representantes = 20
+    clientes = max(1, quantidade // 10)
+    cursor.executemany("INSERT INTO Representante VALUES (?, ?)",
+                       [(i, f'representante{i}@exemplo.com.br') for i in range(1, representantes + 1)])
+    cursor.executemany("INSERT INTO Cliente VALUES (?, ?, ?)",
+                       [(i, f'cliente{i}@exemplo.com.br', f'Cliente {i}') for i in range(1, clientes + 1)])
+
+    inicio = datetime.now() - timedelta(days=30)
+    tamanho_pdf = tamanho_pdf_kb * 1024
+    cabecalhos, controles = [], []
+    for i in range(quantidade):
+        numero = 1000000 + i
+        cod_cliente = i % clientes + 1
+        cabecalhos.append((numero, cod_cliente, i % representantes + 1, 'F'))
+        reenvio = versoes > 1 and random.random() < fracao_reenvio
+        controles.append((
+            numero, cod_cliente, (inicio + timedelta(seconds=i)).isoformat(sep=' '),
+            f'copia{i % 7}@exemplo.com.br' if i % 3 == 0 else None,
+            'ENVIADO' if reenvio else 'PENDENTE', 1 if reenvio else 0, 1 if reenvio else None,
+        ))
+        for versao in range(1, versoes + 1):
+            nome = f'PEDIDO {numero}.pdf' if versao == 1 else f'PEDIDO {numero}_{versao}.pdf'
+            gerar_pdf(os.path.join(pasta_pdfs, nome), numero, versao, tamanho_pdf)
+    cursor.executemany("INSERT INTO CabecalhoPedido VALUES (?, ?, ?, ?)", cabecalhos)
+    cursor.executemany(
+        "INSERT INTO ControleEmailPedidos (NroPedido, CodCliente, DataPedidoFechado, EmailsCopia, "
+        "StatusProcessamento, EmailEnviado, VersaoPdfEnviada) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        controles
+    )
+    conexao.commit()
+
+
+# ---------------------------------------------------------------------------
+# Medição
+# ---------------------------------------------------------------------------
+
+def contar_status(caminho_banco):
+    conexao = sqlite3.connect(caminho_banco)
+    try:
+        return dict(conexao.execute(
+            "SELECT StatusProcessamento, COUNT(*) FROM ControleEmailPedidos GROUP BY StatusProcessamento"
+        ).fetchall())
+    finally:
+        conexao.close()
+
+
+def executar_cenario(sender, banco, coletor, quantidade, args):
+    """Gera a massa, executa um ciclo completo e um ciclo ocioso e devolve as medições"""
+    if args.diretorio:
+        os.makedirs(args.diretorio, exist_ok=True)
+    diretorio = os.path.abspath(tempfile.mkdtemp(prefix=f'benchmark_{quantidade}_', dir=args.diretorio))
+    diretorio_original = os.getcwd()
+    resultado = {'pedidos': quantidade, 'diretorio': diretorio}
+    try:
+        inicio = time.perf_counter()
+        conexao = banco.criar(os.path.join(diretorio, 'srpp.db'))
+        gerar_massa(conexao, os.path.join(diretorio, 'pdfs'), quantidade, args.versoes,
+                    args.fracao_reenvio, args.tamanho_pdf_kb, args, coletor.porta)
+        conexao.close()
+        resultado['preparacao_segundos'] = time.perf_counter() - inicio
+
+        os.chdir(diretorio)  # dados/ e planilhas do sender ficam no diretório do cenário
+        coletor.zerar()
+        sender.METRICAS.zerar()
+        if not args.sem_memoria:
+            tracemalloc.start()
+
+        inicio = time.perf_counter()
+        sistema = sender.SistemaEnvioEmails()
+        resultado['inicializacao_segundos'] = time.perf_counter() - inicio
+        if not sistema.config_db:
+            raise RuntimeError("o sender não carregou a configuração do banco substituto (veja benchmark.log)")
+        sistema.buffer_status.iniciar()
+        sistema.cache_anexos.iniciar()
+        sistema.caixa_saida.iniciar(int(sistema.get_config('SISTEMA', 'trabalhadores_entrega', fallback=2) or 0))
+        sistema.retomar_reservas()  # Como no main(): libera a entrega da caixa de saída
+
+        # O ciclo termina ao montar a última mensagem; a medição vai até a caixa de saída esvaziar
+        inicio = time.perf_counter()
+        sistema.executar_ciclo()
+        resultado['montagem_segundos'] = time.perf_counter() - inicio
+        sistema.caixa_saida.aguardar_vazia()
+        resultado['ciclo_segundos'] = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        sistema.executar_ciclo()
+        resultado['ciclo_ocioso_segundos'] = time.perf_counter() - inicio
+
+        sistema.encerrar()
+        if not args.sem_memoria:
+            resultado['pico_memoria_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+
+        resultado['status'] = contar_status(banco.caminho)
+        resultado['smtp'] = dict(coletor.contadores)
+        # Fases medidas pelo próprio sender (mesmos spans exportados em produção)
+        with sender.METRICAS.lock:
+            resultado['fases'] = {fase: {'segundos': soma, 'chamadas': sum(faixas)}
+                                  for fase, (faixas, soma) in sender.METRICAS.histogramas.items()}
+            resultado['eventos'] = dict(sender.METRICAS.contadores)
+        processados = resultado['status'].get('ENVIADO', 0)
+        resultado['pedidos_por_segundo'] = processados / resultado['ciclo_segundos'] if resultado['ciclo_segundos'] else 0
+        return resultado
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        os.chdir(diretorio_original)
+        if not args.manter:
+            shutil.rmtree(diretorio, ignore_errors=True)
+
+
+def imprimir_resultado(resultado):
+    print(f"\n=== {resultado['pedidos']} pedido(s) ===")
+    print(f"Preparação da massa:   {resultado['preparacao_segundos']:.2f}s (fora da medição)")
+    print(f"Inicialização:         {resultado['inicializacao_segundos']:.3f}s")
+    print(f"Ciclo completo:        {resultado['ciclo_segundos']:.2f}s (montagem {resultado['montagem_segundos']:.2f}s)")
+    print(f"Ciclo ocioso:          {resultado['ciclo_ocioso_segundos']:.3f}s")
+    print(f"Pedidos/s:             {resultado['pedidos_por_segundo']:.1f}")
+    if 'pico_memoria_mb' in resultado:
+        print(f"Pico de memória:       {resultado['pico_memoria_mb']:.1f} MB (tracemalloc)")
+    print(f"Status no banco:       {resultado['status']}")
+    smtp = resultado['smtp']
+    print(f"SMTP:                  {smtp['mensagens']} aceita(s), {smtp['erros']} erro(s), "
+          f"{smtp['throttling']} throttling, {smtp['bytes_recebidos'] / (1024 * 1024):.1f} MB")
+    print(f"Eventos:               {resultado['eventos']}")
+    print("Fases (tempo somado entre threads):")
+    for fase, dados in sorted(resultado['fases'].items(), key=lambda item: -item[1]['segundos']):
+        media = dados['segundos'] / dados['chamadas'] * 1000 if dados['chamadas'] else 0
+        print(f"  {fase:<36} {dados['segundos']:>9.3f}s  {dados['chamadas']:>8} chamada(s)  {media:>9.3f} ms/chamada")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline do sistema de envio de PDFs por email")
+    parser.add_argument('--pedidos', type=int, nargs='+', default=[100, 10000],
+                        help="quantidades de pedidos a medir (ex.: 100 10000 100000)")
+    parser.add_argument('--versoes', type=int, default=1, help="versões de PDF por pedido")
+    parser.add_argument('--fracao-reenvio', type=float, default=0.2,
+                        help="fração dos pedidos já enviados na versão 1 (com --versoes > 1 viram reenvio)")
+    parser.add_argument('--tamanho-pdf-kb', type=int, default=16, help="tamanho aproximado de cada PDF")
+    parser.add_argument('--trabalhadores', type=int, default=1, help="SistemaTrabalhadoresEnvio")
+    parser.add_argument('--trabalhadores-entrega', type=int, default=2,
+                        help="SistemaTrabalhadoresEntrega (0 = envio direto, sem caixa de saída)")
+    parser.add_argument('--tamanho-pagina', type=int, default=200, help="SistemaTamanhoPaginaBusca")
+    parser.add_argument('--limite-mensagens-por-segundo', type=float, default=0,
+                        help="EmailLimiteMensagensPorSegundo (0 = sem limite)")
+    parser.add_argument('--limite-destinatarios-por-minuto', type=int, default=0,
+                        help="EmailLimiteDestinatariosPorMinuto (0 = sem limite)")
+    parser.add_argument('--latencia-ms', type=float, default=0, help="latência do coletor SMTP por mensagem")
+    parser.add_argument('--taxa-erro', type=float, default=0.0, help="fração de mensagens recusadas com 451")
+    parser.add_argument('--taxa-throttling', type=float, default=0.0, help="fração de mensagens recusadas com 421 4.7.0")
+    parser.add_argument('--sem-memoria', action='store_true', help="não medir pico de memória (tracemalloc deixa o ciclo mais lento)")
+    parser.add_argument('--diretorio', default=None, help="onde criar os cenários (padrão: temporário do sistema)")
+    parser.add_argument('--manter', action='store_true', help="não apagar banco, PDFs e logs de cada cenário")
+    parser.add_argument('--nivel-log', default='WARNING', help="nível do log do sender (gravado em benchmark.log)")
+    parser.add_argument('--json', help="grava os resultados neste arquivo para comparação entre versões")
+    args = parser.parse_args()
+
+    # Configurado antes do sender: com o logger raiz já tendo handlers, o setup_logging do sender
+    # não inicia o LogAssincrono nem grava em logs/, e o nível do banco (SistemaNivelLog) não se aplica
+    logging.basicConfig(
+        level=getattr(logging, args.nivel_log.upper(), logging.WARNING),
+        format='%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s',
+        handlers=[logging.FileHandler('benchmark.log', encoding='utf-8')]
+    )
+
+    banco = BancoSubstituto()
+    sys.modules['pyodbc'] = banco.modulo_pyodbc()
+    # O coletor local não oferece TLS
+    smtplib.SMTP.starttls = lambda self, *args, **kwargs: (220, b'2.0.0 TLS desativado no benchmark')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import sender
+
+    coletor = ColetorSmtp(args.latencia_ms, args.taxa_erro, args.taxa_throttling)
+    coletor.iniciar()
+    print(f"Coletor SMTP em 127.0.0.1:{coletor.porta} (latência {args.latencia_ms}ms, "
+          f"erro {args.taxa_erro:.1%}, throttling {args.taxa_throttling:.1%})")
+
+    resultados = []
+    for quantidade in args.pedidos:
+        resultado = executar_cenario(sender, banco, coletor, quantidade, args)
+        imprimir_resultado(resultado)
+        resultados.append(resultado)
+
+    coletor.shutdown()
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as arquivo:
+            json.dump({'data': datetime.now().isoformat(), 'parametros': vars(args), 'resultados': resultados},
+                      arquivo, indent=2, ensure_ascii=False)
+        print(f"\nResultados gravados em {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,6 +21,12 @@ BEGIN
     PRINT 'Tabela ConfiguracaoSistemaEmailEmail (incorreta) removida.';
 END
 
+IF OBJECT_ID('dbo.ConfiguracaoSistemaEmailContaSmtp', 'U') IS NOT NULL
+BEGIN
+    DROP TABLE dbo.ConfiguracaoSistemaEmailContaSmtp;
+    PRINT 'Tabela ConfiguracaoSistemaEmailContaSmtp existente removida.';
+END
+
 IF OBJECT_ID('dbo.ConfiguracaoSistemaEmail', 'U') IS NOT NULL
 BEGIN
     DROP TABLE dbo.ConfiguracaoSistemaEmail;
@@ -49,6 +55,10 @@ CREATE TABLE dbo.ConfiguracaoSistemaEmail (
     EmailUsuario NVARCHAR(255) NOT NULL,
     EmailSenhaApp NVARCHAR(255) NOT NULL,
     EmailRemetente NVARCHAR(255) NOT NULL,
+    EmailSmtpMensagensPorConexao INT NOT NULL DEFAULT 100,
+    EmailSmtpOciosidadeSegundos INT NOT NULL DEFAULT 60,
+    EmailLimiteMensagensPorSegundo DECIMAL(6,2) NOT NULL DEFAULT 0,
+    EmailLimiteDestinatariosPorMinuto INT NOT NULL DEFAULT 0,
 
     -- Configurações de Email - Templates
     EmailAssunto NVARCHAR(500) NOT NULL DEFAULT 'Pedido {NroPedido} - PDF Anexado',
@@ -65,6 +75,14 @@ Equipe SRPP',
     SistemaAguardarSegundosAposArquivo INT NOT NULL DEFAULT 5,
     SistemaVerificacaoPeriodicaAtiva BIT NOT NULL DEFAULT 1,
     SistemaVerificacaoPeriodicaMinutos INT NOT NULL DEFAULT 30,
+    SistemaTrabalhadoresEnvio INT NOT NULL DEFAULT 1,
+    SistemaTamanhoPaginaBusca INT NOT NULL DEFAULT 200,
+    SistemaMetricasPorta INT NOT NULL DEFAULT 0,
+    SistemaTrabalhadoresEntrega INT NOT NULL DEFAULT 2,
+    SistemaMinutosReserva INT NOT NULL DEFAULT 30,
+    SistemaNivelLog VARCHAR(10) NOT NULL DEFAULT 'INFO',
+    SistemaLogTamanhoMaximoMB INT NOT NULL DEFAULT 20,
+    SistemaLogArquivosMantidos INT NOT NULL DEFAULT 10,
 
     -- Configurações de Cool-down (em minutos)
     SistemaCooldownTentativa1 INT NOT NULL DEFAULT 2,
@@ -77,6 +95,7 @@ Equipe SRPP',
     Ativo BIT NOT NULL DEFAULT 1,
     DataCriacao DATETIME NOT NULL DEFAULT GETDATE(),
     DataAlteracao DATETIME NULL,
+    VersaoConfiguracao ROWVERSION,
     UsuarioAlteracao NVARCHAR(100) NULL,
     Observacoes NVARCHAR(MAX) NULL
 );
@@ -88,6 +107,22 @@ ON dbo.ConfiguracaoSistemaEmail(Ativo)
 WHERE Ativo = 1;
 GO
 
+-- Contas SMTP adicionais (opcional): o envio é distribuído entre as contas ativas.
+-- Sem registros ativos, usa EmailUsuario/EmailSenhaApp acima.
+CREATE TABLE dbo.ConfiguracaoSistemaEmailContaSmtp (
+    Id INT IDENTITY(1,1) PRIMARY KEY,
+    ConfiguracaoId INT NOT NULL
+        REFERENCES dbo.ConfiguracaoSistemaEmail(Id),
+    SmtpServidor NVARCHAR(255) NOT NULL,
+    SmtpPorta INT NOT NULL DEFAULT 587,
+    Usuario NVARCHAR(255) NOT NULL,
+    SenhaApp NVARCHAR(255) NOT NULL,
+    Ativo BIT NOT NULL DEFAULT 1,
+    DataCriacao DATETIME NOT NULL DEFAULT GETDATE(),
+    Observacoes NVARCHAR(MAX) NULL
+);
+GO
+
 -- Comentários na tabela
 EXEC sys.sp_addextendedproperty
     @name=N'MS_Description',
@@ -0,0 +1,346 @@
+-- =====================================================
+-- Script de Migração: Parâmetros de desempenho do envio
+-- Sistema: EnviaEmailSRPP
+-- Versão: 3.x - Pool de conexões SMTP e demais otimizações
+-- Descrição: Execute este script em instalações existentes para adicionar
+--            as novas colunas sem recriar as tabelas.
+-- =====================================================
+
+USE SRPP;
+GO
+
+-- Pool SMTP: quantidade de mensagens enviadas por conexão antes de reciclá-la
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'EmailSmtpMensagensPorConexao'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD EmailSmtpMensagensPorConexao INT NOT NULL DEFAULT 100;
+
+    PRINT 'Coluna EmailSmtpMensagensPorConexao adicionada com sucesso.';
+END
+GO
+
+-- Pool SMTP: segundos de ociosidade antes de descartar uma conexão
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'EmailSmtpOciosidadeSegundos'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD EmailSmtpOciosidadeSegundos INT NOT NULL DEFAULT 60;
+
+    PRINT 'Coluna EmailSmtpOciosidadeSegundos adicionada com sucesso.';
+END
+GO
+
+-- Envio paralelo: quantidade de trabalhadores (1 = sequencial)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'SistemaTrabalhadoresEnvio'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD SistemaTrabalhadoresEnvio INT NOT NULL DEFAULT 1;
+
+    PRINT 'Coluna SistemaTrabalhadoresEnvio adicionada com sucesso.';
+END
+GO
+
+-- Carimbo de versão da configuração (muda automaticamente a cada UPDATE)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'VersaoConfiguracao'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD VersaoConfiguracao ROWVERSION;
+
+    PRINT 'Coluna VersaoConfiguracao adicionada com sucesso.';
+END
+GO
+
+-- Reenvio: maior versão de PDF encontrada na pasta (gravada pelo serviço ao detectar o arquivo)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ControleEmailPedidos'
+      AND COLUMN_NAME = 'VersaoPdfDisponivel'
+)
+BEGIN
+    ALTER TABLE dbo.ControleEmailPedidos
+    ADD VersaoPdfDisponivel INT NULL;
+
+    PRINT 'Coluna VersaoPdfDisponivel adicionada com sucesso.';
+END
+GO
+
+-- Reenvio: índice para localizar ENVIADOS com versão de PDF mais nova sem varrer o histórico
+IF NOT EXISTS (
+    SELECT 1 FROM sys.indexes
+    WHERE name = 'IX_ControleEmailPedidos_Reenvio'
+      AND object_id = OBJECT_ID('dbo.ControleEmailPedidos')
+)
+BEGIN
+    CREATE INDEX IX_ControleEmailPedidos_Reenvio
+    ON dbo.ControleEmailPedidos(StatusProcessamento, EmailEnviado)
+    INCLUDE (VersaoPdfDisponivel, VersaoPdfEnviada);
+
+    PRINT 'Índice IX_ControleEmailPedidos_Reenvio criado com sucesso.';
+END
+GO
+
+-- Busca de candidatos: quantidade de linhas lidas por página (fetchmany)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'SistemaTamanhoPaginaBusca'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD SistemaTamanhoPaginaBusca INT NOT NULL DEFAULT 200;
+
+    PRINT 'Coluna SistemaTamanhoPaginaBusca adicionada com sucesso.';
+END
+GO
+
+-- Cool-down: data/hora a partir da qual um pedido em ERRO pode ser retentado
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ControleEmailPedidos'
+      AND COLUMN_NAME = 'ProximaTentativa'
+)
+BEGIN
+    ALTER TABLE dbo.ControleEmailPedidos
+    ADD ProximaTentativa DATETIME NULL;
+
+    PRINT 'Coluna ProximaTentativa adicionada com sucesso.';
+END
+GO
+
+-- Verificação periódica: carimbo de alteração da linha (marca d'água incremental)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ControleEmailPedidos'
+      AND COLUMN_NAME = 'VersaoLinha'
+)
+BEGIN
+    ALTER TABLE dbo.ControleEmailPedidos
+    ADD VersaoLinha ROWVERSION;
+
+    PRINT 'Coluna VersaoLinha adicionada com sucesso.';
+END
+GO
+
+-- Verificação periódica: índice para a varredura incremental por VersaoLinha
+IF NOT EXISTS (
+    SELECT 1 FROM sys.indexes
+    WHERE name = 'IX_ControleEmailPedidos_VersaoLinha'
+      AND object_id = OBJECT_ID('dbo.ControleEmailPedidos')
+)
+BEGIN
+    CREATE INDEX IX_ControleEmailPedidos_VersaoLinha
+    ON dbo.ControleEmailPedidos(VersaoLinha);
+
+    PRINT 'Índice IX_ControleEmailPedidos_VersaoLinha criado com sucesso.';
+END
+GO
+
+-- Várias contas SMTP: cada conta/relay tem sua própria cota do provedor.
+-- Sem registros ativos aqui, o sistema usa EmailUsuario/EmailSenhaApp da configuração.
+IF OBJECT_ID('dbo.ConfiguracaoSistemaEmailContaSmtp', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.ConfiguracaoSistemaEmailContaSmtp (
+        Id INT IDENTITY(1,1) PRIMARY KEY,
+        ConfiguracaoId INT NOT NULL
+            REFERENCES dbo.ConfiguracaoSistemaEmail(Id),
+        SmtpServidor NVARCHAR(255) NOT NULL,
+        SmtpPorta INT NOT NULL DEFAULT 587,
+        Usuario NVARCHAR(255) NOT NULL,
+        SenhaApp NVARCHAR(255) NOT NULL,
+        Ativo BIT NOT NULL DEFAULT 1,
+        DataCriacao DATETIME NOT NULL DEFAULT GETDATE(),
+        Observacoes NVARCHAR(MAX) NULL
+    );
+
+    PRINT 'Tabela ConfiguracaoSistemaEmailContaSmtp criada com sucesso.';
+END
+GO
+
+-- Limitador de taxa: mensagens por segundo por conta SMTP (0 = sem limite; após um throttling
+-- o recuo adaptativo parte da taxa observada da conta e o limite some quando ela se recupera)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'EmailLimiteMensagensPorSegundo'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD EmailLimiteMensagensPorSegundo DECIMAL(6,2) NOT NULL DEFAULT 0;
+
+    PRINT 'Coluna EmailLimiteMensagensPorSegundo adicionada com sucesso.';
+END
+GO
+
+-- Limitador de taxa: destinatários por minuto por conta SMTP (0 = sem limite)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'EmailLimiteDestinatariosPorMinuto'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD EmailLimiteDestinatariosPorMinuto INT NOT NULL DEFAULT 0;
+
+    PRINT 'Coluna EmailLimiteDestinatariosPorMinuto adicionada com sucesso.';
+END
+GO
+
+-- Deduplicação: SHA-256 do PDF da última versão enviada (reenvio de conteúdo idêntico é dispensado)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ControleEmailPedidos'
+      AND COLUMN_NAME = 'HashPdfEnviado'
+)
+BEGIN
+    ALTER TABLE dbo.ControleEmailPedidos
+    ADD HashPdfEnviado CHAR(64) NULL;
+
+    PRINT 'Coluna HashPdfEnviado adicionada com sucesso.';
+END
+GO
+
+-- Métricas: porta HTTP local para GET /metrics (0 = só o arquivo dados\metricas.prom)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'SistemaMetricasPorta'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD SistemaMetricasPorta INT NOT NULL DEFAULT 0;
+
+    PRINT 'Coluna SistemaMetricasPorta adicionada com sucesso.';
+END
+GO
+
+-- Trabalhadores que entregam as mensagens da caixa de saída (0 = envio direto, sem caixa de saída; lido na inicialização)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'SistemaTrabalhadoresEntrega'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD SistemaTrabalhadoresEntrega INT NOT NULL DEFAULT 2;
+
+    PRINT 'Coluna SistemaTrabalhadoresEntrega adicionada com sucesso.';
+END
+GO
+
+-- Várias instâncias: status do pedido antes da reserva (retomado quando a reserva vence)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ControleEmailPedidos'
+      AND COLUMN_NAME = 'StatusAnterior'
+)
+BEGIN
+    ALTER TABLE dbo.ControleEmailPedidos
+    ADD StatusAnterior VARCHAR(50) NULL;
+
+    PRINT 'Coluna StatusAnterior adicionada com sucesso.';
+END
+GO
+
+-- Várias instâncias: instância que reservou o pedido (máquina e pasta de instalação)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ControleEmailPedidos'
+      AND COLUMN_NAME = 'ProcessandoPor'
+)
+BEGIN
+    ALTER TABLE dbo.ControleEmailPedidos
+    ADD ProcessandoPor VARCHAR(100) NULL;
+
+    PRINT 'Coluna ProcessandoPor adicionada com sucesso.';
+END
+GO
+
+-- Várias instâncias: validade da reserva; vencida, o pedido volta a ser candidato para qualquer instância
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ControleEmailPedidos'
+      AND COLUMN_NAME = 'ProcessandoAte'
+)
+BEGIN
+    ALTER TABLE dbo.ControleEmailPedidos
+    ADD ProcessandoAte DATETIME NULL;
+
+    PRINT 'Coluna ProcessandoAte adicionada com sucesso.';
+END
+GO
+
+-- Várias instâncias: validade em minutos da reserva de um pedido (renovada enquanto a instância está ativa)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'SistemaMinutosReserva'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD SistemaMinutosReserva INT NOT NULL DEFAULT 30;
+
+    PRINT 'Coluna SistemaMinutosReserva adicionada com sucesso.';
+END
+GO
+
+-- Log: nível do arquivo/console (DEBUG, INFO, WARNING, ERROR)
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'SistemaNivelLog'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD SistemaNivelLog VARCHAR(10) NOT NULL DEFAULT 'INFO';
+
+    PRINT 'Coluna SistemaNivelLog adicionada com sucesso.';
+END
+GO
+
+-- Log: tamanho em MB a partir do qual envio_emails.log é rotacionado e compactado
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'SistemaLogTamanhoMaximoMB'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD SistemaLogTamanhoMaximoMB INT NOT NULL DEFAULT 20;
+
+    PRINT 'Coluna SistemaLogTamanhoMaximoMB adicionada com sucesso.';
+END
+GO
+
+-- Log: quantidade de arquivos rotacionados (.gz) mantidos
+IF NOT EXISTS (
+    SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_NAME = 'ConfiguracaoSistemaEmail'
+      AND COLUMN_NAME = 'SistemaLogArquivosMantidos'
+)
+BEGIN
+    ALTER TABLE dbo.ConfiguracaoSistemaEmail
+    ADD SistemaLogArquivosMantidos INT NOT NULL DEFAULT 10;
+
+    PRINT 'Coluna SistemaLogArquivosMantidos adicionada com sucesso.';
+END
+GO
+
+PRINT '=================================================';
+PRINT 'Migração v3 concluída!';
+PRINT '=================================================';
+GO
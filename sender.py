@@ -5,39 +5,49 @@ Sistema de Envio Automático de PDFs por Email
 Monitora pasta de PDFs e processa automaticamente quando novos arquivos são criados
 """
 
+import time
+INICIO_PROCESSO = time.perf_counter()  # Referência do tempo de inicialização exibido no --teste
+
 import os
 import re
-import glob
+import string
+import socket
 import smtplib
 import logging
-import pyodbc
-import time
+import gzip
+import shutil
+import atexit
 import signal
 import sys
+import json
+import base64
 import hashlib
-from datetime import datetime
+import heapq
+import bisect
+import queue
+import threading
+import importlib.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
-from email import encoders
+from email import message_from_bytes, policy
 from pathlib import Path
 
-# Para logs em Excel
-try:
-    import openpyxl
-    from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
-    from openpyxl.utils import get_column_letter
-    EXCEL_DISPONIVEL = True
-except ImportError:
-    EXCEL_DISPONIVEL = False
+# Para logs em Excel (o openpyxl só é importado na primeira gravação, fora do caminho de inicialização)
+EXCEL_DISPONIVEL = importlib.util.find_spec('openpyxl') is not None
 
-# Para monitoramento de arquivos
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+# Para acesso ao banco: o pyodbc é importado na primeira conexão do PoolConexoesBanco
+
+# Para monitoramento de arquivos: o watchdog é importado em main(), depois da verificação inicial
 
 class SistemaEnvioEmails:
-    def __init__(self):
-        """Inicializa o sistema com configurações"""
+    def __init__(self, somente_leitura=False):
+        """Inicializa o sistema com configurações (somente_leitura = --teste: nada é gravado em disco)"""
         # Configurações de conexão SQL embutidas (não mudam nunca)
         self.sql_config = {
             'servidor': '127.0.0.1',
@@ -47,11 +57,27 @@ class SistemaEnvioEmails:
             'driver_preferencial': 'ODBC Driver 17 for SQL Server'
         }
         self.config_db = None  # Configurações carregadas do banco de dados
+        self.templates = TemplatesEmail(TemplatesEmail.ASSUNTO_PADRAO, TemplatesEmail.CORPO_PADRAO)
+        self.versao_config = None  # (Id, VersaoConfiguracao, VersaoContasSmtp) do registro carregado
         self.setup_logging()
+        self._local_thread = threading.local()
         self.conexao_db = None
         self.excel_logger = None
+        self.indice_pdfs = IndicePdfs(self.logger)
+        self.pool_banco = PoolConexoesBanco(self.sql_config, self.logger, gravar_driver=not somente_leitura)
+        self.contas_smtp = DistribuidorSmtp(self.logger)
+        self.buffer_status = BufferStatus(self.pool_banco, self.logger)
+        self.cache_anexos = CacheAnexos(self.logger)
+        self.agendador_tentativas = AgendadorTentativas(self)
+        self.caixa_saida = CaixaSaida(self)
+        self.lock_ciclo = threading.Lock()  # Ciclos (eventos, tentativas, verificação) nunca se sobrepõem
+        self.marca_dagua = None  # MIN_ACTIVE_ROWVERSION do início da última varredura concluída
+        self.verificacoes_incrementais = 0  # Verificações incrementais desde a última varredura completa
+        # Dono das reservas em ControleEmailPedidos: estável entre reinícios da mesma instalação
+        self.identificacao_instancia = f"{socket.gethostname()}:{hashlib.sha1(os.path.abspath('.').encode('utf-8')).hexdigest()[:8]}"
         self.carregar_configuracoes_banco()  # Tenta carregar configurações do banco
-        self.setup_excel_logging()
+        if not somente_leitura:
+            self.setup_excel_logging()
 
     def carregar_configuracoes_banco(self):
         """Carrega configurações da tabela ConfiguracaoSistemaEmail no banco de dados"""
@@ -61,115 +87,246 @@ class SistemaEnvioEmails:
                 self.logger.error("ERRO CRÍTICO: Não foi possível conectar ao banco de dados. Verifique se o SQL Server está acessível.")
                 return False
 
-            cursor = self.conexao_db.cursor()
-            query = """
-                SELECT TOP 1
-                    SqlServidor, SqlBancoDados, SqlUsuario, SqlSenha, SqlDriver,
-                    PdfsCaminho,
-                    EmailSmtpServidor, EmailSmtpPorta, EmailUsuario, EmailSenhaApp, EmailRemetente,
-                    EmailAssunto, EmailCorpo, EmailResponderPara,
-                    SistemaVerificacaoInicial, SistemaAguardarSegundosAposArquivo,
-                    SistemaVerificacaoPeriodicaAtiva, SistemaVerificacaoPeriodicaMinutos,
-                    SistemaCooldownTentativa1, SistemaCooldownTentativa2, SistemaCooldownTentativa3,
-                    SistemaCooldownTentativa4, SistemaCooldownTentativa5Mais,
-                    EmailExpositor
-                FROM ConfiguracaoSistemaEmail
-                WHERE Ativo = 1
-            """
-            cursor.execute(query)
-            row = cursor.fetchone()
-
-            if row:
-                self.config_db = {
-                    'sql_servidor': row.SqlServidor,
-                    'sql_banco_dados': row.SqlBancoDados,
-                    'sql_usuario': row.SqlUsuario,
-                    'sql_senha': row.SqlSenha,
-                    'sql_driver': row.SqlDriver,
-                    'pdfs_caminho': row.PdfsCaminho,
-                    'email_smtp_servidor': row.EmailSmtpServidor,
-                    'email_smtp_porta': row.EmailSmtpPorta,
-                    'email_usuario': row.EmailUsuario,
-                    'email_senha_app': row.EmailSenhaApp,
-                    'email_remetente': row.EmailRemetente,
-                    'email_assunto': row.EmailAssunto,
-                    'email_corpo': row.EmailCorpo,
-                    'email_responder_para': row.EmailResponderPara,
-                    'sistema_verificacao_inicial': row.SistemaVerificacaoInicial,
-                    'sistema_aguardar_segundos': row.SistemaAguardarSegundosAposArquivo,
-                    'sistema_verificacao_periodica_ativa': row.SistemaVerificacaoPeriodicaAtiva,
-                    'sistema_verificacao_periodica_minutos': row.SistemaVerificacaoPeriodicaMinutos,
-                    'cooldown_tentativa_1': row.SistemaCooldownTentativa1,
-                    'cooldown_tentativa_2': row.SistemaCooldownTentativa2,
-                    'cooldown_tentativa_3': row.SistemaCooldownTentativa3,
-                    'cooldown_tentativa_4': row.SistemaCooldownTentativa4,
-                    'cooldown_tentativa_5_mais': row.SistemaCooldownTentativa5Mais,
-                    'email_expositor': row.EmailExpositor,
-                }
+            if self._ler_configuracoes(self.conexao_db.cursor()):
                 self.logger.info("Configurações carregadas do banco de dados com sucesso!")
-                self.conexao_db.close()
-                self.conexao_db = None
+                self.desconectar_banco()
                 return True
             else:
                 self.logger.error("ERRO CRÍTICO: Nenhuma configuração ativa encontrada na tabela ConfiguracaoSistemaEmail.")
                 self.logger.error("SOLUÇÃO: Execute o script SQL 'criar_tabela_configuracoes.sql' para criar a tabela.")
-                self.conexao_db.close()
-                self.conexao_db = None
+                self.desconectar_banco()
                 return False
 
         except Exception as e:
             self.logger.error(f"ERRO ao carregar configurações do banco: {e}")
-            if self.conexao_db:
-                self.conexao_db.close()
-                self.conexao_db = None
+            self.desconectar_banco(descartar=True)
+            return False
+
+    # Carimbo das contas SMTP adicionais (a tabela filha não altera o rowversion da configuração)
+    VERSAO_CONTAS_SMTP = """
+        (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(cs.Id, cs.SmtpServidor, cs.SmtpPorta, cs.Usuario, cs.SenhaApp, cs.Ativo))
+         FROM ConfiguracaoSistemaEmailContaSmtp cs
+         WHERE cs.ConfiguracaoId = ConfiguracaoSistemaEmail.Id) AS VersaoContasSmtp
+    """
+
+    def _ler_configuracoes(self, cursor):
+        """Lê o registro ativo de ConfiguracaoSistemaEmail e reconstrói o que depende dele"""
+        query = f"""
+            SELECT TOP 1
+                Id, VersaoConfiguracao, {self.VERSAO_CONTAS_SMTP},
+                SqlServidor, SqlBancoDados, SqlUsuario, SqlSenha, SqlDriver,
+                PdfsCaminho,
+                EmailSmtpServidor, EmailSmtpPorta, EmailUsuario, EmailSenhaApp, EmailRemetente,
+                EmailAssunto, EmailCorpo, EmailResponderPara,
+                SistemaVerificacaoInicial, SistemaAguardarSegundosAposArquivo,
+                SistemaVerificacaoPeriodicaAtiva, SistemaVerificacaoPeriodicaMinutos,
+                SistemaCooldownTentativa1, SistemaCooldownTentativa2, SistemaCooldownTentativa3,
+                SistemaCooldownTentativa4, SistemaCooldownTentativa5Mais,
+                EmailExpositor,
+                EmailSmtpMensagensPorConexao, EmailSmtpOciosidadeSegundos,
+                EmailLimiteMensagensPorSegundo, EmailLimiteDestinatariosPorMinuto,
+                SistemaTrabalhadoresEnvio, SistemaTamanhoPaginaBusca, SistemaMetricasPorta, SistemaTrabalhadoresEntrega,
+                SistemaMinutosReserva, SistemaNivelLog, SistemaLogTamanhoMaximoMB, SistemaLogArquivosMantidos
+            FROM ConfiguracaoSistemaEmail
+            WHERE Ativo = 1
+        """
+        cursor.execute(query)
+        row = cursor.fetchone()
+        if not row:
             return False
 
+        cursor.execute("""
+            SELECT SmtpServidor, SmtpPorta, Usuario, SenhaApp
+            FROM ConfiguracaoSistemaEmailContaSmtp
+            WHERE ConfiguracaoId = ? AND Ativo = 1
+            ORDER BY Id
+        """, row.Id)
+        contas_smtp = [(c.SmtpServidor, c.SmtpPorta, c.Usuario, c.SenhaApp) for c in cursor.fetchall()]
+
+        self.config_db = {
+            'sql_servidor': row.SqlServidor,
+            'sql_banco_dados': row.SqlBancoDados,
+            'sql_usuario': row.SqlUsuario,
+            'sql_senha': row.SqlSenha,
+            'sql_driver': row.SqlDriver,
+            'pdfs_caminho': row.PdfsCaminho,
+            'email_smtp_servidor': row.EmailSmtpServidor,
+            'email_smtp_porta': row.EmailSmtpPorta,
+            'email_usuario': row.EmailUsuario,
+            'email_senha_app': row.EmailSenhaApp,
+            'email_remetente': row.EmailRemetente,
+            'email_assunto': row.EmailAssunto,
+            'email_corpo': row.EmailCorpo,
+            'email_responder_para': row.EmailResponderPara,
+            'sistema_verificacao_inicial': row.SistemaVerificacaoInicial,
+            'sistema_aguardar_segundos': row.SistemaAguardarSegundosAposArquivo,
+            'sistema_verificacao_periodica_ativa': row.SistemaVerificacaoPeriodicaAtiva,
+            'sistema_verificacao_periodica_minutos': row.SistemaVerificacaoPeriodicaMinutos,
+            'cooldown_tentativa_1': row.SistemaCooldownTentativa1,
+            'cooldown_tentativa_2': row.SistemaCooldownTentativa2,
+            'cooldown_tentativa_3': row.SistemaCooldownTentativa3,
+            'cooldown_tentativa_4': row.SistemaCooldownTentativa4,
+            'cooldown_tentativa_5_mais': row.SistemaCooldownTentativa5Mais,
+            'email_expositor': row.EmailExpositor,
+            'email_smtp_mensagens_por_conexao': row.EmailSmtpMensagensPorConexao,
+            'email_smtp_ociosidade_segundos': row.EmailSmtpOciosidadeSegundos,
+            'email_limite_mensagens_por_segundo': row.EmailLimiteMensagensPorSegundo,
+            'email_limite_destinatarios_por_minuto': row.EmailLimiteDestinatariosPorMinuto,
+            'sistema_trabalhadores_envio': row.SistemaTrabalhadoresEnvio,
+            'sistema_tamanho_pagina_busca': row.SistemaTamanhoPaginaBusca,
+            'sistema_metricas_porta': row.SistemaMetricasPorta,
+            'sistema_trabalhadores_entrega': row.SistemaTrabalhadoresEntrega,
+            'sistema_minutos_reserva': row.SistemaMinutosReserva,
+            'sistema_nivel_log': row.SistemaNivelLog,
+            'sistema_log_tamanho_maximo_mb': row.SistemaLogTamanhoMaximoMB,
+            'sistema_log_arquivos_mantidos': row.SistemaLogArquivosMantidos,
+            'email_contas_smtp': contas_smtp,
+        }
+        self.versao_config = (row.Id, bytes(row.VersaoConfiguracao), row.VersaoContasSmtp)
+        self.configurar_log()
+        self.compilar_templates()
+        self.configurar_contas_smtp()
+        return True
+
+    def atualizar_configuracoes(self):
+        """Confere o carimbo de versão na conexão já aberta e só relê a configuração se ela mudou"""
+        try:
+            cursor = self.conexao_db.cursor()
+            cursor.execute(f"SELECT Id, VersaoConfiguracao, {self.VERSAO_CONTAS_SMTP} FROM ConfiguracaoSistemaEmail WHERE Ativo = 1")
+            row = cursor.fetchone()
+            if not row:
+                self.logger.error("Nenhuma configuração ativa encontrada - mantendo configuração em memória")
+                return self.config_db is not None
+            if self.config_db and (row.Id, bytes(row.VersaoConfiguracao), row.VersaoContasSmtp) == self.versao_config:
+                return True
+            if self._ler_configuracoes(cursor):
+                self.logger.info("Configuração alterada no banco de dados - recarregada")
+            return True
+        except Exception as e:
+            self.logger.error(f"Erro ao verificar versão das configurações: {e}")
+            return self.config_db is not None
+
+    # Mapeia seção/chave para as chaves do dicionário do banco
+    MAPA_CONFIG = {
+        ('PDFS', 'caminho'): 'pdfs_caminho',
+        ('EMAIL', 'smtp_servidor'): 'email_smtp_servidor',
+        ('EMAIL', 'smtp_porta'): 'email_smtp_porta',
+        ('EMAIL', 'usuario'): 'email_usuario',
+        ('EMAIL', 'senha_app'): 'email_senha_app',
+        ('EMAIL', 'remetente_nome'): 'email_remetente',
+        ('EMAIL', 'reply_to'): 'email_responder_para',
+        ('EMAIL', 'smtp_mensagens_por_conexao'): 'email_smtp_mensagens_por_conexao',
+        ('EMAIL', 'smtp_ociosidade_segundos'): 'email_smtp_ociosidade_segundos',
+        ('EMAIL', 'contas_smtp'): 'email_contas_smtp',
+        ('EMAIL', 'limite_mensagens_por_segundo'): 'email_limite_mensagens_por_segundo',
+        ('EMAIL', 'limite_destinatarios_por_minuto'): 'email_limite_destinatarios_por_minuto',
+        ('SISTEMA', 'verificacao_inicial'): 'sistema_verificacao_inicial',
+        ('SISTEMA', 'aguardar_segundos_apos_arquivo'): 'sistema_aguardar_segundos',
+        ('SISTEMA', 'verificacao_periodica_ativa'): 'sistema_verificacao_periodica_ativa',
+        ('SISTEMA', 'verificacao_periodica_minutos'): 'sistema_verificacao_periodica_minutos',
+        ('SISTEMA', 'cooldown_tentativa_1'): 'cooldown_tentativa_1',
+        ('SISTEMA', 'cooldown_tentativa_2'): 'cooldown_tentativa_2',
+        ('SISTEMA', 'cooldown_tentativa_3'): 'cooldown_tentativa_3',
+        ('SISTEMA', 'cooldown_tentativa_4'): 'cooldown_tentativa_4',
+        ('SISTEMA', 'cooldown_tentativa_5_mais'): 'cooldown_tentativa_5_mais',
+        ('SISTEMA', 'trabalhadores_envio'): 'sistema_trabalhadores_envio',
+        ('SISTEMA', 'tamanho_pagina_busca'): 'sistema_tamanho_pagina_busca',
+        ('SISTEMA', 'metricas_porta'): 'sistema_metricas_porta',
+        ('SISTEMA', 'trabalhadores_entrega'): 'sistema_trabalhadores_entrega',
+        ('SISTEMA', 'minutos_reserva'): 'sistema_minutos_reserva',
+        ('SISTEMA', 'nivel_log'): 'sistema_nivel_log',
+        ('SISTEMA', 'log_tamanho_maximo_mb'): 'sistema_log_tamanho_maximo_mb',
+        ('SISTEMA', 'log_arquivos_mantidos'): 'sistema_log_arquivos_mantidos',
+    }
+
     def get_config(self, secao, chave, fallback=None):
-        """Obtém configuração do banco de dados"""
+        """Obtém configuração do banco de dados (em memória)"""
         if not self.config_db:
             self.logger.error(f"ERRO: Tentativa de obter configuração '{secao}.{chave}' mas config_db não está carregado!")
             return fallback
 
-        # Mapeia seção/chave para as chaves do dicionário do banco
-        mapa = {
-            ('PDFS', 'caminho'): 'pdfs_caminho',
-            ('EMAIL', 'smtp_servidor'): 'email_smtp_servidor',
-            ('EMAIL', 'smtp_porta'): 'email_smtp_porta',
-            ('EMAIL', 'usuario'): 'email_usuario',
-            ('EMAIL', 'senha_app'): 'email_senha_app',
-            ('EMAIL', 'remetente_nome'): 'email_remetente',
-            ('EMAIL', 'reply_to'): 'email_responder_para',
-            ('SISTEMA', 'verificacao_inicial'): 'sistema_verificacao_inicial',
-            ('SISTEMA', 'aguardar_segundos_apos_arquivo'): 'sistema_aguardar_segundos',
-            ('SISTEMA', 'verificacao_periodica_ativa'): 'sistema_verificacao_periodica_ativa',
-            ('SISTEMA', 'verificacao_periodica_minutos'): 'sistema_verificacao_periodica_minutos',
-            ('SISTEMA', 'cooldown_tentativa_1'): 'cooldown_tentativa_1',
-            ('SISTEMA', 'cooldown_tentativa_2'): 'cooldown_tentativa_2',
-            ('SISTEMA', 'cooldown_tentativa_3'): 'cooldown_tentativa_3',
-            ('SISTEMA', 'cooldown_tentativa_4'): 'cooldown_tentativa_4',
-            ('SISTEMA', 'cooldown_tentativa_5_mais'): 'cooldown_tentativa_5_mais',
-        }
-
-        chave_db = mapa.get((secao, chave))
+        chave_db = self.MAPA_CONFIG.get((secao, chave))
         if chave_db and chave_db in self.config_db:
             return self.config_db[chave_db]
 
         return fallback
+
+    @property
+    def conexao_db(self):
+        """Conexão com o banco da thread atual (cada trabalhador de envio usa a sua)"""
+        return getattr(self._local_thread, 'conexao_db', None)
+
+    @conexao_db.setter
+    def conexao_db(self, valor):
+        self._local_thread.conexao_db = valor
+
+    def configurar_contas_smtp(self):
+        """Aplica as contas SMTP atuais ao distribuidor (sem contas adicionais, usa EmailUsuario/EmailSenhaApp)"""
+        contas = self.get_config('EMAIL', 'contas_smtp') or [(
+            self.get_config('EMAIL', 'smtp_servidor'),
+            self.get_config('EMAIL', 'smtp_porta'),
+            self.get_config('EMAIL', 'usuario'),
+            self.get_config('EMAIL', 'senha_app'),
+        )]
+        self.contas_smtp.configurar(
+            [(servidor, int(porta or 587), usuario, senha) for servidor, porta, usuario, senha in contas],
+            int(self.get_config('EMAIL', 'smtp_mensagens_por_conexao', fallback=100) or 100),
+            int(self.get_config('EMAIL', 'smtp_ociosidade_segundos', fallback=60) or 60),
+            float(self.get_config('EMAIL', 'limite_mensagens_por_segundo', fallback=0) or 0),
+            int(self.get_config('EMAIL', 'limite_destinatarios_por_minuto', fallback=0) or 0),
+        )
+
+    def compilar_templates(self):
+        """Valida e prepara os templates de email; um template inválido é rejeitado aqui, não no envio"""
+        email_reply_to = self.get_config('EMAIL', 'reply_to')
+        variaveis_fixas = {
+            'ResponderPara': email_reply_to if email_reply_to else '',
+            'EmailReplyTo': email_reply_to if email_reply_to else '',
+            'HeaderColor': '#0a77d5',
+        }
+        try:
+            self.templates = TemplatesEmail(
+                self.config_db.get('email_assunto') or TemplatesEmail.ASSUNTO_PADRAO,
+                self.config_db.get('email_corpo') or TemplatesEmail.CORPO_PADRAO,
+                variaveis_fixas,
+            )
+            self.logger.debug(f"Templates de email preparados (conteúdo: {self.templates.tipo_conteudo})")
+        except ValueError as e:
+            self.logger.error(f"ERRO: Template de email inválido em ConfiguracaoSistemaEmail - {e}")
+            anterior = "o template padrão" if self.templates.assunto == TemplatesEmail.ASSUNTO_PADRAO and self.templates.corpo == TemplatesEmail.CORPO_PADRAO else "o template anterior"
+            self.logger.error(f"Template rejeitado; os emails continuam saindo com {anterior}. Consulte VariaveisDisponiveis.md")
+
+    def encerrar(self):
+        """Libera recursos mantidos abertos entre ciclos"""
+        self.caixa_saida.parar()
+        self.contas_smtp.fechar_todas()
+        self.buffer_status.fechar()
+        if self.excel_logger:
+            self.excel_logger.fechar()
+        self.pool_banco.fechar_todas()
         
     def setup_logging(self):
-        """Configura sistema de logs"""
-        log_dir = 'logs'
-        os.makedirs(log_dir, exist_ok=True)
-        
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(f'{log_dir}/envio_emails.log', encoding='utf-8'),
-                logging.StreamHandler()
-            ]
-        )
+        """Configura sistema de logs (gravação em thread própria; nível e rotação vêm do banco)"""
         self.logger = logging.getLogger(__name__)
+        self.log_assincrono = None
+        if logging.getLogger().handlers:
+            return  # Logging já configurado por quem importou o módulo (ex.: benchmark_envio.py)
+        self.log_assincrono = LogAssincrono('logs')
+        self.log_assincrono.iniciar()
+
+    def configurar_log(self):
+        """Aplica SistemaNivelLog e a rotação do arquivo de log definidos em ConfiguracaoSistemaEmail"""
+        if not self.log_assincrono:
+            return
+        nivel = str(self.get_config('SISTEMA', 'nivel_log', fallback='INFO') or 'INFO').strip().upper()
+        if nivel not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+            self.logger.warning(f"SistemaNivelLog inválido ('{nivel}') - usando INFO")
+            nivel = 'INFO'
+        self.log_assincrono.configurar(
+            getattr(logging, nivel),
+            int(self.get_config('SISTEMA', 'log_tamanho_maximo_mb', fallback=20) or 20),
+            int(self.get_config('SISTEMA', 'log_arquivos_mantidos', fallback=10) or 10),
+        )
         
     def setup_excel_logging(self):
         """Configura sistema de logs em Excel"""
@@ -187,6 +344,7 @@ class SistemaEnvioEmails:
     def listar_drivers_odbc_disponiveis(self):
         """Lista todos os drivers ODBC instalados no sistema"""
         try:
+            import pyodbc
             drivers = pyodbc.drivers()
             self.logger.info(f"Drivers ODBC instalados no sistema: {len(drivers)}")
             for driver in drivers:
@@ -197,133 +355,234 @@ class SistemaEnvioEmails:
             return []
         
     def conectar_banco(self):
-        """Estabelece conexão com SQL Server com fallback automático de drivers"""
-        # Lista de drivers ODBC em ordem de preferência (mais recente para mais antigo)
-        drivers_disponiveis = [
-            self.sql_config['driver_preferencial'],  # Driver preferencial
-            'ODBC Driver 18 for SQL Server',
-            'ODBC Driver 17 for SQL Server',
-            'ODBC Driver 13.1 for SQL Server',
-            'ODBC Driver 13 for SQL Server',
-            'ODBC Driver 11 for SQL Server',
-            'SQL Server Native Client 11.0',
-            'SQL Server Native Client 10.0',
-            'SQL Server',
-        ]
-
-        # Remove duplicatas mantendo a ordem
-        drivers_unicos = []
-        for driver in drivers_disponiveis:
-            if driver not in drivers_unicos:
-                drivers_unicos.append(driver)
-
-        erros_tentativas = []
-        driver_preferencial = self.sql_config['driver_preferencial']
-
-        for driver in drivers_unicos:
-            try:
-                conn_str = (
-                    f"DRIVER={{{driver}}};"
-                    f"SERVER={self.sql_config['servidor']};"
-                    f"DATABASE={self.sql_config['banco_de_dados']};"
-                    f"UID={self.sql_config['usuario']};"
-                    f"PWD={self.sql_config['senha']};"
-                )
-                self.conexao_db = pyodbc.connect(conn_str)
-                self.logger.info(f"Conectado ao banco de dados com sucesso usando driver: {driver}")
-
-                # Se conectou com driver diferente do preferencial, avisar
-                if driver != driver_preferencial:
-                    self.logger.warning(f"Driver preferencial '{driver_preferencial}' não disponível. Usando '{driver}' como alternativa.")
-
-                return True
-
-            except Exception as e:
-                erros_tentativas.append(f"{driver}: {str(e)[:100]}")
-                # Continua tentando próximo driver
-
-        # Se chegou aqui, nenhum driver funcionou
-        self.logger.error("ERRO: Não foi possível conectar ao banco de dados com nenhum driver ODBC disponível")
-        self.logger.error("Drivers tentados:")
-        for erro in erros_tentativas:
-            self.logger.error(f"  - {erro}")
-        self.logger.error("SOLUÇÃO: Instale um driver ODBC para SQL Server:")
-        self.logger.error("  - Download: https://go.microsoft.com/fwlink/?linkid=2249004")
-
-        return False
+        """Obtém uma conexão do pool para a thread atual (driver ODBC resolvido uma vez por processo)"""
+        self.conexao_db = self.pool_banco.obter()
+        return self.conexao_db is not None
+
+    def desconectar_banco(self, descartar=False):
+        """Devolve a conexão da thread atual ao pool (ou a descarta após erro)"""
+        if self.conexao_db:
+            self.pool_banco.devolver(self.conexao_db, descartar)
+            self.conexao_db = None
             
-    def buscar_pedidos_para_processar(self):
-        """Busca todos os pedidos que precisam ser processados"""
-        query = """
+    # Linhas de ControleEmailPedidos que precisam de trabalho; repetida na reserva para que um pedido
+    # já reservado ou concluído por outra instância não seja reservado de novo
+    CONDICAO_CANDIDATO = """
+        (cep.StatusProcessamento = 'PENDENTE' AND cep.EmailEnviado = 0) OR
+        (cep.StatusProcessamento = 'ENVIADO' AND cep.EmailEnviado = 1
+            AND cep.VersaoPdfDisponivel > ISNULL(cep.VersaoPdfEnviada, 0)) OR
+        (cep.StatusProcessamento = 'ERRO_VALIDACAO' AND cep.EmailEnviado = 0) OR
+        (cep.StatusProcessamento = 'INVALIDO' AND cep.EmailEnviado = 0) OR
+        (cep.StatusProcessamento = 'ERRO' AND cep.EmailEnviado = 0
+            AND (cep.ProximaTentativa IS NULL OR cep.ProximaTentativa <= GETDATE())) OR
+        (cep.StatusProcessamento = 'PROCESSANDO'
+            AND (cep.ProcessandoAte IS NULL OR cep.ProcessandoAte < GETDATE()))
+    """
+
+    # Linhas de controle dos pedidos fechados, sem filtro de status (usada também pelo --teste)
+    CONSULTA_PEDIDOS_FECHADOS = """
         SELECT
             cep.Id, cep.NroPedido, cep.CodCliente, cep.DataPedidoFechado, cep.EmailsCopia,
             c.EMAIL as EmailCliente, c.NomeContato as NomeCliente,
             cep.VersaoPdfEnviada, cep.StatusProcessamento, cep.EmailEnviado,
             cep.TentativasEnvio, NULL as DataUltimaVerificacao, cep.UltimoErro,
-            cep.EnviarEmailCliente, rep.EmailRepresentante
+            cep.EnviarEmailCliente, rep.EmailRepresentante, cep.HashPdfEnviado,
+            cep.StatusAnterior, cep.ProcessandoPor
         FROM ControleEmailPedidos cep
         INNER JOIN CabecalhoPedido cap ON cap.NroPedido = cep.NroPedido
         INNER JOIN Cliente c ON c.CodCliente = cap.CodCliente
         LEFT JOIN Representante rep ON rep.CodRepresentante = cap.CodRepresentante
         WHERE cap.SituacaoAtual = 'F'
-            AND (
-                (cep.StatusProcessamento = 'PENDENTE' AND cep.EmailEnviado = 0) OR
-                (cep.StatusProcessamento = 'ENVIADO' AND cep.EmailEnviado = 1) OR
-                (cep.StatusProcessamento = 'ERRO_VALIDACAO' AND cep.EmailEnviado = 0) OR
-                (cep.StatusProcessamento = 'INVALIDO' AND cep.EmailEnviado = 0) OR
-                (cep.StatusProcessamento = 'ERRO' AND cep.EmailEnviado = 0)
-            )
-        ORDER BY cep.DataPedidoFechado
         """
-        
-        try:
-            cursor = self.conexao_db.cursor()
-            cursor.execute(query)
-            resultados = cursor.fetchall()
-            
-            pedidos_para_processar = []
-            
-            for row in resultados:
-                numero_pedido = row.NroPedido
-                versao_enviada = int(row.VersaoPdfEnviada) if row.VersaoPdfEnviada is not None else 0
-                status_atual = row.StatusProcessamento
+    # Consulta base dos pedidos candidatos (filtros adicionais são concatenados ao final)
+    CONSULTA_PEDIDOS = f"""{CONSULTA_PEDIDOS_FECHADOS}
+            AND ({CONDICAO_CANDIDATO})
+        """
 
-                caminho_pdf, versao_disponivel = self.buscar_pdf_pedido(numero_pedido)
+    # Reserva atômica de um lote: UPDLOCK/READPAST pulam linhas que outra instância está reservando
+    # e a condição de candidato descarta as que ela já reservou ou concluiu. OUTPUT devolve só as obtidas.
+    CONSULTA_RESERVA = f"""
+        UPDATE cep SET
+            StatusAnterior = CASE WHEN cep.StatusProcessamento = 'PROCESSANDO' THEN cep.StatusAnterior ELSE cep.StatusProcessamento END,
+            StatusProcessamento = 'PROCESSANDO',
+            ProcessandoPor = ?,
+            ProcessandoAte = DATEADD(MINUTE, ?, GETDATE())
+        OUTPUT inserted.Id
+        FROM ControleEmailPedidos cep WITH (UPDLOCK, READPAST, ROWLOCK)
+        WHERE cep.Id IN ({{ids}}) AND ({CONDICAO_CANDIDATO})
+        """
+    LIMITE_RESERVA = 1000  # Ids por instrução (o SQL Server aceita até 2100 parâmetros)
 
-                deve_processar = False
-                motivo = ""
+    def sincronizar_versoes_pdf(self):
+        """Grava em VersaoPdfDisponivel as novas versões de PDF detectadas na pasta
 
-                if not caminho_pdf:
-                    self.logger.warning(f"Pedido {numero_pedido}: PDF não encontrado, pulando...")
-                    continue
-                elif status_atual in ('PENDENTE', 'INVALIDO') and row.EmailEnviado == 0:
-                    deve_processar = True
-                    motivo = "PRIMEIRO_ENVIO"
-                elif status_atual == 'ENVIADO' and versao_disponivel > versao_enviada:
-                    deve_processar = True
-                    motivo = "REENVIO_VERSAO_ATUALIZADA"
-                elif status_atual == 'ERRO_VALIDACAO' and row.EmailEnviado == 0:
-                    deve_processar = True
-                    motivo = "REVALIDACAO_APOS_ERRO"
-                
-                if deve_processar:
-                    pedidos_para_processar.append({
-                        'id': row.Id, 'numero': numero_pedido, 'cod_cliente': row.CodCliente,
-                        'data_fechamento': row.DataPedidoFechado, 'emails_copia': row.EmailsCopia,
-                        'email_cliente': row.EmailCliente, 'nome_cliente': row.NomeCliente,
-                        'versao_pdf_enviada': versao_enviada, 'status_atual': status_atual,
-                        'versao_disponivel': versao_disponivel, 'motivo_processamento': motivo,
-                        'caminho_pdf': caminho_pdf, 'tentativas_anteriores': row.TentativasEnvio or 0,
-                        'ultimo_erro': row.UltimoErro, 'enviar_email_cliente': row.EnviarEmailCliente,
-                        'email_representante': row.EmailRepresentante
-                    })
-                    
+        Assim a consulta de candidatos só traz pedidos ENVIADO cujo PDF realmente
+        mudou, em vez de todo o histórico de enviados a cada ciclo.
+        """
+        self.indice_pdfs.garantir_carregado(self.get_config('PDFS', 'caminho'))
+        versoes = self.indice_pdfs.retirar_versoes_alteradas()
+        if not versoes:
+            return
+        try:
+            cursor = self.conexao_db.cursor()
+            BufferStatus.habilitar_fast_executemany(cursor)
+            cursor.executemany(
+                "UPDATE ControleEmailPedidos SET VersaoPdfDisponivel = ? "
+                "WHERE NroPedido = ? AND ISNULL(VersaoPdfDisponivel, 0) < ?",
+                [(versao, numero, versao) for versao, numero in versoes]
+            )
+            # O UPDATE não distingue "já atualizado" de "sem linha de controle": o PDF pode chegar antes
+            # do fechamento do pedido, e essa versão precisa ser gravada quando a linha existir
+            numeros = [numero for _, numero in versoes]
+            com_controle = set()
+            for inicio in range(0, len(numeros), self.LIMITE_RESERVA):
+                lote = numeros[inicio:inicio + self.LIMITE_RESERVA]
+                cursor.execute(f"SELECT NroPedido FROM ControleEmailPedidos WHERE NroPedido IN ({', '.join('?' * len(lote))})", lote)
+                com_controle.update(row.NroPedido for row in cursor.fetchall())
+            self.conexao_db.commit()
+        except Exception as e:
+            self.logger.error(f"Erro ao gravar versões de PDF disponíveis: {e}")
+            self.indice_pdfs.devolver_versoes_alteradas(versoes)
+            return
+        sem_controle = [(versao, numero) for versao, numero in versoes if numero not in com_controle]
+        if sem_controle:
+            self.indice_pdfs.devolver_versoes_alteradas(sem_controle)
+            self.logger.debug(f"{len(sem_controle)} versão(ões) de PDF sem linha de controle mantidas para o próximo ciclo")
+        if len(versoes) > len(sem_controle):
+            self.logger.info(f"Versões de PDF atualizadas no banco para {len(versoes) - len(sem_controle)} pedido(s)")
+
+    def buscar_pedidos_para_processar(self, somente_leitura=False):
+        """Busca todos os pedidos que precisam ser processados"""
+        try:
+            pedidos_para_processar = [pedido for pagina in self.paginas_pedidos_para_processar(somente_leitura=somente_leitura) for pedido in pagina]
             self.logger.info(f"Encontrados {len(pedidos_para_processar)} pedidos para processar")
             return pedidos_para_processar
-            
         except Exception as e:
             self.logger.error(f"Erro ao buscar pedidos para processar: {e}")
             return []
+
+    def paginas_pedidos_para_processar(self, filtro='', parametros=(), somente_leitura=False):
+        """Gera os pedidos candidatos em páginas (fetchmany); a próxima página é lida enquanto a atual é processada"""
+        tamanho_pagina = int(self.get_config('SISTEMA', 'tamanho_pagina_busca', fallback=200) or 200)
+        fila = queue.Queue(maxsize=2)  # No máximo duas páginas prontas em memória
+        cancelado = threading.Event()
+        fim = object()
+        erros = []
+
+        def entregar(item):
+            while not cancelado.is_set():
+                try:
+                    fila.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+
+        def produzir():
+            # Conexão própria: o result set fica aberto enquanto a thread do ciclo usa a sua
+            conexao = self.pool_banco.obter()
+            if conexao is None:
+                erros.append(RuntimeError("banco de dados indisponível"))
+                entregar(fim)
+                return
+            descartar = False
+            try:
+                cursor = conexao.cursor()
+                with METRICAS.medir('consulta_pedidos'):
+                    cursor.execute(self.CONSULTA_PEDIDOS + filtro + " ORDER BY cep.DataPedidoFechado", parametros)
+                while not cancelado.is_set():
+                    with METRICAS.medir('consulta_pedidos_pagina'):
+                        rows = cursor.fetchmany(tamanho_pagina)
+                    if not rows:
+                        break
+                    pagina = [pedido for pedido in (self._montar_pedido(row, somente_leitura) for row in rows) if pedido]
+                    if pagina:
+                        entregar(pagina)
+                cursor.close()
+            except Exception as e:
+                erros.append(e)
+                descartar = True
+            finally:
+                self.pool_banco.devolver(conexao, descartar)
+                entregar(fim)
+
+        threading.Thread(target=produzir, name='busca-pedidos', daemon=True).start()
+        try:
+            while True:
+                pagina = fila.get()
+                if pagina is fim:
+                    if erros:
+                        raise erros[0]
+                    return
+                yield pagina
+        finally:
+            cancelado.set()
+
+    def buscar_pedido_por_numero(self, numero_pedido):
+        """Busca apenas a linha de controle do pedido informado (caminho rápido para PDFs novos)"""
+        query = self.CONSULTA_PEDIDOS + " AND cep.NroPedido = ?"
+
+        try:
+            cursor = self.conexao_db.cursor()
+            cursor.execute(query, (numero_pedido,))
+            row = cursor.fetchone()
+            if not row:
+                self.logger.info(f"Pedido {numero_pedido}: sem registro pendente em ControleEmailPedidos")
+                return None
+            return self._montar_pedido(row)
+        except Exception as e:
+            self.logger.error(f"Erro ao buscar pedido {numero_pedido}: {e}")
+            return None
+
+    def _montar_pedido(self, row, somente_leitura=False):
+        """Decide se a linha de controle deve ser processada e monta o dicionário do pedido
+
+        Com somente_leitura (--teste), nada é anotado para gravação no banco.
+        """
+        numero_pedido = row.NroPedido
+        versao_enviada = int(row.VersaoPdfEnviada) if row.VersaoPdfEnviada is not None else 0
+        status_atual = row.StatusProcessamento
+        if status_atual == 'PROCESSANDO':
+            # Reserva vencida (instância que caiu ou linha antiga): decide pelo status de antes da reserva
+            status_atual = row.StatusAnterior or ('ENVIADO' if row.EmailEnviado == 1 else 'PENDENTE')
+            self.logger.warning(f"Pedido {numero_pedido}: reserva de '{row.ProcessandoPor or 'instância desconhecida'}' vencida - retomando como {status_atual}")
+
+        with METRICAS.medir('buscar_pdf'):
+            caminho_pdf, versao_disponivel = self.buscar_pdf_pedido(numero_pedido)
+
+        deve_processar = False
+        motivo = ""
+
+        if not caminho_pdf:
+            self.logger.warning(f"Pedido {numero_pedido}: PDF não encontrado, pulando...", extra=FiltroRepeticoes.POR_PEDIDO)
+        elif status_atual in ('PENDENTE', 'INVALIDO') and row.EmailEnviado == 0:
+            deve_processar = True
+            motivo = "PRIMEIRO_ENVIO"
+        elif status_atual == 'ENVIADO' and versao_disponivel > versao_enviada:
+            deve_processar = True
+            motivo = "REENVIO_VERSAO_ATUALIZADA"
+        elif status_atual == 'ERRO_VALIDACAO' and row.EmailEnviado == 0:
+            deve_processar = True
+            motivo = "REVALIDACAO_APOS_ERRO"
+        elif status_atual == 'ERRO' and row.EmailEnviado == 0:
+            # A consulta só traz pedidos em ERRO cujo cool-down (ProximaTentativa) já venceu
+            deve_processar = True
+            motivo = "RETENTATIVA_APOS_ERRO"
+
+        if not deve_processar:
+            if row.StatusProcessamento == 'PROCESSANDO' and not somente_leitura:
+                # Nada a fazer na reserva vencida: devolve o status que o pedido tinha
+                self.buffer_status.registrar('LIBERAR', row.Id, status_atual)
+            return None
+        return {
+            'id': row.Id, 'numero': numero_pedido, 'cod_cliente': row.CodCliente,
+            'data_fechamento': row.DataPedidoFechado, 'emails_copia': row.EmailsCopia,
+            'email_cliente': row.EmailCliente, 'nome_cliente': row.NomeCliente,
+            'versao_pdf_enviada': versao_enviada, 'status_atual': status_atual,
+            'versao_disponivel': versao_disponivel, 'motivo_processamento': motivo,
+            'caminho_pdf': caminho_pdf, 'tentativas_anteriores': row.TentativasEnvio or 0,
+            'ultimo_erro': row.UltimoErro, 'enviar_email_cliente': row.EnviarEmailCliente,
+            'email_representante': row.EmailRepresentante, 'hash_pdf_enviado': row.HashPdfEnviado
+        }
             
     def _calcular_cooldown(self, tentativas):
         """Calcula tempo de cool-down progressivo"""
@@ -341,39 +600,105 @@ class SistemaEnvioEmails:
             else: return 30
         
     def buscar_pdf_pedido(self, numero_pedido):
-        """Busca e identifica a versão mais recente do PDF"""
+        """Busca e identifica a versão mais recente do PDF (consulta o índice em memória)"""
         caminho_pdfs = self.get_config('PDFS', 'caminho')
-        padrao = f"PEDIDO {str(numero_pedido).zfill(7)}*.pdf"
-        arquivos = glob.glob(os.path.join(caminho_pdfs, padrao))
-        
-        if not arquivos:
-            self.logger.warning(f"Nenhum PDF encontrado para pedido {numero_pedido}")
+        self.indice_pdfs.garantir_carregado(caminho_pdfs)
+        arquivo_mais_recente, versao_maxima = self.indice_pdfs.buscar(numero_pedido)
+
+        if not arquivo_mais_recente:
+            self.logger.debug(f"Nenhum PDF encontrado para pedido {numero_pedido}")
             return None, 0
-            
-        versao_maxima = 1
-        arquivo_mais_recente = None
-        for arquivo in arquivos:
-            match = re.search(r'PEDIDO \d+(?:_(\d+))?\.pdf$', os.path.basename(arquivo))
-            if match:
-                versao = int(match.group(1)) if match.group(1) else 1
-                if versao >= versao_maxima:
-                    versao_maxima = versao
-                    arquivo_mais_recente = arquivo
         return arquivo_mais_recente, versao_maxima
-        
-    def atualizar_status_pedido(self, id_controle, campo, valor, erro=None):
-        """Atualiza status do pedido na tabela de controle"""
+
+    def atualizar_status_pedido(self, id_controle, status, erro=None):
+        """Registra a mudança de status do pedido no buffer de gravação em lote"""
+        if erro:
+            self.buffer_status.registrar('STATUS_ERRO', id_controle, status, str(erro)[:500])
+        else:
+            self.buffer_status.registrar('STATUS', id_controle, status)
+
+    def reservar_pedidos(self, pedidos):
+        """Marca os pedidos do lote como PROCESSANDO para esta instância e retorna só os que ela obteve"""
+        if not pedidos:
+            return []
+        minutos = int(self.get_config('SISTEMA', 'minutos_reserva', fallback=30) or 30)
+        reservados = set()
         try:
-            cursor = self.conexao_db.cursor()
-            if erro:
-                query = f"UPDATE ControleEmailPedidos SET {campo} = ?, UltimoErro = ?, TentativasEnvio = TentativasEnvio + 1 WHERE Id = ?"
-                cursor.execute(query, (valor, str(erro)[:500], id_controle))
-            else:
-                query = f"UPDATE ControleEmailPedidos SET {campo} = ? WHERE Id = ?"
-                cursor.execute(query, (valor, id_controle))
-            self.conexao_db.commit()
+            with METRICAS.medir('reservar_pedidos'):
+                cursor = self.conexao_db.cursor()
+                for inicio in range(0, len(pedidos), self.LIMITE_RESERVA):
+                    ids = [p['id'] for p in pedidos[inicio:inicio + self.LIMITE_RESERVA]]
+                    cursor.execute(self.CONSULTA_RESERVA.format(ids=', '.join('?' * len(ids))), (self.identificacao_instancia, minutos, *ids))
+                    reservados.update(row.Id for row in cursor.fetchall())
+                self.conexao_db.commit()
+        except Exception as e:
+            # Sem a reserva, processar arriscaria envio em duplicidade com outra instância
+            self.logger.error(f"Erro ao reservar {len(pedidos)} pedido(s) - ficam para o próximo ciclo: {e}")
+            try:
+                self.conexao_db.rollback()
+            except Exception:
+                pass
+            return []
+        if len(reservados) < len(pedidos):
+            METRICAS.contar('reserva_perdida', len(pedidos) - len(reservados))
+            self.logger.info(f"{len(pedidos) - len(reservados)} pedido(s) já reservado(s) ou concluído(s) por outra instância")
+        return [p for p in pedidos if p['id'] in reservados]
+
+    def renovar_reservas(self):
+        """Prorroga a validade de todas as reservas desta instância em uma única instrução"""
+        conexao = self.pool_banco.obter()
+        if conexao is None:
+            return False
+        try:
+            cursor = conexao.cursor()
+            cursor.execute(
+                "UPDATE ControleEmailPedidos SET ProcessandoAte = DATEADD(MINUTE, ?, GETDATE()) "
+                "WHERE StatusProcessamento = 'PROCESSANDO' AND ProcessandoPor = ?",
+                (int(self.get_config('SISTEMA', 'minutos_reserva', fallback=30) or 30), self.identificacao_instancia)
+            )
+            conexao.commit()
         except Exception as e:
-            self.logger.error(f"Erro ao atualizar status do pedido {id_controle}: {e}")
+            self.logger.error(f"Erro ao renovar reservas de pedidos: {e}")
+            self.pool_banco.devolver(conexao, descartar=True)
+            return False
+        self.pool_banco.devolver(conexao)
+        return True
+
+    def retomar_reservas(self):
+        """Na inicialização: libera as reservas que esta instância deixou ao cair, menos as da caixa de saída
+
+        Itens da caixa de saída cujo pedido deixou de estar reservado para esta instância
+        (reserva vencida e retomada por outra) são descartados em vez de enviados de novo.
+        """
+        if not self.buffer_status.descarregar():
+            return False
+        conexao = self.pool_banco.obter()
+        if conexao is None:
+            return False
+        try:
+            cursor = conexao.cursor()
+            cursor.execute(
+                "SELECT Id FROM ControleEmailPedidos WITH (UPDLOCK) WHERE StatusProcessamento = 'PROCESSANDO' AND ProcessandoPor = ?",
+                (self.identificacao_instancia,)
+            )
+            reservados = {row.Id for row in cursor.fetchall()}
+            na_caixa_saida = set(self.caixa_saida.indice)
+            self.caixa_saida.descartar(na_caixa_saida - reservados)
+            orfaos = reservados - na_caixa_saida
+            if orfaos:
+                # Reserva vencida na hora: a próxima busca retoma esses pedidos pelo StatusAnterior
+                BufferStatus.habilitar_fast_executemany(cursor)
+                cursor.executemany("UPDATE ControleEmailPedidos SET ProcessandoPor = NULL, ProcessandoAte = NULL WHERE Id = ?", [(i,) for i in orfaos])
+                self.logger.warning(f"{len(orfaos)} pedido(s) reservados antes do último encerramento voltam a ser candidatos")
+            conexao.commit()
+        except Exception as e:
+            self.logger.error(f"Erro ao retomar reservas de pedidos: {e}")
+            self.pool_banco.devolver(conexao, descartar=True)
+            return False
+        self.pool_banco.devolver(conexao)
+        self.renovar_reservas()
+        self.caixa_saida.liberar_entrega()
+        return True
             
     def _email_valido(self, email):
         """Verifica se um endereço de email é válido e não está vazio"""
@@ -381,8 +706,9 @@ class SistemaEnvioEmails:
             return False
         return bool(re.match(r'^[a-zA-Z0-9._%+\-]+@[a-zA-Z0-9.\-]+\.[a-zA-Z]{2,}$', str(email).strip()))
 
-    def enviar_email(self, destinatario, nome_cliente, numero_pedido, caminho_pdf, emails_copia=None, eh_reenvio=False, versao_pdf=1, enviar_para_cliente=True, data_pedido_fechado=None, email_representante=None, email_expositor=None):
-        """Envia email com PDF anexo usando templates do banco de dados"""
+    def montar_email(self, destinatario, nome_cliente, numero_pedido, caminho_pdf, emails_copia=None, eh_reenvio=False, versao_pdf=1, enviar_para_cliente=True, data_pedido_fechado=None, email_representante=None, email_expositor=None):
+        """Monta o email com PDF anexo usando templates do banco de dados; retorna (mensagem, destinatários, remetente) ou None"""
+        inicio_mime = time.perf_counter()
         try:
             # Determinar destinatários baseado em enviar_para_cliente
             destinatario_principal = None
@@ -411,11 +737,11 @@ class SistemaEnvioEmails:
                         else:
                             self.logger.info(f"Pedido {numero_pedido}: Cliente NÃO receberá email. Enviando apenas PARA ({destinatario_principal})")
                     else:
-                        self.logger.warning(f"Pedido {numero_pedido}: EnviarEmailCliente=0 e EmailsCopia vazio - Nenhum destinatário definido")
-                        return False
+                        self.logger.warning(f"Pedido {numero_pedido}: EnviarEmailCliente=0 e EmailsCopia vazio - Nenhum destinatário definido", extra=FiltroRepeticoes.POR_PEDIDO)
+                        return None
                 else:
-                    self.logger.warning(f"Pedido {numero_pedido}: EnviarEmailCliente=0 e EmailsCopia vazio - Nenhum destinatário definido")
-                    return False
+                    self.logger.warning(f"Pedido {numero_pedido}: EnviarEmailCliente=0 e EmailsCopia vazio - Nenhum destinatário definido", extra=FiltroRepeticoes.POR_PEDIDO)
+                    return None
 
             # Adicionar EmailExpositor ao CC se válido e não duplicado
             if self._email_valido(email_expositor):
@@ -431,31 +757,9 @@ class SistemaEnvioEmails:
                     lista_copia.append(str(email_representante).strip())
                     self.logger.info(f"Pedido {numero_pedido}: EmailRepresentante adicionado ao CC: {email_representante}")
 
-            # Obter templates do banco de dados ou usar padrões
-            assunto_template = self.config_db.get('email_assunto') if self.config_db else 'Pedido {NroPedido} - PDF Anexado'
-            corpo_template = self.config_db.get('email_corpo') if self.config_db else """Prezado(a) {RazaoSocial},
-
-Segue em anexo o PDF do seu pedido número {NroPedido}.
-
-{MensagemReenvio}
-
-Atenciosamente,
-Equipe SRPP"""
-
-            # Detectar tipo de conteúdo (HTML ou TEXTO) e processar corpo
-            tipo_conteudo = 'plain'  # Padrão é texto simples
-            linhas = corpo_template.split('\n')
-
-            if linhas and linhas[0].strip().upper() in ('#HTML', '#TEXTO'):
-                tipo_marcador = linhas[0].strip().upper()
-                # Remove a primeira linha (marcador) do template
-                corpo_template = '\n'.join(linhas[1:])
-
-                if tipo_marcador == '#HTML':
-                    tipo_conteudo = 'html'
-                    self.logger.debug(f"Pedido {numero_pedido}: Email será enviado como HTML")
-                else:
-                    self.logger.debug(f"Pedido {numero_pedido}: Email será enviado como TEXTO")
+            # Templates já validados e preparados quando a configuração foi carregada
+            templates = self.templates
+            tipo_conteudo = templates.tipo_conteudo
 
             # Obter variáveis de email antes de usar nos templates
             email_usuario = self.get_config('EMAIL', 'usuario')  # Usado para autenticação SMTP
@@ -474,42 +778,19 @@ Equipe SRPP"""
             else:
                 mensagem_reenvio = ""
 
-            # Substituir variáveis no assunto
-            assunto = assunto_template.format(
+            variaveis = dict(templates.variaveis_fixas)
+            variaveis.update(
                 NroPedido=numero_pedido,
                 RazaoSocial=nome_cliente,
                 NomeContato=nome_cliente,
                 DataPedidoFechado=data_formatada,
                 VersaoPdf=versao_pdf,
                 MensagemReenvio=mensagem_reenvio,
-                ResponderPara=email_reply_to if email_reply_to else '',
-                EmailReplyTo=email_reply_to if email_reply_to else '',
-                HeaderColor='#0a77d5',
                 EmailRepresentante=str(email_representante).strip() if self._email_valido(email_representante) else '',
                 EmailExpositor=str(email_expositor).strip() if self._email_valido(email_expositor) else '',
             )
-
-            # Substituir variáveis no corpo
-            try:
-                self.logger.debug(f"Pedido {numero_pedido}: Template do corpo: {repr(corpo_template[:100])}")
-                corpo = corpo_template.format(
-                    NroPedido=numero_pedido,
-                    RazaoSocial=nome_cliente,
-                    NomeContato=nome_cliente,
-                    DataPedidoFechado=data_formatada,
-                    VersaoPdf=versao_pdf,
-                    MensagemReenvio=mensagem_reenvio,
-                    ResponderPara=email_reply_to if email_reply_to else '',
-                    EmailReplyTo=email_reply_to if email_reply_to else '',
-                    HeaderColor='#0a77d5',
-                    EmailRepresentante=str(email_representante).strip() if self._email_valido(email_representante) else '',
-                    EmailExpositor=str(email_expositor).strip() if self._email_valido(email_expositor) else '',
-                )
-                self.logger.debug(f"Pedido {numero_pedido}: Corpo formatado com sucesso")
-            except KeyError as e:
-                self.logger.error(f"Pedido {numero_pedido}: Variável não encontrada no template: {e}")
-                self.logger.error(f"Pedido {numero_pedido}: Template que causou erro: {repr(corpo_template[:500])}")
-                raise
+            assunto = templates.renderizar_assunto(variaveis)
+            corpo = templates.renderizar_corpo(variaveis)
 
             # Montar email
             msg = MIMEMultipart()
@@ -536,32 +817,33 @@ Equipe SRPP"""
 
             msg.attach(MIMEText(corpo.strip(), tipo_conteudo, 'utf-8'))
 
-            # Anexar PDF
-            with open(caminho_pdf, 'rb') as attachment:
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(attachment.read())
-            encoders.encode_base64(part)
+            # Anexar PDF (base64 gerado uma vez por conteúdo e transmitido em blocos no DATA)
             nome_arquivo = f"Pedido_{numero_pedido}_v{versao_pdf}.pdf" if eh_reenvio else f"Pedido_{numero_pedido}.pdf"
-            part.add_header('Content-Disposition', f'attachment; filename= {nome_arquivo}')
-            msg.attach(part)
+            METRICAS.observar('montar_mime', time.perf_counter() - inicio_mime)
+            with METRICAS.medir('codificar_anexo'):
+                arquivo_codificado = self.cache_anexos.obter(caminho_pdf)
+            mensagem = MensagemEmail(msg, arquivo_codificado, nome_arquivo)
 
             # Enviar para todos os destinatários
             todos_destinatarios = [destinatario_principal] + lista_copia
+            return mensagem, todos_destinatarios, email_remetente or None
+        except Exception as e:
+            import traceback
+            self.logger.error(f"Pedido {numero_pedido}: ERRO INESPERADO ao montar email - {e}")
+            self.logger.error(f"Traceback completo:\n{traceback.format_exc()}")
+            return None
 
-            # Conectar ao servidor SMTP
-            smtp_servidor = self.get_config('EMAIL', 'smtp_servidor')
-            smtp_porta = int(self.get_config('EMAIL', 'smtp_porta', fallback=587))
-            self.logger.debug(f"Pedido {numero_pedido}: Conectando ao servidor SMTP {smtp_servidor}:{smtp_porta}")
-            server = smtplib.SMTP(smtp_servidor, smtp_porta)
-            server.starttls()
-            self.logger.debug(f"Pedido {numero_pedido}: Autenticando como {email_usuario}")
-            senha_app = self.get_config('EMAIL', 'senha_app')
-            server.login(email_usuario, senha_app)
-            self.logger.debug(f"Pedido {numero_pedido}: Enviando email FROM {email_from} para {len(todos_destinatarios)} destinatário(s)")
-            server.sendmail(email_from, todos_destinatarios, msg.as_string())
-            server.quit()
-
-            self.logger.info(f"{'REENVIO' if eh_reenvio else 'EMAIL'} enviado com sucesso - Pedido {numero_pedido} - Total de destinatários: {len(todos_destinatarios)}")
+    def enviar_email(self, numero_pedido, mensagem, destinatarios, remetente=None, eh_reenvio=False):
+        """Envia a mensagem montada; retorna True se o servidor SMTP a aceitou"""
+        try:
+            # Enviar pela conta SMTP menos carregada, numa sessão autenticada reaproveitada entre pedidos.
+            # Sem EmailRemetente, o FROM passa a ser o usuário da conta escolhida.
+            self.logger.debug(f"Pedido {numero_pedido}: Enviando email FROM {mensagem.remetente} para {len(destinatarios)} destinatário(s)")
+            with METRICAS.medir('smtp_envio'):
+                conta = self.contas_smtp.enviar(remetente, destinatarios, mensagem)
+            self.logger.debug(f"Pedido {numero_pedido}: Enviado pela conta SMTP {conta.usuario}")
+
+            self.logger.info(f"{'REENVIO' if eh_reenvio else 'EMAIL'} enviado com sucesso - Pedido {numero_pedido} - Total de destinatários: {len(destinatarios)}")
             return True
         except OSError as e:
             # Erros de rede (DNS, conexão, timeout)
@@ -587,17 +869,30 @@ Equipe SRPP"""
         """Processa um pedido individual"""
         id_controle, numero_pedido = pedido['id'], pedido['numero']
         self.logger.info(f"Processando pedido {numero_pedido}...")
-        self.atualizar_status_pedido(id_controle, 'StatusProcessamento', 'PROCESSANDO')
+        inicio = time.perf_counter()
+        METRICAS.iniciar_rastreio()
+        status, erro = 'ERRO', None
 
         try:
-            if not self.validacao_geral(pedido): return False
+            if not self.validacao_geral(pedido):
+                status = 'ERRO_VALIDACAO'
+                return False
 
             eh_reenvio = (pedido['motivo_processamento'] == "REENVIO_VERSAO_ATUALIZADA")
             enviar_para_cliente = pedido.get('enviar_email_cliente', 1) == 1  # Converte para boolean
             email_expositor = self.config_db.get('email_expositor') if self.config_db else None
             email_representante = pedido.get('email_representante')
 
-            if self.enviar_email(
+            # Reexportação com o mesmo conteúdo da versão já enviada: só avança a versão, sem novo email
+            with METRICAS.medir('hash_pdf'):
+                hash_pdf = self.cache_anexos.calcular_hash(pedido['caminho_pdf'])
+            if eh_reenvio and hash_pdf == (pedido.get('hash_pdf_enviado') or '').strip():
+                self.buffer_status.registrar('IDENTICO', id_controle, pedido['versao_disponivel'])
+                self.logger.info(f"Pedido {numero_pedido}: versão {pedido['versao_disponivel']} idêntica à já enviada - reenvio dispensado")
+                status = 'IDENTICO'
+                return True
+
+            montagem = self.montar_email(
                 pedido['email_cliente'],
                 pedido['nome_cliente'],
                 numero_pedido,
@@ -609,29 +904,78 @@ Equipe SRPP"""
                 pedido['data_fechamento'],
                 email_representante=email_representante,
                 email_expositor=email_expositor
-            ):
-                query = "UPDATE ControleEmailPedidos SET StatusProcessamento = 'ENVIADO', EmailEnviado = 1, VersaoPdfEnviada = ?, DataEnvio = GETDATE(), UltimoErro = NULL, TentativasEnvio = 0 WHERE Id = ?"
-                cursor = self.conexao_db.cursor()
-                cursor.execute(query, (pedido['versao_disponivel'], id_controle))
-                self.conexao_db.commit()
-                self.logger.info(f"SUCESSO ao processar pedido {numero_pedido}")
+            )
+            if montagem and self.caixa_saida.ativa:
+                # Entrega e gravação do ENVIADO ficam com os trabalhadores da caixa de saída
+                self.caixa_saida.depositar(pedido, *montagem, hash_pdf)
+                status = 'NA_FILA'
                 return True
-            else:
-                # Marca como ERRO e garante que EmailEnviado = 0 para retentar no próximo ciclo
-                query = "UPDATE ControleEmailPedidos SET StatusProcessamento = 'ERRO', EmailEnviado = 0, UltimoErro = ?, TentativasEnvio = TentativasEnvio + 1 WHERE Id = ?"
-                cursor = self.conexao_db.cursor()
-                cursor.execute(query, ('Erro no envio do email', id_controle))
-                self.conexao_db.commit()
-                self.logger.warning(f"ERRO ao processar pedido {numero_pedido} - Será retentado no próximo ciclo")
-                return False
+            if montagem and self.enviar_email(numero_pedido, *montagem, eh_reenvio):
+                self.concluir_envio(pedido, hash_pdf)
+                status = 'ENVIADO'
+                return True
+            erro = 'Erro no envio do email'
+            self.registrar_erro_envio(pedido, erro)
+            return False
         except Exception as e:
             self.logger.error(f"Erro ao processar pedido {numero_pedido}: {e}")
-            # Marca como ERRO e garante que EmailEnviado = 0 para retentar no próximo ciclo
-            query = "UPDATE ControleEmailPedidos SET StatusProcessamento = 'ERRO', EmailEnviado = 0, UltimoErro = ?, TentativasEnvio = TentativasEnvio + 1 WHERE Id = ?"
-            cursor = self.conexao_db.cursor()
-            cursor.execute(query, (str(e)[:500], id_controle))
-            self.conexao_db.commit()
+            erro = str(e)[:500]
+            self.registrar_erro_envio(pedido, erro)
             return False
+        finally:
+            self._registrar_metricas_pedido(pedido, status, erro, time.perf_counter() - inicio)
+
+    def concluir_envio(self, pedido, hash_pdf):
+        """Anota o envio aceito pelo SMTP para a gravação em lote em ControleEmailPedidos"""
+        self.buffer_status.registrar('ENVIADO', pedido['id'], pedido['versao_disponivel'], datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), hash_pdf)
+        self.logger.info(f"SUCESSO ao processar pedido {pedido['numero']}")
+
+    def _registrar_metricas_pedido(self, pedido, status, erro, duracao):
+        """Contabiliza o pedido nas métricas e registra as abas RESUMO e LOG_GERAL do Excel"""
+        fases = METRICAS.encerrar_rastreio()
+        METRICAS.observar('processar_pedido', duracao)
+        if status == 'NA_FILA':
+            METRICAS.contar('pedido_na_fila')  # O resultado final é registrado na entrega
+        else:
+            self.registrar_resultado_pedido(pedido, status, erro)
+        if self.excel_logger:
+            self.excel_logger.log_geral(
+                pedido=pedido['numero'],
+                cliente=pedido['nome_cliente'] or '',
+                fase=pedido['motivo_processamento'],
+                detalhes=', '.join(f"{fase}={segundos * 1000:.1f}ms" for fase, segundos in fases.items()),
+                validacoes='FALHOU' if status == 'ERRO_VALIDACAO' else 'OK',
+                erro=erro or '',
+                duracao=f"{duracao:.3f}s",
+                thread=threading.current_thread().name,
+            )
+
+    def registrar_resultado_pedido(self, pedido, status, erro=None):
+        """Contabiliza o resultado final do pedido e registra a aba RESUMO do Excel"""
+        METRICAS.contar(f"pedido_{status.lower()}")
+        if not self.excel_logger:
+            return
+        enviar_para_cliente = pedido.get('enviar_email_cliente', 1) == 1
+        self.excel_logger.log_resumo(
+            pedido=pedido['numero'],
+            cliente=pedido['nome_cliente'] or '',
+            email=(pedido['email_cliente'] if enviar_para_cliente else pedido['emails_copia']) or '',
+            status=status,
+            motivo=pedido['motivo_processamento'],
+            tentativas=pedido['tentativas_anteriores'] + 1,
+            versao_pdf=pedido['versao_disponivel'],
+            observacoes=erro or '',
+        )
+
+    def registrar_erro_envio(self, pedido, erro):
+        """Marca o pedido como ERRO e agenda a próxima tentativa conforme o cool-down progressivo"""
+        tentativas = pedido['tentativas_anteriores'] + 1
+        cooldown = self._calcular_cooldown(tentativas)
+        proxima_tentativa = datetime.now().replace(microsecond=0) + timedelta(minutes=cooldown)
+        # Marca como ERRO e garante que EmailEnviado = 0 para retentar após o cool-down
+        self.buffer_status.registrar('ERRO', pedido['id'], erro, proxima_tentativa.strftime('%Y-%m-%dT%H:%M:%S'))
+        self.agendador_tentativas.agendar(pedido['numero'], proxima_tentativa)
+        self.logger.warning(f"ERRO ao processar pedido {pedido['numero']} (tentativa {tentativas}) - Nova tentativa em {cooldown} min ({proxima_tentativa.strftime('%H:%M')})")
 
     def validacao_geral(self, pedido):
         """Agrupa todas as validações de um pedido"""
@@ -640,32 +984,149 @@ Equipe SRPP"""
 
         # Se deve enviar para cliente, valida se tem email do cliente
         if enviar_para_cliente and not pedido['email_cliente']:
-            self.logger.warning(f"Pedido {numero_pedido}: EnviarEmailCliente=1 mas cliente sem email cadastrado.")
-            self.atualizar_status_pedido(pedido['id'], 'StatusProcessamento', 'ERRO_VALIDACAO', 'Cliente sem email')
+            self.logger.warning(f"Pedido {numero_pedido}: EnviarEmailCliente=1 mas cliente sem email cadastrado.", extra=FiltroRepeticoes.POR_PEDIDO)
+            self.atualizar_status_pedido(pedido['id'], 'ERRO_VALIDACAO', 'Cliente sem email')
             return False
 
         # Se NÃO deve enviar para cliente, valida se tem emails de cópia
         if not enviar_para_cliente and not pedido['emails_copia']:
-            self.logger.warning(f"Pedido {numero_pedido}: EnviarEmailCliente=0 mas não há EmailsCopia definidos.")
-            self.atualizar_status_pedido(pedido['id'], 'StatusProcessamento', 'ERRO_VALIDACAO', 'EnviarEmailCliente=0 sem EmailsCopia')
+            self.logger.warning(f"Pedido {numero_pedido}: EnviarEmailCliente=0 mas não há EmailsCopia definidos.", extra=FiltroRepeticoes.POR_PEDIDO)
+            self.atualizar_status_pedido(pedido['id'], 'ERRO_VALIDACAO', 'EnviarEmailCliente=0 sem EmailsCopia')
             return False
 
         return True
 
-    def executar_ciclo(self):
-        """Executa um ciclo completo de processamento"""
-        self.logger.info("=== Iniciando ciclo de processamento ===")
-        # Recarrega configurações a cada ciclo para refletir mudanças imediatamente
-        self.carregar_configuracoes_banco()
+    def executar_ciclo(self, numeros_pedidos=None):
+        """Executa um ciclo de processamento (completo ou apenas dos pedidos informados)"""
+        with self.lock_ciclo:
+            self._executar_ciclo(numeros_pedidos)
+
+    # Pedidos que passam a SituacaoAtual = 'F' alteram só CabecalhoPedido, sem mudar o rowversion de
+    # ControleEmailPedidos: a cada N verificações incrementais a verificação periódica varre tudo
+    VERIFICACOES_POR_VARREDURA_COMPLETA = 4
+
+    def executar_verificacao_periodica(self):
+        """Verificação periódica incremental (linhas alteradas desde a última marca d'água e PDFs sem evento)"""
+        with self.lock_ciclo:
+            incremental = self.marca_dagua is not None and self.verificacoes_incrementais < self.VERIFICACOES_POR_VARREDURA_COMPLETA
+            self.verificacoes_incrementais = self.verificacoes_incrementais + 1 if incremental else 0
+            self._executar_ciclo(None, incremental=incremental, periodica=True)
+
+    # Linhas alteradas desde a marca d'água e as que ficam elegíveis só com o passar do tempo
+    # (reserva vencida de instância que caiu, nova tentativa que venceu), sem mudar o rowversion
+    FILTRO_INCREMENTAL = """
+            AND ((cep.VersaoLinha >= ? AND cep.VersaoLinha < ?)
+                OR (cep.StatusProcessamento = 'PROCESSANDO' AND cep.ProcessandoAte < GETDATE())
+                OR (cep.StatusProcessamento = 'ERRO' AND cep.ProximaTentativa <= GETDATE()))"""
+
+    def _ler_marca_dagua(self):
+        """Menor rowversion ainda não confirmada: tudo abaixo dela já está gravado"""
+        cursor = self.conexao_db.cursor()
+        cursor.execute("SELECT MIN_ACTIVE_ROWVERSION()")
+        return bytes(cursor.fetchone()[0])
+
+    def _executar_ciclo(self, numeros_pedidos, incremental=False, periodica=False):
+        """Corpo do ciclo (executado sob lock_ciclo)"""
+        if numeros_pedidos:
+            self.logger.info(f"=== Iniciando ciclo direcionado: {len(numeros_pedidos)} pedido(s) ===")
+        elif incremental:
+            self.logger.info("=== Iniciando verificação periódica incremental ===")
+        elif periodica:
+            self.logger.info("=== Iniciando verificação periódica completa ===")
+        else:
+            self.logger.info("=== Iniciando ciclo de processamento ===")
+        inicio = time.perf_counter()
         if not self.conectar_banco(): return
+        # Confere o carimbo de versão e só recarrega as configurações se mudaram no banco
+        with METRICAS.medir('verificar_configuracao'):
+            configurado = self.atualizar_configuracoes()
+        if not configurado:
+            self.desconectar_banco()
+            return
         
         try:
-            pedidos = self.buscar_pedidos_para_processar()
-            for pedido in pedidos:
-                self.processar_pedido(pedido)
+            alterados_na_pasta = set()
+            if periodica:
+                # Uma leitura da pasta por intervalo cobre eventos do watchdog que se perderam
+                with METRICAS.medir('indice_pdfs'):
+                    alterados_na_pasta = self.indice_pdfs.reconstruir(self.get_config('PDFS', 'caminho')) or set()
+            with METRICAS.medir('sincronizar_versoes'):
+                self.sincronizar_versoes_pdf()
+            if numeros_pedidos:
+                pedidos = [p for p in (self.buscar_pedido_por_numero(n) for n in sorted(numeros_pedidos)) if p]
+                self.processar_pedidos(pedidos)
+                return
+
+            nova_marca = self._ler_marca_dagua()
+            if incremental:
+                filtro = self.FILTRO_INCREMENTAL
+                parametros = (self.marca_dagua, nova_marca)
+            else:
+                filtro, parametros = '', ()
+            processados = set()
+            try:
+                for pagina in self.paginas_pedidos_para_processar(filtro, parametros):
+                    self.logger.info(f"Página com {len(pagina)} pedido(s) para processar")
+                    processados.update(pedido['numero'] for pedido in pagina)
+                    self.processar_pedidos(pagina)
+            except Exception as e:
+                # Marca d'água não avança: a próxima verificação repete o intervalo
+                self.logger.error(f"Erro ao buscar pedidos para processar: {e}")
+                return
+
+            restantes = alterados_na_pasta - processados
+            if restantes:
+                self.logger.info(f"{len(restantes)} pedido(s) com PDF novo sem evento recebido")
+                pedidos = [p for p in (self.buscar_pedido_por_numero(n) for n in sorted(restantes)) if p]
+                self.processar_pedidos(pedidos)
+            self.marca_dagua = nova_marca
         finally:
-            if self.conexao_db: self.conexao_db.close()
-        self.logger.info("=== Ciclo de processamento concluído ===")
+            self.desconectar_banco()
+            METRICAS.observar('ciclo_direcionado' if numeros_pedidos else 'ciclo', time.perf_counter() - inicio)
+            self.logger.info("=== Ciclo de processamento concluído ===")
+
+    def processar_pedidos(self, pedidos):
+        """Processa a lista de pedidos sequencialmente ou com trabalhadores em paralelo"""
+        pedidos = self.reservar_pedidos(pedidos)
+        trabalhadores = int(self.get_config('SISTEMA', 'trabalhadores_envio', fallback=1) or 1)
+        try:
+            if trabalhadores > 1 and len(pedidos) > 1:
+                self.processar_pedidos_paralelo(pedidos, trabalhadores)
+            else:
+                for pedido in pedidos:
+                    self.processar_pedido(pedido)
+        finally:
+            self.buffer_status.descarregar()
+
+    def processar_pedidos_paralelo(self, pedidos, trabalhadores):
+        """Distribui os pedidos entre trabalhadores, cada um com sua conexão de banco e sessão SMTP"""
+        fila = queue.Queue()
+        for pedido in pedidos:
+            fila.put(pedido)
+        trabalhadores = min(trabalhadores, len(pedidos))
+        self.logger.info(f"Processando {len(pedidos)} pedidos com {trabalhadores} trabalhadores em paralelo")
+        with ThreadPoolExecutor(max_workers=trabalhadores, thread_name_prefix='envio') as executor:
+            for _ in range(trabalhadores):
+                executor.submit(self._trabalhador_envio, fila)
+        if not fila.empty():
+            self.logger.warning(f"{fila.qsize()} pedido(s) não processados neste ciclo (falha de conexão dos trabalhadores)")
+
+    def _trabalhador_envio(self, fila):
+        """Consome pedidos da fila usando uma conexão de banco própria da thread"""
+        if not self.conectar_banco():
+            return
+        try:
+            while True:
+                try:
+                    pedido = fila.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self.processar_pedido(pedido)
+                except Exception as e:
+                    self.logger.error(f"Erro inesperado no trabalhador ao processar pedido {pedido['numero']}: {e}")
+        finally:
+            self.desconectar_banco()
 
     def testar_deteccao_versoes(self):
         """Função de teste para verificar detecção de versões de PDF sem enviar emails"""
@@ -679,111 +1140,2148 @@ Equipe SRPP"""
             self.logger.error("Erro ao conectar ao banco para teste")
             return
         try:
-            pedidos = self.buscar_pedidos_para_processar()
+            # Somente leitura: sem liberar reservas vencidas nem gravar VersaoPdfDisponivel
+            pedidos = self.buscar_pedidos_para_processar(somente_leitura=True)
+            ids = {pedido['id'] for pedido in pedidos}
+            pedidos += [pedido for pedido in self.buscar_reenvios_pela_pasta() if pedido['id'] not in ids]
             for pedido in pedidos:
                 self.logger.info(f"Pedido {pedido['numero']}: Motivo: {pedido['motivo_processamento']}")
         finally:
-            if self.conexao_db: self.conexao_db.close()
+            self.desconectar_banco()
+
+    def buscar_reenvios_pela_pasta(self):
+        """Pedidos ENVIADO com versão de PDF na pasta maior que a enviada, ainda não gravada em VersaoPdfDisponivel"""
+        self.indice_pdfs.garantir_carregado(self.get_config('PDFS', 'caminho'))
+        with self.indice_pdfs.lock:
+            numeros = sorted(numero for numero, versoes in self.indice_pdfs.pedidos.items() if versoes and max(versoes) > 1)
+        pedidos = []
+        try:
+            cursor = self.conexao_db.cursor()
+            for inicio in range(0, len(numeros), self.LIMITE_RESERVA):
+                lote = numeros[inicio:inicio + self.LIMITE_RESERVA]
+                cursor.execute(
+                    self.CONSULTA_PEDIDOS_FECHADOS + " AND cep.StatusProcessamento = 'ENVIADO' AND cep.EmailEnviado = 1"
+                    f" AND cep.NroPedido IN ({', '.join('?' * len(lote))})", lote)
+                pedidos += [pedido for pedido in (self._montar_pedido(row, somente_leitura=True) for row in cursor.fetchall()) if pedido]
+        except Exception as e:
+            self.logger.error(f"Erro ao buscar pedidos com nova versão de PDF: {e}")
+        return pedidos
+
+class PoolConexoesBanco:
+    """Pool de conexões pyodbc reutilizáveis, com o driver ODBC resolvido uma única vez por processo"""
+    # Drivers ODBC em ordem de preferência (mais recente para mais antigo)
+    DRIVERS_CONHECIDOS = [
+        'ODBC Driver 18 for SQL Server',
+        'ODBC Driver 17 for SQL Server',
+        'ODBC Driver 13.1 for SQL Server',
+        'ODBC Driver 13 for SQL Server',
+        'ODBC Driver 11 for SQL Server',
+        'SQL Server Native Client 11.0',
+        'SQL Server Native Client 10.0',
+        'SQL Server',
+    ]
+    TAMANHO_MAXIMO = 8
+    VERIFICAR_APOS_SEGUNDOS = 30
+
+    def __init__(self, sql_config, logger, arquivo_driver=os.path.join('dados', 'driver_odbc.txt'), gravar_driver=True):
+        self.sql_config = sql_config
+        self.logger = logger
+        self.arquivo_driver = arquivo_driver
+        self.gravar_driver = gravar_driver
+        self.driver = self._ler_driver_gravado()  # Driver que funcionou (None = precisa testar novamente)
+        self.ociosas = []  # (conexão, último uso)
+        self.lock = threading.Lock()
+
+    def _string_conexao(self, driver):
+        return (
+            f"DRIVER={{{driver}}};"
+            f"SERVER={self.sql_config['servidor']};"
+            f"DATABASE={self.sql_config['banco_de_dados']};"
+            f"UID={self.sql_config['usuario']};"
+            f"PWD={self.sql_config['senha']};"
+        )
+
+    def _ler_driver_gravado(self):
+        """Driver que conectou na execução anterior, para a primeira conexão não percorrer a lista"""
+        try:
+            with open(self.arquivo_driver, 'r', encoding='utf-8') as arquivo:
+                return arquivo.read().strip() or None
+        except OSError:
+            return None
+
+    def _gravar_driver(self, driver):
+        if not self.gravar_driver:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.arquivo_driver) or '.', exist_ok=True)
+            with open(self.arquivo_driver, 'w', encoding='utf-8') as arquivo:
+                arquivo.write(driver)
+        except OSError as e:
+            self.logger.debug(f"Não foi possível gravar o driver ODBC em '{self.arquivo_driver}': {e}")
+
+    def _drivers_candidatos(self):
+        """Driver preferencial seguido dos conhecidos, priorizando os instalados na máquina"""
+        candidatos = []
+        for driver in [self.sql_config['driver_preferencial']] + self.DRIVERS_CONHECIDOS:
+            if driver not in candidatos:
+                candidatos.append(driver)
+        try:
+            import pyodbc
+            instalados = set(pyodbc.drivers())
+        except Exception:
+            instalados = set()
+        return [d for d in candidatos if d in instalados] or candidatos
+
+    def _resolver_driver(self):
+        """Testa os drivers em ordem de preferência e memoriza o primeiro que conectar"""
+        import pyodbc
+        erros_tentativas = []
+        driver_preferencial = self.sql_config['driver_preferencial']
+
+        for driver in self._drivers_candidatos():
+            try:
+                conexao = pyodbc.connect(self._string_conexao(driver))
+            except Exception as e:
+                erros_tentativas.append(f"{driver}: {str(e)[:100]}")
+                continue
+
+            self.driver = driver
+            self._gravar_driver(driver)
+            self.logger.info(f"Conectado ao banco de dados com sucesso usando driver: {driver}")
+            # Se conectou com driver diferente do preferencial, avisar
+            if driver != driver_preferencial:
+                self.logger.warning(f"Driver preferencial '{driver_preferencial}' não disponível. Usando '{driver}' como alternativa.")
+            return conexao
+
+        # Se chegou aqui, nenhum driver funcionou
+        self.logger.error("ERRO: Não foi possível conectar ao banco de dados com nenhum driver ODBC disponível")
+        self.logger.error("Drivers tentados:")
+        for erro in erros_tentativas:
+            self.logger.error(f"  - {erro}")
+        self.logger.error("SOLUÇÃO: Instale um driver ODBC para SQL Server:")
+        self.logger.error("  - Download: https://go.microsoft.com/fwlink/?linkid=2249004")
+        return None
+
+    def _conectar(self):
+        """Abre nova conexão com o driver memorizado (ou gravado na execução anterior); testa os demais só após uma falha"""
+        import pyodbc
+        driver = self.driver
+        if driver:
+            try:
+                return pyodbc.connect(self._string_conexao(driver))
+            except Exception as e:
+                self.logger.warning(f"Falha ao conectar com o driver '{driver}': {str(e)[:100]} - testando drivers novamente")
+                self.driver = None
+        return self._resolver_driver()
+
+    @staticmethod
+    def _conexao_saudavel(conexao):
+        try:
+            cursor = conexao.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _fechar(conexao):
+        try:
+            conexao.close()
+        except Exception:
+            pass
+
+    def obter(self):
+        """Retorna uma conexão ociosa válida ou abre uma nova (None se o banco estiver inacessível)"""
+        while True:
+            with self.lock:
+                item = self.ociosas.pop() if self.ociosas else None
+            if item is None:
+                return self._conectar()
+            conexao, ultimo_uso = item
+            if time.monotonic() - ultimo_uso < self.VERIFICAR_APOS_SEGUNDOS or self._conexao_saudavel(conexao):
+                return conexao
+            self._fechar(conexao)
+
+    def devolver(self, conexao, descartar=False):
+        """Devolve a conexão ao pool descartando transações pendentes"""
+        if not descartar:
+            try:
+                conexao.rollback()
+            except Exception:
+                descartar = True
+        if not descartar:
+            with self.lock:
+                if len(self.ociosas) < self.TAMANHO_MAXIMO:
+                    self.ociosas.append((conexao, time.monotonic()))
+                    return
+        self._fechar(conexao)
+
+    def fechar_todas(self):
+        """Fecha todas as conexões ociosas"""
+        with self.lock:
+            ociosas, self.ociosas = self.ociosas, []
+        for conexao, _ in ociosas:
+            self._fechar(conexao)
+
+class BufferStatus:
+    """Buffer de gravação em lote das mudanças de status em ControleEmailPedidos
+
+    Cada transição é anotada antes em um diário local (com fsync), para que um
+    email já enviado nunca volte a constar como não enviado se o processo cair
+    antes da gravação no banco. O diário é reaplicado na próxima descarga.
+
+    A descarga acontece ao acumular LIMITE_REGISTROS transições ou, pela thread
+    própria, LIMITE_SEGUNDOS depois da anterior. O diário só cresce: uma descarga
+    acrescenta uma linha marcando até onde já está no banco, e o arquivo é
+    esvaziado quando nada mais fica pendente (ou compactado ao passar de
+    LIMITE_LINHAS_DIARIO).
+    """
+    CONSULTAS = {
+        'ENVIADO': "UPDATE ControleEmailPedidos SET StatusProcessamento = 'ENVIADO', EmailEnviado = 1, VersaoPdfEnviada = ?, DataEnvio = ?, HashPdfEnviado = ?, UltimoErro = NULL, TentativasEnvio = 0, ProximaTentativa = NULL, ProcessandoPor = NULL, ProcessandoAte = NULL WHERE Id = ?",
+        'IDENTICO': "UPDATE ControleEmailPedidos SET StatusProcessamento = 'ENVIADO', EmailEnviado = 1, VersaoPdfEnviada = ?, UltimoErro = NULL, TentativasEnvio = 0, ProximaTentativa = NULL, ProcessandoPor = NULL, ProcessandoAte = NULL WHERE Id = ?",
+        'ERRO': "UPDATE ControleEmailPedidos SET StatusProcessamento = 'ERRO', EmailEnviado = 0, UltimoErro = ?, ProximaTentativa = ?, TentativasEnvio = TentativasEnvio + 1, ProcessandoPor = NULL, ProcessandoAte = NULL WHERE Id = ?",
+        'STATUS': "UPDATE ControleEmailPedidos SET StatusProcessamento = ?, ProcessandoPor = NULL, ProcessandoAte = NULL WHERE Id = ?",
+        'STATUS_ERRO': "UPDATE ControleEmailPedidos SET StatusProcessamento = ?, UltimoErro = ?, TentativasEnvio = TentativasEnvio + 1, ProcessandoPor = NULL, ProcessandoAte = NULL WHERE Id = ?",
+        # Só devolve o status se a reserva continua vencida (outra instância pode tê-la retomado)
+        'LIBERAR': "UPDATE ControleEmailPedidos SET StatusProcessamento = ?, ProcessandoPor = NULL, ProcessandoAte = NULL WHERE Id = ? AND StatusProcessamento = 'PROCESSANDO' AND (ProcessandoAte IS NULL OR ProcessandoAte < GETDATE())",
+    }
+    LIMITE_REGISTROS = 50
+    LIMITE_SEGUNDOS = 5
+    LIMITE_LINHAS_DIARIO = 5000
+
+    def __init__(self, pool_banco, logger, arquivo_diario=os.path.join('dados', 'status_pendentes.jsonl')):
+        self.pool_banco = pool_banco
+        self.logger = logger
+        self.arquivo_diario = arquivo_diario
+        self.pendentes = {}  # Id -> (tipo, parâmetros); a última transição de cada pedido prevalece
+        self.linhas_pendentes = {}  # Id -> linha do diário da transição pendente
+        self.linhas_diario = 0
+        self.ultima_descarga = time.monotonic()
+        self.lock = threading.Lock()
+        self.lock_descarga = threading.Lock()
+        self.parado = threading.Event()
+        self.thread = None  # O diário só é recuperado em iniciar() (o --teste não grava nada)
+
+    def iniciar(self):
+        """Recupera o diário da execução anterior e inicia a descarga periódica"""
+        with self.lock:
+            if self.thread:
+                return
+            os.makedirs(os.path.dirname(self.arquivo_diario), exist_ok=True)
+            self._recuperar_diario()
+            self.thread = threading.Thread(target=self._executar, name='status-lote', daemon=True)
+            self.thread.start()
+
+    @staticmethod
+    def habilitar_fast_executemany(cursor):
+        """Ativa o envio de parâmetros em bloco quando o driver suporta"""
+        try:
+            cursor.fast_executemany = True
+        except Exception:
+            pass
+
+    def _recuperar_diario(self):
+        """Recarrega transições que não chegaram ao banco antes do último encerramento"""
+        if not os.path.exists(self.arquivo_diario):
+            return
+        try:
+            with open(self.arquivo_diario, 'r', encoding='utf-8') as arquivo:
+                for linha in arquivo:
+                    if not linha.strip():
+                        continue
+                    registro = json.loads(linha)
+                    if 'gravado_ate' in registro:
+                        # Transições anteriores à marca já estão no banco
+                        for id_controle in [i for i, n in self.linhas_pendentes.items() if n < registro['gravado_ate']]:
+                            del self.pendentes[id_controle], self.linhas_pendentes[id_controle]
+                    else:
+                        if registro['tipo'] == 'ENVIADO' and len(registro['parametros']) == 2:
+                            registro['parametros'].append(None)  # Diário anterior ao HashPdfEnviado
+                        self.pendentes[registro['id']] = (registro['tipo'], registro['parametros'])
+                        self.linhas_pendentes[registro['id']] = self.linhas_diario
+                    self.linhas_diario += 1
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Erro ao ler diário de status pendentes: {e}")
+        try:
+            self._reescrever_diario()  # Descarta marcas e uma eventual linha incompleta da queda
+        except OSError as e:
+            self.logger.error(f"Erro ao atualizar diário de status pendentes: {e}")
+        if self.pendentes:
+            self.logger.warning(f"{len(self.pendentes)} mudança(s) de status pendentes recuperadas do diário local")
+
+    def _anotar(self, registro):
+        """Acrescenta uma linha ao diário com fsync (chamado com lock)"""
+        with open(self.arquivo_diario, 'a', encoding='utf-8') as arquivo:
+            arquivo.write(json.dumps(registro) + '\n')
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        self.linhas_diario += 1
+
+    def _reescrever_diario(self):
+        """Regrava o diário apenas com o que ainda não foi gravado no banco (chamado com lock)"""
+        self.linhas_pendentes = {}
+        with open(self.arquivo_diario, 'w', encoding='utf-8') as arquivo:
+            for linha, (id_controle, (tipo, parametros)) in enumerate(self.pendentes.items()):
+                arquivo.write(json.dumps({'id': id_controle, 'tipo': tipo, 'parametros': parametros}) + '\n')
+                self.linhas_pendentes[id_controle] = linha
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        self.linhas_diario = len(self.pendentes)
+
+    def registrar(self, tipo, id_controle, *parametros):
+        """Anota a transição no diário e no buffer; descarrega se atingiu o limite"""
+        if not self.thread:
+            self.iniciar()  # Anotar antes de recuperar o diário desalinharia as marcas gravado_ate
+        with self.lock, METRICAS.medir('diario_status'):
+            self.pendentes[id_controle] = (tipo, list(parametros))
+            self.linhas_pendentes[id_controle] = self.linhas_diario
+            self._anotar({'id': id_controle, 'tipo': tipo, 'parametros': list(parametros)})
+            cheio = len(self.pendentes) >= self.LIMITE_REGISTROS
+            vencido = time.monotonic() - self.ultima_descarga >= self.LIMITE_SEGUNDOS
+        if cheio or vencido:
+            self.descarregar()
+
+    def descarregar(self):
+        """Grava todas as transições pendentes em uma única transação"""
+        with self.lock_descarga:
+            with self.lock:
+                lote = dict(self.pendentes)
+                linhas_lote = self.linhas_diario
+                self.ultima_descarga = time.monotonic()
+            if not lote:
+                return True
+
+            por_tipo = {}
+            for id_controle, (tipo, parametros) in lote.items():
+                por_tipo.setdefault(tipo, []).append(tuple(parametros) + (id_controle,))
+
+            conexao = self.pool_banco.obter()
+            if conexao is None:
+                self.logger.error(f"Banco indisponível - {len(lote)} mudança(s) de status mantidas no diário local")
+                return False
+            try:
+                with METRICAS.medir('gravar_status'):
+                    cursor = conexao.cursor()
+                    self.habilitar_fast_executemany(cursor)
+                    for tipo, linhas in por_tipo.items():
+                        cursor.executemany(self.CONSULTAS[tipo], linhas)
+                    conexao.commit()
+            except Exception as e:
+                self.logger.error(f"Erro ao gravar {len(lote)} mudança(s) de status - mantidas para nova tentativa: {e}")
+                self.pool_banco.devolver(conexao, descartar=True)
+                return False
+            self.pool_banco.devolver(conexao)
+
+            with self.lock:
+                # Remove só o que foi gravado; transições mais novas do mesmo pedido continuam pendentes
+                for id_controle in lote:
+                    if self.linhas_pendentes.get(id_controle, linhas_lote) < linhas_lote:
+                        del self.pendentes[id_controle], self.linhas_pendentes[id_controle]
+                try:
+                    if not self.pendentes or self.linhas_diario >= self.LIMITE_LINHAS_DIARIO:
+                        self._reescrever_diario()
+                    else:
+                        self._anotar({'gravado_ate': linhas_lote})
+                except OSError as e:
+                    self.logger.error(f"Erro ao atualizar diário de status pendentes: {e}")
+            self.logger.debug(f"{len(lote)} mudança(s) de status gravadas em lote")
+            return True
+
+    def _executar(self):
+        """Descarrega o que ficou pendente por LIMITE_SEGUNDOS sem que novas transições disparassem a gravação"""
+        while not self.parado.wait(self.LIMITE_SEGUNDOS):
+            with self.lock:
+                vencido = self.pendentes and time.monotonic() - self.ultima_descarga >= self.LIMITE_SEGUNDOS
+            if vencido:
+                try:
+                    self.descarregar()
+                except Exception as e:
+                    self.logger.error(f"Erro ao gravar mudanças de status pendentes: {e}")
+
+    def fechar(self):
+        """Encerra a thread de descarga e grava o que estiver pendente"""
+        self.parado.set()
+        if self.thread:
+            self.thread.join(timeout=10)
+        return self.descarregar()
+
+class SessaoSmtp:
+    """Conexão SMTP autenticada com contadores de uso"""
+    def __init__(self, servidor):
+        self.servidor = servidor
+        self.mensagens = 0
+        self.ultimo_uso = time.monotonic()
+
+    def fechar(self):
+        """Encerra a conexão ignorando falhas (servidor pode já ter desconectado)"""
+        try:
+            self.servidor.quit()
+        except Exception:
+            try:
+                self.servidor.close()
+            except Exception:
+                pass
+
+class PoolSmtp:
+    """Pool de sessões SMTP autenticadas reaproveitadas entre pedidos e ciclos"""
+    TIMEOUT_SEGUNDOS = 60
+    VERIFICAR_NOOP_APOS_SEGUNDOS = 5
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.parametros = None
+        self.mensagens_por_conexao = 100
+        self.ociosidade_segundos = 60
+        self.ociosas = []
+        self.conexoes_abertas = 0
+        self.lock = threading.Lock()
+
+    def configurar(self, servidor, porta, usuario, senha, mensagens_por_conexao=100, ociosidade_segundos=60):
+        """Define servidor/credenciais; se mudarem, as sessões antigas são descartadas"""
+        parametros = (servidor, porta, usuario, senha)
+        with self.lock:
+            mudou = parametros != self.parametros
+            self.parametros = parametros
+            self.mensagens_por_conexao = max(1, mensagens_por_conexao)
+            self.ociosidade_segundos = max(1, ociosidade_segundos)
+        if mudou:
+            self.fechar_todas()
+
+    def _conectar(self):
+        """Abre conexão, STARTTLS e login"""
+        servidor, porta, usuario, senha = self.parametros
+        self.logger.debug(f"Conectando ao servidor SMTP {servidor}:{porta}")
+        with METRICAS.medir('smtp_conexao'):
+            smtp = smtplib.SMTP(servidor, porta, timeout=self.TIMEOUT_SEGUNDOS)
+        try:
+            # O DATA é escrito em vários blocos antes de ler a resposta: sem TCP_NODELAY o último
+            # bloco pequeno espera o ACK atrasado do servidor (Nagle), ~40 ms por mensagem
+            smtp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with METRICAS.medir('smtp_tls'):
+                smtp.starttls()
+            self.logger.debug(f"Autenticando como {usuario}")
+            with METRICAS.medir('smtp_login'):
+                smtp.login(usuario, senha)
+        except Exception:
+            smtp.close()
+            METRICAS.contar('smtp_falha_conexao')
+            raise
+        METRICAS.contar('smtp_conexao')
+        with self.lock:
+            self.conexoes_abertas += 1
+        self.logger.info(f"Nova sessão SMTP autenticada ({self.conexoes_abertas} handshake(s) desde o início)")
+        return SessaoSmtp(smtp)
+
+    def _sessao_saudavel(self, sessao):
+        """Descarta sessões ociosas demais ou que não respondem ao NOOP"""
+        ocioso = time.monotonic() - sessao.ultimo_uso
+        if ocioso > self.ociosidade_segundos:
+            return False
+        if ocioso < self.VERIFICAR_NOOP_APOS_SEGUNDOS:
+            return True
+        try:
+            codigo, _ = sessao.servidor.noop()
+            return codigo == 250
+        except Exception:
+            return False
+
+    def adquirir(self):
+        """Retorna uma sessão pronta para uso (reaproveitada ou nova)"""
+        while True:
+            with self.lock:
+                sessao = self.ociosas.pop() if self.ociosas else None
+            if sessao is None:
+                return self._conectar()
+            if self._sessao_saudavel(sessao):
+                return sessao
+            sessao.fechar()
+
+    def liberar(self, sessao, descartar=False):
+        """Devolve a sessão ao pool ou a encerra se atingiu o limite de mensagens"""
+        if descartar or sessao.mensagens >= self.mensagens_por_conexao:
+            sessao.fechar()
+            return
+        sessao.ultimo_uso = time.monotonic()
+        with self.lock:
+            self.ociosas.append(sessao)
+
+    @staticmethod
+    def _conexao_perdida(erro):
+        """Indica se o erro significa que a conexão não pode mais ser usada (desconexão ou 421)"""
+        if isinstance(erro, smtplib.SMTPServerDisconnected):
+            return True
+        return isinstance(erro, smtplib.SMTPResponseException) and erro.smtp_code == 421
+
+    @staticmethod
+    def _transmitir(smtp, remetente, destinatarios, mensagem):
+        """Equivalente ao sendmail, mas escreve os blocos da mensagem direto no DATA"""
+        inicio = time.perf_counter()
+        smtp.ehlo_or_helo_if_needed()
+        codigo, resposta = smtp.mail(remetente)
+        if codigo != 250:
+            PoolSmtp._rset(smtp)
+            raise smtplib.SMTPSenderRefused(codigo, resposta, remetente)
+        recusados = {}
+        for destinatario in destinatarios:
+            codigo, resposta = smtp.rcpt(destinatario)
+            if codigo not in (250, 251):
+                recusados[destinatario] = (codigo, resposta)
+        if len(recusados) == len(destinatarios):
+            PoolSmtp._rset(smtp)
+            raise smtplib.SMTPRecipientsRefused(recusados)
+        METRICAS.observar('smtp_envelope', time.perf_counter() - inicio)
+        with METRICAS.medir('smtp_data'):
+            codigo, resposta = smtp.docmd('data')
+            if codigo != 354:
+                PoolSmtp._rset(smtp)
+                raise smtplib.SMTPDataError(codigo, resposta)
+            for bloco in mensagem.blocos():
+                smtp.send(bloco)
+            smtp.send(mensagem.terminador())
+            codigo, resposta = smtp.getreply()
+        if codigo != 250:
+            raise smtplib.SMTPDataError(codigo, resposta)
+        return recusados
+
+    @staticmethod
+    def _rset(smtp):
+        try:
+            smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    def enviar(self, remetente, destinatarios, mensagem):
+        """Envia a mensagem reconectando uma vez se a sessão tiver caído"""
+        for tentativa in range(2):
+            sessao = self.adquirir()
+            try:
+                self._transmitir(sessao.servidor, remetente, destinatarios, mensagem)
+            except (smtplib.SMTPException, OSError) as e:
+                perdida = self._conexao_perdida(e) or not isinstance(e, smtplib.SMTPException)
+                self.liberar(sessao, descartar=perdida)
+                if perdida and tentativa == 0 and not LimitadorTaxa.eh_throttling(e):
+                    METRICAS.contar('smtp_sessao_perdida')
+                    self.logger.warning(f"Sessão SMTP perdida ({e}), reconectando...")
+                    continue
+                raise
+            sessao.mensagens += 1
+            self.liberar(sessao)
+            return
+
+    def fechar_todas(self):
+        """Encerra todas as sessões ociosas"""
+        with self.lock:
+            ociosas, self.ociosas = self.ociosas, []
+        for sessao in ociosas:
+            sessao.fechar()
+
+class LimitadorTaxa:
+    """Token bucket de mensagens/s e destinatários/min que recua ao receber throttling e depois volta aos poucos.
+    Sem limite de mensagens/s configurado, o recuo parte da taxa observada nos últimos envios"""
+    FATOR_MINIMO = 0.1
+    PASSO_RETOMADA = 0.1  # Fração da taxa configurada recuperada a cada intervalo sem throttling
+    INTERVALO_RETOMADA_SEGUNDOS = 30
+    PAUSA_THROTTLING_SEGUNDOS = 30
+    PAUSA_MAXIMA_SEGUNDOS = 300
+    RAJADA_DESTINATARIOS_SEGUNDOS = 10  # Destinatários acumuláveis = taxa de 10 segundos
+    JANELA_OBSERVACAO_SEGUNDOS = 60  # Envios considerados para a taxa observada
+
+    def __init__(self, logger, usuario):
+        self.logger = logger
+        self.usuario = usuario
+        self.mensagens_por_segundo = 0.0
+        self.destinatarios_por_minuto = 0
+        self.taxa_observada = 0.0  # Base do recuo quando não há limite configurado (0 = sem limite em vigor)
+        self.envios_recentes = deque(maxlen=100)  # Instantes dos últimos envios aceitos
+        self.fator = 1.0
+        self.throttlings_seguidos = 0
+        self.bloqueado_ate = 0.0
+        self.ultimo_ajuste = time.monotonic()
+        self.ultima_recarga = time.monotonic()
+        self.fichas_mensagens = 1.0
+        self.fichas_destinatarios = 0.0
+        self.lock = threading.Lock()
+
+    def configurar(self, mensagens_por_segundo, destinatarios_por_minuto):
+        """Define os limites da conta (0 = sem limite até um throttling); o fator adaptativo atual é mantido"""
+        with self.lock:
+            self.mensagens_por_segundo = max(0.0, float(mensagens_por_segundo))
+            self.destinatarios_por_minuto = max(0, int(destinatarios_por_minuto))
+
+    @staticmethod
+    def eh_throttling(erro):
+        """Reconhece respostas de limitação do provedor (421, 4.7.x, cota excedida)"""
+        if isinstance(erro, smtplib.SMTPRecipientsRefused):
+            respostas = list(erro.recipients.values())
+        elif isinstance(erro, smtplib.SMTPResponseException):
+            respostas = [(erro.smtp_code, erro.smtp_error)]
+        else:
+            return False
+        for codigo, texto in respostas:
+            texto = texto.decode('utf-8', 'replace') if isinstance(texto, bytes) else str(texto)
+            texto = texto.lower()
+            if codigo == 421 or (400 <= codigo < 500 and '4.7.' in texto) or 'quota' in texto or 'rate limit' in texto:
+                return True
+        return False
+
+    def _taxa_mensagens(self):
+        """Limite de mensagens/s em vigor antes do fator: o configurado ou, sem ele, o observado no throttling"""
+        return self.mensagens_por_segundo or self.taxa_observada
+
+    def _recarregar(self, agora):
+        decorrido = agora - self.ultima_recarga
+        self.ultima_recarga = agora
+        if self._taxa_mensagens():
+            taxa = self._taxa_mensagens() * self.fator
+            self.fichas_mensagens = min(max(1.0, taxa), self.fichas_mensagens + decorrido * taxa)
+        if self.destinatarios_por_minuto:
+            taxa = self.destinatarios_por_minuto * self.fator / 60
+            capacidade = max(1.0, taxa * self.RAJADA_DESTINATARIOS_SEGUNDOS)
+            self.fichas_destinatarios = min(capacidade, self.fichas_destinatarios + decorrido * taxa)
+
+    def _reservar(self, destinatarios):
+        """Consome as fichas do envio e retorna 0, ou retorna quantos segundos ainda é preciso esperar"""
+        agora = time.monotonic()
+        self._recarregar(agora)
+        espera = self.bloqueado_ate - agora
+        if self._taxa_mensagens() and self.fichas_mensagens < 1:
+            espera = max(espera, (1 - self.fichas_mensagens) / (self._taxa_mensagens() * self.fator))
+        if self.destinatarios_por_minuto:
+            taxa = self.destinatarios_por_minuto * self.fator / 60
+            necessario = min(destinatarios, max(1.0, taxa * self.RAJADA_DESTINATARIOS_SEGUNDOS))
+            if self.fichas_destinatarios < necessario:
+                espera = max(espera, (necessario - self.fichas_destinatarios) / taxa)
+        if espera > 0:
+            return espera
+        if self._taxa_mensagens():
+            self.fichas_mensagens -= 1
+        if self.destinatarios_por_minuto:
+            self.fichas_destinatarios -= necessario
+        return 0
+
+    def aguardar(self, destinatarios):
+        """Bloqueia até o envio de uma mensagem com N destinatários caber nos limites"""
+        while True:
+            with self.lock:
+                espera = self._reservar(destinatarios)
+            if espera <= 0:
+                return
+            METRICAS.observar('limitador_espera', espera)
+            time.sleep(espera)
+
+    def bloqueado(self):
+        """Indica se a conta está em pausa por throttling"""
+        return self.bloqueado_ate > time.monotonic()
+
+    def registrar_sucesso(self):
+        """Após um intervalo sem throttling, devolve parte da taxa que foi reduzida"""
+        with self.lock:
+            self.throttlings_seguidos = 0
+            agora = time.monotonic()
+            self.envios_recentes.append(agora)
+            if self.fator >= 1.0 or agora - self.ultimo_ajuste < self.INTERVALO_RETOMADA_SEGUNDOS:
+                return
+            self.fator = min(1.0, self.fator + self.PASSO_RETOMADA)
+            self.ultimo_ajuste = agora
+            fator = self.fator
+            if fator >= 1.0:
+                self.taxa_observada = 0.0  # Recuperado por completo: volta a não haver limite
+        self.logger.debug(f"Conta SMTP {self.usuario}: taxa de envio retomada para {fator:.0%} do limite")
+
+    def _observar_taxa(self, agora):
+        """Mensagens/s aceitas na última JANELA_OBSERVACAO_SEGUNDOS (mínimo de 1/s)"""
+        recentes = [t for t in self.envios_recentes if agora - t <= self.JANELA_OBSERVACAO_SEGUNDOS]
+        if len(recentes) < 2 or recentes[-1] <= recentes[0]:
+            return 1.0
+        return max(1.0, (len(recentes) - 1) / (recentes[-1] - recentes[0]))
+
+    def registrar_throttling(self, erro):
+        """Corta a taxa pela metade; só throttlings seguidos (sem envio aceito entre eles) pausam a conta,
+        por tempo crescente. Um throttling isolado não para os demais envios da conta"""
+        with self.lock:
+            agora = time.monotonic()
+            self.throttlings_seguidos += 1
+            if not self.mensagens_por_segundo and not self.taxa_observada:
+                self.taxa_observada = self._observar_taxa(agora)
+            self.fator = max(self.FATOR_MINIMO, self.fator / 2)
+            pausa = 0
+            if self.throttlings_seguidos > 1:
+                pausa = min(self.PAUSA_MAXIMA_SEGUNDOS, self.PAUSA_THROTTLING_SEGUNDOS * 2 ** (self.throttlings_seguidos - 2))
+                self.bloqueado_ate = agora + pausa
+            self.ultimo_ajuste = agora
+            self.fichas_mensagens = min(self.fichas_mensagens, 0.0)
+            self.fichas_destinatarios = min(self.fichas_destinatarios, 0.0)
+            fator = self.fator
+        if pausa:
+            self.logger.warning(f"Conta SMTP {self.usuario}: throttling do provedor ({erro}) - pausa de {pausa}s, taxa reduzida para {fator:.0%} do limite")
+        else:
+            self.logger.warning(f"Conta SMTP {self.usuario}: throttling do provedor ({erro}) - taxa reduzida para {fator:.0%} do limite")
+
+class ContaSmtp:
+    """Conta (ou relay) SMTP com seu pool de sessões, limitador de taxa, carga atual e estado de saúde"""
+    def __init__(self, pool, usuario, limitador):
+        self.pool = pool
+        self.usuario = usuario
+        self.limitador = limitador
+        self.em_uso = 0
+        self.enviadas = 0
+        self.falhas_seguidas = 0
+        self.pausada_ate = 0.0
+
+class DistribuidorSmtp:
+    """Distribui os envios entre as contas SMTP configuradas, escolhendo a menos carregada"""
+    PAUSA_INICIAL_SEGUNDOS = 60
+    PAUSA_MAXIMA_SEGUNDOS = 900
+    MAX_REPETICOES_THROTTLING = 3
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.contas = []
+        self.lock = threading.Lock()
+
+    def configurar(self, contas, mensagens_por_conexao=100, ociosidade_segundos=60,
+                   mensagens_por_segundo=0, destinatarios_por_minuto=0):
+        """Aplica a lista de contas (servidor, porta, usuário, senha), preservando pool e saúde das que não mudaram"""
+        with self.lock:
+            anteriores = {conta.pool.parametros: conta for conta in self.contas}
+            novas = []
+            for parametros in contas:
+                conta = anteriores.pop(tuple(parametros), None)
+                if conta is None:
+                    conta = ContaSmtp(PoolSmtp(self.logger), parametros[2], LimitadorTaxa(self.logger, parametros[2]))
+                conta.pool.configurar(*parametros, mensagens_por_conexao, ociosidade_segundos)
+                conta.limitador.configurar(mensagens_por_segundo, destinatarios_por_minuto)
+                novas.append(conta)
+            self.contas = novas
+        for conta in anteriores.values():
+            conta.pool.fechar_todas()
+        if len(novas) > 1:
+            self.logger.info(f"Envio distribuído entre {len(novas)} contas SMTP: {', '.join(c.usuario for c in novas)}")
+
+    def _escolher(self, tentadas):
+        """Conta disponível menos carregada (sem throttling primeiro); se todas estão pausadas, a que volta primeiro (só na 1ª tentativa)"""
+        with self.lock:
+            candidatas = [c for c in self.contas if c not in tentadas]
+            agora = time.monotonic()
+            disponiveis = [c for c in candidatas if c.pausada_ate <= agora]
+            if disponiveis:
+                conta = min(disponiveis, key=lambda c: (c.limitador.bloqueado(), c.em_uso, c.enviadas))
+            elif candidatas and not tentadas:
+                conta = min(candidatas, key=lambda c: c.pausada_ate)
+            else:
+                return None
+            conta.em_uso += 1
+            return conta
+
+    @staticmethod
+    def _falha_da_conta(erro):
+        """Indica se o erro é da conta (conexão, autenticação, 421) e não da mensagem ou dos destinatários
+
+        Respostas 4xx a MAIL/RCPT/DATA (ex.: 451) são falha só da mensagem, que volta pelo cool-down;
+        cota e limitação já foram tratadas pelo limitador de taxa antes de chegar aqui.
+        """
+        if not isinstance(erro, smtplib.SMTPException):
+            return True  # Erro de rede
+        if isinstance(erro, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                             smtplib.SMTPHeloError, smtplib.SMTPAuthenticationError)):
+            return True
+        return isinstance(erro, smtplib.SMTPResponseException) and erro.smtp_code == 421
+
+    def _devolver(self, conta):
+        with self.lock:
+            conta.em_uso -= 1
+
+    def _registrar_resultado(self, conta, erro=None):
+        """Atualiza carga e saúde da conta; falhas seguidas pausam a conta por tempo crescente"""
+        with self.lock:
+            conta.em_uso -= 1
+            if erro is None:
+                recuperada = conta.falhas_seguidas > 0
+                conta.enviadas += 1
+                conta.falhas_seguidas = 0
+                conta.pausada_ate = 0.0
+            else:
+                conta.falhas_seguidas += 1
+                # Sem outra conta para assumir, pausar só adiaria os envios: a conta segue em uso
+                pausa = 0 if len(self.contas) < 2 else min(self.PAUSA_MAXIMA_SEGUNDOS, self.PAUSA_INICIAL_SEGUNDOS * 2 ** (conta.falhas_seguidas - 1))
+                conta.pausada_ate = time.monotonic() + pausa
+        if erro is not None and pausa:
+            self.logger.warning(f"Conta SMTP {conta.usuario} pausada por {pausa}s após {conta.falhas_seguidas} falha(s) seguida(s): {erro}")
+        elif erro is not None:
+            self.logger.warning(f"Conta SMTP {conta.usuario} com {conta.falhas_seguidas} falha(s) seguida(s) (única conta, continua em uso): {erro}")
+        elif recuperada:
+            self.logger.info(f"Conta SMTP {conta.usuario} voltou a enviar normalmente")
+
+    def enviar(self, remetente, destinatarios, mensagem):
+        """Envia pela conta menos carregada, respeitando o limitador de taxa; se a falha for da conta,
+        tenta as demais. Throttling não descarta a conta: o limitador recua e a mensagem espera a vez. Retorna a conta usada"""
+        tentadas = []
+        throttlings = 0
+        ultimo_erro = smtplib.SMTPException("Nenhuma conta SMTP configurada")
+        while True:
+            conta = self._escolher(tentadas)
+            if conta is None:
+                raise ultimo_erro
+            email_from = remetente or conta.usuario
+            try:
+                conta.limitador.aguardar(len(destinatarios))
+                mensagem.definir_remetente(email_from)
+                conta.pool.enviar(email_from, destinatarios, mensagem)
+            except (smtplib.SMTPException, OSError) as e:
+                if LimitadorTaxa.eh_throttling(e):
+                    METRICAS.contar('smtp_throttling')
+                    conta.limitador.registrar_throttling(e)
+                    self._devolver(conta)
+                    throttlings += 1
+                    if throttlings > self.MAX_REPETICOES_THROTTLING:
+                        raise
+                    continue
+                if not self._falha_da_conta(e):
+                    self._registrar_resultado(conta)
+                    raise
+                METRICAS.contar('smtp_falha_conta')
+                self._registrar_resultado(conta, e)
+                tentadas.append(conta)
+                ultimo_erro = e
+                continue
+            except Exception:
+                self._registrar_resultado(conta)
+                raise
+            conta.limitador.registrar_sucesso()
+            self._registrar_resultado(conta)
+            return conta
+
+    def fechar_todas(self):
+        """Encerra as sessões ociosas de todas as contas"""
+        with self.lock:
+            contas = list(self.contas)
+        for conta in contas:
+            conta.pool.fechar_todas()
+
+class TemplatesEmail:
+    """Assunto e corpo do email validados e preparados uma vez por versão da configuração"""
+    # Variáveis documentadas em VariaveisDisponiveis.md
+    VARIAVEIS_DISPONIVEIS = frozenset({
+        'NroPedido', 'RazaoSocial', 'NomeContato', 'DataPedidoFechado', 'VersaoPdf', 'MensagemReenvio',
+        'EmailReplyTo', 'ResponderPara', 'EmailExpositor', 'EmailRepresentante', 'HeaderColor',
+    })
+    ASSUNTO_PADRAO = 'Pedido {NroPedido} - PDF Anexado'
+    CORPO_PADRAO = """Prezado(a) {RazaoSocial},
+
+Segue em anexo o PDF do seu pedido número {NroPedido}.
+
+{MensagemReenvio}
+
+Atenciosamente,
+Equipe SRPP"""
+    # Valores de exemplo usados para testar a renderização na carga
+    AMOSTRA = {
+        'NroPedido': 1234, 'RazaoSocial': 'Cliente', 'NomeContato': 'Cliente', 'DataPedidoFechado': '01/01/2025',
+        'VersaoPdf': 1, 'MensagemReenvio': '', 'EmailReplyTo': '', 'ResponderPara': '',
+        'EmailExpositor': '', 'EmailRepresentante': '', 'HeaderColor': '#0a77d5',
+    }
+
+    def __init__(self, assunto, corpo, variaveis_fixas=None):
+        self.tipo_conteudo = 'plain'  # Padrão é texto simples
+        linhas = corpo.split('\n')
+        if linhas and linhas[0].strip().upper() in ('#HTML', '#TEXTO'):
+            if linhas[0].strip().upper() == '#HTML':
+                self.tipo_conteudo = 'html'
+            # Remove a primeira linha (marcador) do template
+            corpo = '\n'.join(linhas[1:])
+
+        self._validar('EmailAssunto', assunto)
+        self._validar('EmailCorpo', corpo)
+        self.assunto = assunto
+        self.corpo = corpo
+        self.variaveis_fixas = dict(variaveis_fixas or {})
+        self.renderizar_assunto = assunto.format_map
+        self.renderizar_corpo = corpo.format_map
+
+    @classmethod
+    def _validar(cls, campo, template):
+        """Confere sintaxe e variáveis do template; levanta ValueError com a descrição do problema"""
+        try:
+            nomes = [nome for _, nome, _, _ in string.Formatter().parse(template) if nome is not None]
+        except ValueError as e:
+            raise ValueError(f"{campo}: sintaxe inválida ({e})")
+        for nome in nomes:
+            if nome.split('.')[0].split('[')[0] not in cls.VARIAVEIS_DISPONIVEIS:
+                raise ValueError(f"{campo}: variável desconhecida {{{nome}}}")
+        try:
+            template.format_map(cls.AMOSTRA)
+        except Exception as e:
+            raise ValueError(f"{campo}: erro ao aplicar variáveis ({e})")
+
+class CacheAnexos:
+    """Cache em disco dos anexos já codificados em base64, indexado pelo hash do conteúdo"""
+    TAMANHO_LEITURA = 57 * 1024  # Múltiplo de 57 bytes = linhas completas de 76 caracteres
+    DIAS_RETENCAO = 7
+    TAMANHO_MAXIMO_BYTES = 2 * 1024 ** 3  # Acima disso saem os usados há mais tempo (mtime = último uso)
+    FRACAO_APOS_LIMPEZA = 0.8  # A limpeza por tamanho desce até esta fração do limite
+
+    def __init__(self, logger, diretorio=os.path.join('dados', 'anexos')):
+        self.logger = logger
+        self.diretorio = diretorio
+        self.hashes = {}  # (caminho, tamanho, mtime) -> sha256
+        self.tamanho_total = 0  # Bytes no diretório (apurado pela limpeza, somado a cada anexo novo)
+        self.lock = threading.Lock()
+        self.lock_limpeza = threading.Lock()
+
+    def iniciar(self):
+        """Cria o diretório do cache e dispara a limpeza dos anexos antigos em segundo plano"""
+        os.makedirs(self.diretorio, exist_ok=True)
+        threading.Thread(target=self.limpar, name='limpeza-anexos', daemon=True).start()
+
+    def limpar(self):
+        """Remove anexos codificados não usados há mais de DIAS_RETENCAO dias e, se o total passar de
+        TAMANHO_MAXIMO_BYTES, os usados há mais tempo até descer a FRACAO_APOS_LIMPEZA do limite"""
+        if not self.lock_limpeza.acquire(blocking=False):
+            return  # Já há uma limpeza em andamento
+        try:
+            limite = time.time() - self.DIAS_RETENCAO * 86400
+            arquivos = []
+            removidos = 0
+            with os.scandir(self.diretorio) as entradas:
+                for entrada in entradas:
+                    if not entrada.is_file() or not entrada.name.endswith('.b64'):
+                        continue
+                    info = entrada.stat()
+                    if info.st_mtime < limite:
+                        os.remove(entrada.path)
+                        removidos += 1
+                    else:
+                        arquivos.append((info.st_mtime, info.st_size, entrada.path))
+            total = sum(tamanho for _, tamanho, _ in arquivos)
+            if total > self.TAMANHO_MAXIMO_BYTES:
+                alvo = self.TAMANHO_MAXIMO_BYTES * self.FRACAO_APOS_LIMPEZA
+                for _, tamanho, caminho in sorted(arquivos):
+                    if total <= alvo:
+                        break
+                    try:
+                        os.remove(caminho)
+                    except FileNotFoundError:
+                        pass
+                    total -= tamanho
+                    removidos += 1
+            with self.lock:
+                self.tamanho_total = total
+            if removidos:
+                self.logger.info(f"Cache de anexos: {removidos} arquivo(s) removido(s), {total / 1024 ** 2:.0f} MB em uso")
+        except OSError as e:
+            self.logger.warning(f"Erro ao limpar cache de anexos: {e}")
+        finally:
+            self.lock_limpeza.release()
+
+    def calcular_hash(self, caminho_pdf):
+        """SHA-256 do arquivo lido em blocos (memorizado enquanto tamanho/mtime não mudarem)"""
+        info = os.stat(caminho_pdf)
+        chave = (caminho_pdf, info.st_size, info.st_mtime_ns)
+        with self.lock:
+            if chave in self.hashes:
+                return self.hashes[chave]
+        sha = hashlib.sha256()
+        with open(caminho_pdf, 'rb') as arquivo:
+            for bloco in iter(lambda: arquivo.read(1024 * 1024), b''):
+                sha.update(bloco)
+        digest = sha.hexdigest()
+        with self.lock:
+            self.hashes[chave] = digest
+        return digest
+
+    def obter(self, caminho_pdf):
+        """Retorna o caminho do anexo em base64 (linhas CRLF), codificando só na primeira vez"""
+        destino = os.path.join(self.diretorio, f"{self.calcular_hash(caminho_pdf)}.b64")
+        if os.path.exists(destino):
+            try:
+                os.utime(destino)
+                return destino
+            except FileNotFoundError:
+                pass  # Removido pela limpeza entre as duas chamadas: codifica de novo
+
+        os.makedirs(self.diretorio, exist_ok=True)
+        temporario = f"{destino}.{threading.get_ident()}.tmp"
+        with open(caminho_pdf, 'rb') as origem, open(temporario, 'wb') as saida:
+            primeiro = True
+            for bloco in iter(lambda: origem.read(self.TAMANHO_LEITURA), b''):
+                codificado = base64.b64encode(bloco)
+                linhas = b'\r\n'.join(codificado[i:i + 76] for i in range(0, len(codificado), 76))
+                saida.write(linhas if primeiro else b'\r\n' + linhas)
+                primeiro = False
+        os.replace(temporario, destino)
+        with self.lock:
+            self.tamanho_total += os.path.getsize(destino)
+            excedido = self.tamanho_total > self.TAMANHO_MAXIMO_BYTES
+        if excedido:
+            self.limpar()
+        return destino
+
+class MensagemEmail:
+    """Mensagem MIME cujo anexo (já em base64 no cache) é transmitido em blocos direto no DATA"""
+    MARCADOR = '@@ANEXO_PDF_CODIFICADO@@'
+    TAMANHO_BLOCO = 64 * 1024
+    POLITICA = policy.compat32.clone(linesep='\r\n')
+
+    def __init__(self, msg, arquivo_codificado, nome_arquivo):
+        part = MIMEBase('application', 'octet-stream')
+        part.set_payload(self.MARCADOR)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', f'attachment; filename= {nome_arquivo}')
+        msg.attach(part)
+        self.msg = msg
+        self.remetente = msg['From']
+        self.arquivo_codificado = arquivo_codificado
+        self._serializar()
+
+    @classmethod
+    def carregar(cls, dados, arquivo_codificado, remetente):
+        """Reconstrói a mensagem gravada na caixa de saída; o MIME só é interpretado de novo se o From mudar"""
+        mensagem = cls.__new__(cls)
+        mensagem.msg = None
+        mensagem.dados = dados
+        mensagem.remetente = remetente
+        mensagem.arquivo_codificado = arquivo_codificado
+        mensagem._serializar()
+        return mensagem
+
+    def _serializar(self):
+        if self.msg is not None:
+            self.dados = self.msg.as_bytes(policy=self.POLITICA)  # Com o marcador no lugar do anexo
+        inicio, fim = self.dados.split(self.MARCADOR.encode('ascii'), 1)
+        self.inicio = self._escapar_pontos(inicio)
+        self.fim = self._escapar_pontos(fim)
+
+    def definir_remetente(self, endereco):
+        """Troca o cabeçalho From (conta SMTP diferente da prevista) e serializa de novo"""
+        if self.remetente == endereco:
+            return
+        if self.msg is None:
+            self.msg = message_from_bytes(self.dados, policy=self.POLITICA)
+        self.msg.replace_header('From', endereco)
+        self.remetente = endereco
+        self._serializar()
+
+    @staticmethod
+    def _escapar_pontos(dados):
+        """Duplica pontos no início de linha (transparência do SMTP, RFC 5321 4.5.2)"""
+        return re.sub(rb'(?m)^\.', b'..', dados)
+
+    def blocos(self):
+        """Cabeçalhos e corpo, anexo lido do cache em blocos e fechamento do multipart"""
+        yield self.inicio
+        with open(self.arquivo_codificado, 'rb') as arquivo:
+            for bloco in iter(lambda: arquivo.read(self.TAMANHO_BLOCO), b''):
+                yield bloco
+        yield self.fim
+
+    def terminador(self):
+        return b'.\r\n' if self.fim.endswith(b'\r\n') else b'\r\n.\r\n'
+
+class CaixaSaida:
+    """Caixa de saída em disco: mensagens já montadas aguardando a entrega SMTP
+
+    Cada pedido vira dois arquivos: <Id>.eml (a mensagem serializada, com o marcador
+    no lugar do anexo, que continua no cache de anexos) e <Id>.json (a entrada do
+    índice: pedido, destinatários, remetente e hash do PDF). O .json é gravado por
+    último e só então o item existe. Os trabalhadores de entrega esvaziam a caixa no
+    ritmo do SMTP enquanto os ciclos continuam montando mensagens; o ENVIADO só é
+    anotado no BufferStatus depois que o servidor aceitou a mensagem, e um reinício
+    retoma os itens pendentes sem montá-los de novo.
+    """
+    # Campos do pedido necessários para gravar o resultado da entrega
+    CAMPOS_PEDIDO = (
+        'id', 'numero', 'nome_cliente', 'email_cliente', 'emails_copia', 'enviar_email_cliente',
+        'motivo_processamento', 'tentativas_anteriores', 'versao_disponivel',
+    )
+
+    def __init__(self, sistema_emails, diretorio=os.path.join('dados', 'saida')):
+        self.sistema_emails = sistema_emails
+        self.logger = sistema_emails.logger
+        self.diretorio = diretorio
+        self.indice = {}  # Id -> entrada do índice dos itens ainda não entregues
+        self.fila = queue.Queue()
+        self.condicao = threading.Condition()
+        self.parado = threading.Event()
+        self.threads = []
+        self.ativa = False  # Só recebe mensagens enquanto houver trabalhadores de entrega
+        # A entrega só começa depois de retomar_reservas confirmar que os itens recuperados
+        # ainda estão reservados para esta instância
+        self.entrega_liberada = threading.Event()
+
+    def _caminho(self, id_controle, extensao):
+        return os.path.join(self.diretorio, f"{id_controle}{extensao}")
+
+    @staticmethod
+    def _gravar(caminho, dados):
+        """Grava de forma atômica: arquivo temporário com fsync e depois os.replace"""
+        temporario = f"{caminho}.tmp"
+        with open(temporario, 'wb') as arquivo:
+            arquivo.write(dados)
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        os.replace(temporario, caminho)
+
+    def _recuperar(self):
+        """Recarrega o índice com os itens deixados pelo último encerramento"""
+        self.sistema_emails.buffer_status.iniciar()  # As transições do diário dizem o que já foi entregue
+        try:
+            os.makedirs(self.diretorio, exist_ok=True)
+            nomes = os.listdir(self.diretorio)
+        except OSError as e:
+            self.logger.error(f"Erro ao ler caixa de saída: {e}")
+            return
+        itens = []
+        for nome in nomes:
+            if not nome.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.diretorio, nome), 'r', encoding='utf-8') as arquivo:
+                    item = json.load(arquivo)
+            except (OSError, ValueError) as e:
+                self.logger.error(f"Item ilegível na caixa de saída ({nome}): {e}")
+                continue
+            pedido = item['pedido']
+            anotado = self.sistema_emails.buffer_status.pendentes.get(pedido['id'])
+            if anotado and anotado[0] == 'ENVIADO' and anotado[1][0] == pedido['versao_disponivel']:
+                # Entrega já anotada no diário de status; só a remoção do item não chegou a acontecer
+                self._apagar(pedido['id'])
+                continue
+            itens.append(item)
+        for item in sorted(itens, key=lambda item: item['depositado_em']):
+            self.indice[item['pedido']['id']] = item
+            self.fila.put(item['pedido']['id'])
+        # Mensagens sem entrada no índice (queda durante o depósito)
+        recuperados = {str(id_controle) for id_controle in self.indice}
+        for nome in nomes:
+            base, extensao = os.path.splitext(nome)
+            if extensao == '.tmp' or (extensao == '.eml' and base not in recuperados):
+                try:
+                    os.remove(os.path.join(self.diretorio, nome))
+                except OSError:
+                    pass
+        if self.indice:
+            self.logger.warning(f"{len(self.indice)} mensagem(ns) pendente(s) recuperada(s) da caixa de saída")
+
+    def _apagar(self, id_controle):
+        for extensao in ('.json', '.eml'):
+            try:
+                os.remove(self._caminho(id_controle, extensao))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.error(f"Erro ao remover item {id_controle} da caixa de saída: {e}")
+
+    def iniciar(self, trabalhadores=2):
+        """Recupera os itens pendentes e inicia os trabalhadores de entrega; com 0, os pedidos voltam
+        a ser enviados direto no ciclo. Nada é entregue antes de liberar_entrega()"""
+        self._recuperar()
+        self.parado.clear()
+        self.ativa = trabalhadores > 0
+        # Itens recuperados são entregues mesmo com a caixa de saída desligada
+        quantidade = trabalhadores if self.ativa else (1 if self.indice else 0)
+        for numero in range(quantidade):
+            thread = threading.Thread(target=self._executar, name=f'entrega-{numero + 1}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if self.ativa:
+            self.logger.info(f"Caixa de saída ativa com {trabalhadores} trabalhador(es) de entrega")
+
+    def liberar_entrega(self):
+        """Chamado quando as reservas desta instância foram retomadas (itens alheios já descartados)"""
+        if not self.entrega_liberada.is_set():
+            self.entrega_liberada.set()
+            if self.indice:
+                self.logger.info(f"Entrega liberada: {len(self.indice)} item(ns) na caixa de saída")
+
+    def parar(self):
+        """Interrompe a entrega; o que não foi entregue continua em disco para o próximo início"""
+        self.ativa = False
+        self.parado.set()
+        for _ in self.threads:
+            self.fila.put(None)
+        for thread in self.threads:
+            thread.join(timeout=30)
+        self.threads = []
+
+    def descartar(self, ids):
+        """Remove itens que não devem mais ser entregues por esta instância"""
+        for id_controle in ids:
+            with self.condicao:
+                item = self.indice.pop(id_controle, None)
+                self.condicao.notify_all()
+            if item:
+                self._apagar(id_controle)
+                self.logger.warning(f"Pedido {item['pedido']['numero']}: reservado por outra instância ou já concluído - item descartado da caixa de saída")
+
+    def depositar(self, pedido, mensagem, destinatarios, remetente, hash_pdf):
+        """Grava a mensagem montada e sua entrada no índice; a entrega fica com os trabalhadores"""
+        id_controle = pedido['id']
+        item = {
+            'pedido': {campo: pedido.get(campo) for campo in self.CAMPOS_PEDIDO},
+            'destinatarios': destinatarios,
+            'remetente': remetente,
+            'from': mensagem.remetente,
+            'anexo': mensagem.arquivo_codificado,
+            'hash_pdf': hash_pdf,
+            'depositado_em': time.time(),
+        }
+        with METRICAS.medir('caixa_saida_deposito'):
+            self._gravar(self._caminho(id_controle, '.eml'), mensagem.dados)
+            self._gravar(self._caminho(id_controle, '.json'), json.dumps(item, default=str).encode('utf-8'))
+        with self.condicao:
+            self.indice[id_controle] = item
+        self.fila.put(id_controle)
+        self.logger.debug(f"Pedido {pedido['numero']}: mensagem depositada na caixa de saída")
+
+    def aguardar_vazia(self, timeout=None):
+        """Bloqueia até todas as mensagens depositadas terem sido entregues ou recusadas"""
+        with self.condicao:
+            return self.condicao.wait_for(lambda: not self.indice, timeout)
+
+    def _entregar(self, id_controle):
+        """Envia um item e anota o resultado (ENVIADO ou ERRO com nova tentativa) para a gravação em lote"""
+        with self.condicao:
+            item = self.indice.get(id_controle)
+        if item is None:
+            return
+        pedido = item['pedido']
+        METRICAS.observar('caixa_saida_espera', max(0.0, time.time() - item['depositado_em']))
+        erro = 'Erro no envio do email'
+        try:
+            with open(self._caminho(id_controle, '.eml'), 'rb') as arquivo:
+                mensagem = MensagemEmail.carregar(arquivo.read(), item['anexo'], item['from'])
+            if not os.path.exists(item['anexo']):
+                raise FileNotFoundError(f"anexo codificado não encontrado: {item['anexo']}")
+            enviado = self.sistema_emails.enviar_email(
+                pedido['numero'], mensagem, item['destinatarios'], item['remetente'],
+                pedido['motivo_processamento'] == "REENVIO_VERSAO_ATUALIZADA",
+            )
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Pedido {pedido['numero']}: item da caixa de saída inutilizável - {e}")
+            erro = f"Caixa de saída: {e}"[:500]
+            enviado = False
+        if enviado:
+            self.sistema_emails.concluir_envio(pedido, item['hash_pdf'])
+            self.sistema_emails.registrar_resultado_pedido(pedido, 'ENVIADO')
+        else:
+            self.sistema_emails.registrar_erro_envio(pedido, erro)
+            self.sistema_emails.registrar_resultado_pedido(pedido, 'ERRO', erro)
+        self._apagar(id_controle)
+        with self.condicao:
+            self.indice.pop(id_controle, None)
+            self.condicao.notify_all()
+
+    def _executar(self):
+        """Entrega os itens na ordem de depósito (o BufferStatus grava os resultados pelos próprios limites)"""
+        while not self.entrega_liberada.wait(1):
+            if self.parado.is_set():
+                return
+        while not self.parado.is_set():
+            id_controle = self.fila.get()
+            if id_controle is None or self.parado.is_set():
+                break
+            try:
+                self._entregar(id_controle)
+            except Exception as e:
+                # O item continua em disco e é retomado no próximo início
+                self.logger.error(f"Erro inesperado na entrega do item {id_controle} da caixa de saída: {e}")
+                with self.condicao:
+                    self.indice.pop(id_controle, None)
+                    self.condicao.notify_all()
+
+class IndicePdfs:
+    """Índice em memória dos PDFs da pasta: NroPedido -> {versão: caminho}"""
+    PADRAO_ARQUIVO = re.compile(r'^PEDIDO (\d+)(?:_(\d+))?\.pdf$', re.IGNORECASE)
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.caminho = None
+        self.pedidos = {}
+        self.carregado = False
+        self.versoes_alteradas = set()  # Pedidos cuja versão máxima (>= 2) ainda não foi gravada no banco
+        self.lock = threading.Lock()
+
+    @classmethod
+    def interpretar_nome(cls, nome_arquivo):
+        """Extrai (NroPedido, versão) do nome do arquivo ou None se não for um PDF de pedido"""
+        match = cls.PADRAO_ARQUIVO.match(nome_arquivo)
+        if not match:
+            return None
+        versao = int(match.group(2)) if match.group(2) else 1
+        return int(match.group(1)), versao
+
+    def garantir_carregado(self, caminho):
+        """Monta o índice na primeira consulta ou quando a pasta configurada mudar"""
+        if not self.carregado or caminho != self.caminho:
+            self.reconstruir(caminho)
+
+    def reconstruir(self, caminho):
+        """Lê a pasta inteira com uma única passada de os.scandir; retorna os pedidos cuja versão mudou"""
+        pedidos = {}
+        total = 0
+        inicio = time.perf_counter()
+        try:
+            with os.scandir(caminho) as entradas:
+                for entrada in entradas:
+                    identificacao = self.interpretar_nome(entrada.name)
+                    if not identificacao or not entrada.is_file():
+                        continue
+                    numero, versao = identificacao
+                    pedidos.setdefault(numero, {})[versao] = entrada.path
+                    total += 1
+        except OSError as e:
+            self.logger.error(f"Erro ao indexar pasta de PDFs '{caminho}': {e}")
+            return None
+
+        with self.lock:
+            if self.carregado and caminho == self.caminho:
+                # Nova leitura da mesma pasta: só interessa o que mudou desde a anterior
+                anteriores = {numero: max(versoes) for numero, versoes in self.pedidos.items() if versoes}
+                alterados = {numero for numero, versoes in pedidos.items() if anteriores.get(numero) != max(versoes)}
+            else:
+                alterados = set(pedidos)
+            self.caminho = caminho
+            self.pedidos = pedidos
+            self.carregado = True
+            self.versoes_alteradas |= {numero for numero in alterados if max(pedidos[numero]) > 1}
+        self.logger.info(f"Índice de PDFs montado: {total} arquivo(s) de {len(pedidos)} pedido(s) em {time.perf_counter() - inicio:.2f}s")
+        return alterados
+
+    def registrar(self, caminho_arquivo):
+        """Adiciona/atualiza um arquivo no índice (eventos de criação/modificação)"""
+        identificacao = self.interpretar_nome(os.path.basename(caminho_arquivo))
+        if not identificacao:
+            return None
+        numero, versao = identificacao
+        with self.lock:
+            if self.carregado:
+                versoes = self.pedidos.setdefault(numero, {})
+                if versao > 1 and versao > max(versoes, default=0):
+                    self.versoes_alteradas.add(numero)
+                versoes[versao] = caminho_arquivo
+        return identificacao
+
+    def remover(self, caminho_arquivo):
+        """Remove um arquivo do índice (eventos de exclusão/renomeação)"""
+        identificacao = self.interpretar_nome(os.path.basename(caminho_arquivo))
+        if not identificacao:
+            return None
+        numero, versao = identificacao
+        with self.lock:
+            versoes = self.pedidos.get(numero)
+            if versoes is not None:
+                versoes.pop(versao, None)
+                if not versoes:
+                    del self.pedidos[numero]
+        return identificacao
+
+    def retirar_versoes_alteradas(self):
+        """Retorna [(versão máxima, NroPedido)] pendentes de gravação no banco e limpa a lista"""
+        with self.lock:
+            alterados, self.versoes_alteradas = self.versoes_alteradas, set()
+            return [(max(self.pedidos[n]), n) for n in alterados if self.pedidos.get(n)]
+
+    def devolver_versoes_alteradas(self, versoes):
+        """Recoloca na lista pedidos cuja gravação no banco falhou"""
+        with self.lock:
+            self.versoes_alteradas.update(numero for _, numero in versoes)
+
+    def buscar(self, numero_pedido):
+        """Retorna (caminho, versão) da versão mais alta do pedido ou (None, 0)"""
+        try:
+            numero = int(numero_pedido)
+        except (TypeError, ValueError):
+            return None, 0
+        with self.lock:
+            versoes = self.pedidos.get(numero)
+            if not versoes:
+                return None, 0
+            versao_maxima = max(versoes)
+            return versoes[versao_maxima], versao_maxima
+
+class MedicaoFase:
+    """Span de tempo de uma fase (usado com 'with')"""
+    __slots__ = ('metricas', 'fase', 'inicio')
+
+    def __init__(self, metricas, fase):
+        self.metricas = metricas
+        self.fase = fase
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metricas.observar(self.fase, time.perf_counter() - self.inicio)
+
+class Metricas:
+    """Contadores e histogramas de duração por fase, mantidos em memória e exportados no formato texto do Prometheus"""
+    LIMITES_HISTOGRAMA = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contadores = {}
+        self.histogramas = {}  # fase -> [contagens por faixa (última = acima de 60s), soma]
+        self._local_thread = threading.local()
+
+    def medir(self, fase):
+        return MedicaoFase(self, fase)
+
+    def observar(self, fase, segundos):
+        """Registra a duração de uma fase (e no rastreio do pedido em andamento na thread, se houver)"""
+        faixa = bisect.bisect_left(self.LIMITES_HISTOGRAMA, segundos)
+        with self.lock:
+            histograma = self.histogramas.get(fase)
+            if histograma is None:
+                histograma = self.histogramas[fase] = [[0] * (len(self.LIMITES_HISTOGRAMA) + 1), 0.0]
+            histograma[0][faixa] += 1
+            histograma[1] += segundos
+        rastreio = getattr(self._local_thread, 'rastreio', None)
+        if rastreio is not None:
+            rastreio[fase] = rastreio.get(fase, 0.0) + segundos
+
+    def contar(self, evento, valor=1):
+        with self.lock:
+            self.contadores[evento] = self.contadores.get(evento, 0) + valor
+
+    def iniciar_rastreio(self):
+        """Passa a acumular as fases medidas nesta thread (tempo por fase de um pedido)"""
+        self._local_thread.rastreio = {}
+
+    def encerrar_rastreio(self):
+        rastreio = getattr(self._local_thread, 'rastreio', None) or {}
+        self._local_thread.rastreio = None
+        return rastreio
+
+    def zerar(self):
+        with self.lock:
+            self.contadores = {}
+            self.histogramas = {}
+
+    def exportar_texto(self):
+        """Métricas no formato de exposição texto do Prometheus"""
+        with self.lock:
+            contadores = dict(self.contadores)
+            histogramas = {fase: (list(faixas), soma) for fase, (faixas, soma) in self.histogramas.items()}
+        linhas = [
+            '# HELP envio_eventos_total Eventos do envio de emails (pedidos, conexões, erros).',
+            '# TYPE envio_eventos_total counter',
+        ]
+        for evento, valor in sorted(contadores.items()):
+            linhas.append(f'envio_eventos_total{{evento="{evento}"}} {valor}')
+        linhas += [
+            '# HELP envio_fase_duracao_segundos Duração de cada fase do ciclo, do pedido e do envio SMTP.',
+            '# TYPE envio_fase_duracao_segundos histogram',
+        ]
+        for fase, (faixas, soma) in sorted(histogramas.items()):
+            acumulado = 0
+            for limite, quantidade in zip(self.LIMITES_HISTOGRAMA + ('+Inf',), faixas):
+                acumulado += quantidade
+                linhas.append(f'envio_fase_duracao_segundos_bucket{{fase="{fase}",le="{limite}"}} {acumulado}')
+            linhas.append(f'envio_fase_duracao_segundos_sum{{fase="{fase}"}} {soma:.6f}')
+            linhas.append(f'envio_fase_duracao_segundos_count{{fase="{fase}"}} {acumulado}')
+        return '\n'.join(linhas) + '\n'
+
+METRICAS = Metricas()
+
+class ExportadorMetricas:
+    """Grava as métricas periodicamente em arquivo texto (coletor textfile do node/windows_exporter)
+    e, se houver porta configurada, atende GET /metrics em HTTP local"""
+    INTERVALO_SEGUNDOS = 15
+
+    def __init__(self, logger, porta=0, arquivo=os.path.join('dados', 'metricas.prom')):
+        self.logger = logger
+        self.porta = porta
+        self.arquivo = arquivo
+        self.servidor_http = None
+        self.parado = threading.Event()
+        self.thread = threading.Thread(target=self._executar, name='metricas', daemon=True)
+        os.makedirs(os.path.dirname(self.arquivo), exist_ok=True)
+
+    def iniciar(self):
+        self.thread.start()
+        if self.porta:
+            class ManipuladorMetricas(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    corpo = METRICAS.exportar_texto().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(corpo)))
+                    self.end_headers()
+                    self.wfile.write(corpo)
+
+                def log_message(self, *args):
+                    pass
+
+            try:
+                self.servidor_http = ThreadingHTTPServer(('127.0.0.1', self.porta), ManipuladorMetricas)
+                self.servidor_http.daemon_threads = True
+                threading.Thread(target=self.servidor_http.serve_forever, name='metricas-http', daemon=True).start()
+                self.logger.info(f"Métricas disponíveis em http://127.0.0.1:{self.porta}/metrics")
+            except OSError as e:
+                self.logger.error(f"Não foi possível abrir a porta {self.porta} para as métricas: {e}")
+
+    def parar(self):
+        self.parado.set()
+        self.thread.join(timeout=5)
+        if self.servidor_http:
+            self.servidor_http.shutdown()
+            self.servidor_http.server_close()
+        self.gravar()
+
+    def gravar(self):
+        """Substitui o arquivo de uma vez, para o coletor nunca ler um arquivo pela metade"""
+        temporario = f"{self.arquivo}.tmp"
+        try:
+            with open(temporario, 'w', encoding='utf-8', newline='\n') as arquivo:
+                arquivo.write(METRICAS.exportar_texto())
+            os.replace(temporario, self.arquivo)
+        except OSError as e:
+            self.logger.warning(f"Erro ao gravar arquivo de métricas: {e}")
+
+    def _executar(self):
+        while not self.parado.wait(self.INTERVALO_SEGUNDOS):
+            self.gravar()
+
+class FiltroRepeticoes(logging.Filter):
+    """Deixa passar um aviso idêntico (mesmo texto) uma vez por janela; a próxima ocorrência
+    depois da janela informa quantas repetições foram suprimidas
+
+    Só vale para os avisos marcados com extra=FiltroRepeticoes.POR_PEDIDO (os que todo ciclo
+    repete para o mesmo pedido); avisos operacionais, como sessão SMTP perdida ou conta pausada,
+    passam sempre.
+    """
+    JANELA_SEGUNDOS = 3600
+    LIMITE_MENSAGENS = 10000
+    POR_PEDIDO = {'repetitivo': True}
+
+    def __init__(self):
+        super().__init__()
+        self.vistas = {}  # mensagem -> [início da janela, repetições suprimidas]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno != logging.WARNING or not getattr(record, 'repetitivo', False):
+            return True
+        mensagem = record.getMessage()
+        agora = time.monotonic()
+        with self.lock:
+            vista = self.vistas.get(mensagem)
+            if vista and agora - vista[0] < self.JANELA_SEGUNDOS:
+                vista[1] += 1
+                return False
+            if len(self.vistas) >= self.LIMITE_MENSAGENS:
+                self.vistas = {m: v for m, v in self.vistas.items() if agora - v[0] < self.JANELA_SEGUNDOS}
+            self.vistas[mensagem] = [agora, 0]
+        if vista and vista[1]:
+            record.msg = f"{mensagem} (repetido mais {vista[1]} vez(es) nos {self.JANELA_SEGUNDOS // 60} min anteriores)"
+            record.args = None
+        return True
+
+class LogAssincrono:
+    """Log fora do caminho de envio: as threads só enfileiram o registro (QueueHandler) e uma
+    thread própria (QueueListener) formata e grava no arquivo e no console. O arquivo é
+    rotacionado por tamanho e as cópias antigas são compactadas em .gz"""
+    FORMATO = '%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s'
+    ARQUIVO = 'envio_emails.log'
+
+    def __init__(self, diretorio, tamanho_maximo_mb=20, arquivos_mantidos=10):
+        os.makedirs(diretorio, exist_ok=True)
+        formatador = logging.Formatter(self.FORMATO)
+        self.arquivo = RotatingFileHandler(
+            os.path.join(diretorio, self.ARQUIVO), maxBytes=tamanho_maximo_mb * 1024 * 1024,
+            backupCount=arquivos_mantidos, encoding='utf-8',
+        )
+        self.arquivo.namer = lambda nome: f"{nome}.gz"
+        self.arquivo.rotator = self._compactar
+        self.arquivo.setFormatter(formatador)
+        console = logging.StreamHandler()
+        console.setFormatter(formatador)
+        self.fila = queue.SimpleQueue()
+        self.handler = QueueHandler(self.fila)
+        self.handler.addFilter(FiltroRepeticoes())
+        self.ouvinte = QueueListener(self.fila, self.arquivo, console)
+        self.ativo = False
+
+    @staticmethod
+    def _compactar(origem, destino):
+        """Rotação: o arquivo que acabou de fechar vira .gz (executado na thread do ouvinte)"""
+        with open(origem, 'rb') as entrada, gzip.open(destino, 'wb') as saida:
+            shutil.copyfileobj(entrada, saida)
+        os.remove(origem)
+
+    def iniciar(self):
+        raiz = logging.getLogger()
+        raiz.setLevel(logging.INFO)
+        raiz.addHandler(self.handler)
+        self.ouvinte.start()
+        self.ativo = True
+        atexit.register(self.parar)  # Grava o que ainda está na fila ao encerrar o processo
+
+    def configurar(self, nivel, tamanho_maximo_mb, arquivos_mantidos):
+        logging.getLogger().setLevel(nivel)
+        self.arquivo.maxBytes = max(1, tamanho_maximo_mb) * 1024 * 1024
+        self.arquivo.backupCount = max(1, arquivos_mantidos)
+
+    def parar(self):
+        if not self.ativo:
+            return
+        self.ativo = False
+        self.ouvinte.stop()
+        self.arquivo.close()
 
 class ExcelLogger:
-    """Classe para gerenciar logs em formato Excel"""
+    """Classe para gerenciar logs em formato Excel
+
+    As linhas são enfileiradas e gravadas por uma thread própria, a cada
+    INTERVALO_SEGUNDOS ou ao acumular LIMITE_LINHAS. Cada linha vai para o
+    arquivo do dia em que foi registrada; se o arquivo estiver aberto no Excel,
+    as linhas ficam retidas em memória até a próxima gravação bem-sucedida.
+    """
+    INTERVALO_SEGUNDOS = 10
+    LIMITE_LINHAS = 100
+
     def __init__(self):
+        self.logger = logging.getLogger(__name__)
         self.caminho_base = r"C:\Users\Public\Documents\SRPP\scripts"
         os.makedirs(self.caminho_base, exist_ok=True)
-        self.arquivo_atual = os.path.join(self.caminho_base, f"log_emails_{datetime.now().strftime('%Y-%m-%d')}.xlsx")
-
+        self.pendentes = []  # (data, aba, linha) ainda não gravadas no workbook
+        self.abertos = {}  # data -> {'arquivo', 'workbook', 'sujo'}
+        self.lock = threading.Lock()
+        self.lock_arquivo = threading.Lock()
+        self.sinal = threading.Event()
+        self.parado = threading.Event()
+
+        self.data_atual = datetime.now().strftime('%Y-%m-%d')
+        # O workbook do dia é aberto pela própria thread na primeira gravação
+        self.thread = threading.Thread(target=self._executar, name='excel-logger', daemon=True)
+        self.thread.start()
+
+    @property
+    def arquivo_atual(self):
+        return self._caminho_arquivo(self.data_atual)
+
+    def _caminho_arquivo(self, data):
+        return os.path.join(self.caminho_base, f"log_emails_{data}.xlsx")
+
+    def _abrir_dia(self, data):
+        """Abre (ou cria) o workbook do dia informado"""
+        if data in self.abertos:
+            return self.abertos[data]
+        arquivo = self._caminho_arquivo(data)
+        sujo = False
+        import openpyxl
         try:
-            if os.path.exists(self.arquivo_atual):
-                self.workbook = openpyxl.load_workbook(self.arquivo_atual)
+            if os.path.exists(arquivo):
+                workbook = openpyxl.load_workbook(arquivo)
             else:
-                self._criar_novo_workbook()
+                workbook = self._criar_novo_workbook()
+                sujo = True
         except Exception as e:
             # Se arquivo estiver corrompido, renomeia e cria novo
-            if os.path.exists(self.arquivo_atual):
-                backup_name = self.arquivo_atual.replace('.xlsx', f'_corrupted_{datetime.now().strftime("%H%M%S")}.xlsx')
-                os.rename(self.arquivo_atual, backup_name)
-            self._criar_novo_workbook()
-
-        self.aba_resumo = self.workbook["RESUMO"]
-        self.aba_geral = self.workbook["LOG_GERAL"]
+            if os.path.exists(arquivo):
+                backup_name = arquivo.replace('.xlsx', f'_corrupted_{datetime.now().strftime("%H%M%S")}.xlsx')
+                os.rename(arquivo, backup_name)
+            workbook = self._criar_novo_workbook()
+            sujo = True
+
+        self.abertos[data] = {'arquivo': arquivo, 'workbook': workbook, 'sujo': sujo}
+        if data > self.data_atual:
+            self.logger.info(f"Log Excel virou o dia: {os.path.basename(arquivo)}")
+            self.data_atual = data
+            self.salvar()  # Grava e libera o dia anterior
+        # Um dia anterior (linhas retidas na virada) fica aberto até o salvar() ao fim da descarga
+        return self.abertos[data]
 
     def _criar_novo_workbook(self):
         """Cria um novo workbook Excel"""
-        self.workbook = openpyxl.Workbook()
-        self.workbook.remove(self.workbook.active)
-        self.workbook.create_sheet("RESUMO")
-        self.configurar_aba(self.workbook["RESUMO"], ["Data/Hora", "Pedido", "Cliente", "Email", "Status", "Motivo", "Tentativas", "Versão PDF", "Observações"])
-        self.workbook.create_sheet("LOG_GERAL")
-        self.configurar_aba(self.workbook["LOG_GERAL"], ["Timestamp", "Pedido", "Cliente", "Fase", "Detalhes", "Validações", "Erro", "Duração", "Thread"])
-        self.salvar()
+        import openpyxl
+        workbook = openpyxl.Workbook()
+        workbook.remove(workbook.active)
+        workbook.create_sheet("RESUMO")
+        self.configurar_aba(workbook["RESUMO"], ["Data/Hora", "Pedido", "Cliente", "Email", "Status", "Motivo", "Tentativas", "Versão PDF", "Observações"])
+        workbook.create_sheet("LOG_GERAL")
+        self.configurar_aba(workbook["LOG_GERAL"], ["Timestamp", "Pedido", "Cliente", "Fase", "Detalhes", "Validações", "Erro", "Duração", "Thread"])
+        return workbook
 
     def configurar_aba(self, aba, cabecalhos):
         """Configura cabeçalhos e formatação de uma aba"""
+        from openpyxl.styles import Font, PatternFill
         aba.append(cabecalhos)
         for cell in aba[1]:
             cell.font = Font(bold=True, color="FFFFFF")
             cell.fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
         aba.freeze_panes = "A2"
 
+    def _enfileirar(self, aba, linha):
+        with self.lock:
+            self.pendentes.append((datetime.now().strftime('%Y-%m-%d'), aba, linha))
+            cheio = len(self.pendentes) >= self.LIMITE_LINHAS
+        if cheio:
+            self.sinal.set()
+
     def log_resumo(self, **kwargs):
         """Adiciona entrada na aba RESUMO"""
         linha = [datetime.now().strftime("%d/%m/%Y %H:%M:%S")] + list(kwargs.values())
-        self.aba_resumo.append(linha)
-        self.salvar()
+        self._enfileirar("RESUMO", linha)
 
     def log_geral(self, **kwargs):
         """Adiciona entrada na aba LOG_GERAL"""
         linha = [datetime.now().strftime("%d/%m/%Y %H:%M:%S.%f")[:-3]] + list(kwargs.values())
-        self.aba_geral.append(linha)
-        self.salvar()
+        self._enfileirar("LOG_GERAL", linha)
+
+    def descarregar(self):
+        """Passa as linhas enfileiradas para o workbook do respectivo dia e salva"""
+        with self.lock:
+            pendentes, self.pendentes = self.pendentes, []
+        with self.lock_arquivo:
+            passadas = 0
+            try:
+                for data, aba, linha in pendentes:
+                    dia = self._abrir_dia(data)
+                    dia['workbook'][aba].append(linha)
+                    dia['sujo'] = True
+                    passadas += 1
+            finally:
+                if passadas < len(pendentes):
+                    # Falha ao abrir o dia: o que não entrou no workbook volta para a frente da fila, na ordem
+                    with self.lock:
+                        self.pendentes[:0] = pendentes[passadas:]
+            self.salvar()
 
     def salvar(self):
-        """Salva o arquivo Excel"""
+        """Salva os arquivos Excel com alterações; dias anteriores já salvos são liberados"""
+        for data, dia in list(self.abertos.items()):
+            if dia['sujo']:
+                try:
+                    dia['workbook'].save(dia['arquivo'])
+                    dia['sujo'] = False
+                except PermissionError:
+                    self.logger.warning("Não foi possível salvar o log do Excel, talvez esteja aberto. As linhas ficam retidas para a próxima gravação.")
+                    continue
+            if data != self.data_atual:
+                del self.abertos[data]
+
+    def _executar(self):
+        """Grava periodicamente ou quando o limite de linhas é atingido"""
+        while not self.parado.is_set():
+            self.sinal.wait(self.INTERVALO_SEGUNDOS)
+            self.sinal.clear()
+            try:
+                self.descarregar()
+            except Exception as e:
+                self.logger.error(f"Erro ao gravar log do Excel (linhas retidas para a próxima gravação): {e}")
+
+    def fechar(self):
+        """Encerra a thread de gravação e grava o que estiver pendente"""
+        self.parado.set()
+        self.sinal.set()
+        self.thread.join(timeout=10)
+        self.descarregar()
+
+class AgendadorTentativas:
+    """Agenda as novas tentativas dos pedidos em ERRO (min-heap pela data da próxima tentativa)
+
+    O cool-down fica gravado em ControleEmailPedidos.ProximaTentativa, então a
+    agenda é recarregada do banco ao iniciar. Quando a tentativa mais próxima
+    vence, é executado um ciclo direcionado só para os pedidos vencidos.
+    """
+    def __init__(self, sistema_emails):
+        self.sistema_emails = sistema_emails
+        self.logger = sistema_emails.logger
+        self.heap = []  # (próxima tentativa, NroPedido)
+        self.agendados = {}  # NroPedido -> próxima tentativa vigente (entradas antigas do heap são ignoradas)
+        self.lock = threading.Lock()
+        self.sinal = threading.Event()
+        self.parado = threading.Event()
+        self.thread = threading.Thread(target=self._executar, name='tentativas', daemon=True)
+
+    def carregar(self):
+        """Recarrega do banco os pedidos em ERRO que aguardam o cool-down"""
+        conexao = self.sistema_emails.pool_banco.obter()
+        if conexao is None:
+            return
+        try:
+            cursor = conexao.cursor()
+            cursor.execute(
+                "SELECT NroPedido, ProximaTentativa FROM ControleEmailPedidos "
+                "WHERE StatusProcessamento = 'ERRO' AND EmailEnviado = 0 AND ProximaTentativa IS NOT NULL"
+            )
+            linhas = cursor.fetchall()
+            self.sistema_emails.pool_banco.devolver(conexao)
+        except Exception as e:
+            self.logger.error(f"Erro ao carregar tentativas agendadas: {e}")
+            self.sistema_emails.pool_banco.devolver(conexao, descartar=True)
+            return
+        for linha in linhas:
+            self.agendar(linha.NroPedido, linha.ProximaTentativa)
+        if linhas:
+            self.logger.info(f"{len(linhas)} pedido(s) em ERRO aguardando nova tentativa")
+
+    def iniciar(self):
+        self.thread.start()
+
+    def parar(self):
+        self.parado.set()
+        self.sinal.set()
+        self.thread.join(timeout=5)
+
+    def agendar(self, numero_pedido, quando):
+        """Agenda (ou reagenda) a próxima tentativa do pedido"""
+        with self.lock:
+            self.agendados[numero_pedido] = quando
+            heapq.heappush(self.heap, (quando, numero_pedido))
+            mais_proximo = self.heap[0][1] == numero_pedido
+        if mais_proximo:
+            self.sinal.set()
+
+    def _retirar_vencidos(self):
+        """Remove do heap os pedidos vencidos; retorna (NroPedidos, segundos até o próximo)"""
+        agora = datetime.now()
+        vencidos = set()
+        with self.lock:
+            while self.heap and self.heap[0][0] <= agora:
+                quando, numero = heapq.heappop(self.heap)
+                if self.agendados.get(numero) == quando:
+                    del self.agendados[numero]
+                    vencidos.add(numero)
+            espera = (self.heap[0][0] - agora).total_seconds() if self.heap else None
+        return vencidos, espera
+
+    def _executar(self):
+        while not self.parado.is_set():
+            vencidos, espera = self._retirar_vencidos()
+            if vencidos:
+                self.logger.info(f"Cool-down vencido para {len(vencidos)} pedido(s) - executando nova tentativa")
+                try:
+                    self.sistema_emails.executar_ciclo(vencidos)
+                except Exception as e:
+                    self.logger.error(f"Erro ao executar nova tentativa agendada: {e}")
+                continue
+            self.sinal.wait(espera)
+            self.sinal.clear()
+
+class VerificacaoPeriodica:
+    """Thread que executa a verificação incremental a cada SistemaVerificacaoPeriodicaMinutos"""
+    def __init__(self, sistema_emails):
+        self.sistema_emails = sistema_emails
+        self.logger = sistema_emails.logger
+        self.parado = threading.Event()
+        self.thread = threading.Thread(target=self._executar, name='verificacao-periodica', daemon=True)
+
+    def iniciar(self):
+        self.thread.start()
+
+    def parar(self):
+        self.parado.set()
+        self.thread.join(timeout=5)
+
+    def _configuracao(self):
+        """(ativa, intervalo em segundos) lidos da configuração em memória a cada rodada"""
+        ativa = self.sistema_emails.get_config('SISTEMA', 'verificacao_periodica_ativa', fallback=True)
+        if isinstance(ativa, str):
+            ativa = ativa.lower() in ('true', '1', 'yes')
+        minutos = int(self.sistema_emails.get_config('SISTEMA', 'verificacao_periodica_minutos', fallback=30) or 30)
+        return bool(ativa), max(1, minutos) * 60
+
+    def _executar(self):
+        while True:
+            ativa, intervalo = self._configuracao()
+            if self.parado.wait(intervalo if ativa else 60):
+                return
+            if not ativa:
+                continue
+            try:
+                self.sistema_emails.executar_verificacao_periodica()
+            except Exception as e:
+                self.logger.error(f"Erro na verificação periódica: {e}")
+
+class RenovacaoReservas:
+    """Mantém válidas as reservas desta instância; só as de uma instância que parou chegam a vencer"""
+
+    def __init__(self, sistema_emails):
+        self.sistema_emails = sistema_emails
+        self.parado = threading.Event()
+        self.retomadas = False
+        self.thread = threading.Thread(target=self._executar, name='reservas', daemon=True)
+
+    def iniciar(self):
+        """Libera as reservas deixadas pelo último encerramento e inicia a renovação periódica"""
+        self.retomadas = self.sistema_emails.retomar_reservas()
+        self.thread.start()
+
+    def parar(self):
+        self.parado.set()
+        self.thread.join(timeout=5)
+
+    def _intervalo(self):
+        """Um terço da validade: duas renovações podem falhar antes de a reserva vencer"""
+        minutos = int(self.sistema_emails.get_config('SISTEMA', 'minutos_reserva', fallback=30) or 30)
+        return max(60, minutos * 20)
+
+    def _executar(self):
+        while not self.parado.wait(self._intervalo()):
+            if not self.retomadas:
+                self.retomadas = self.sistema_emails.retomar_reservas()
+            else:
+                self.sistema_emails.renovar_reservas()
+
+class ProcessadorEventosPdf:
+    """Fila de eventos de PDF processada fora da thread do watchdog; cada arquivo só segue quando terminou de ser gravado"""
+    JANELA_AGRUPAMENTO_SEGUNDOS = 0.5
+    INTERVALO_VERIFICACAO_SEGUNDOS = 0.25
+    VERIFICACOES_ESTAVEIS = 2  # Tamanho e mtime iguais em N verificações seguidas
+    MAX_REENFILEIRAMENTOS = 10
+
+    def __init__(self, sistema_emails, limite_espera_segundos):
+        self.sistema_emails = sistema_emails
+        self.limite_espera_segundos = max(1, limite_espera_segundos)
+        self.logger = sistema_emails.logger
+        self.fila = queue.Queue()
+        self.reenfileiramentos = {}  # caminho -> vezes que o limite de espera estourou
+        self.parado = threading.Event()
+        self.thread = threading.Thread(target=self._executar, name='eventos-pdf', daemon=True)
+
+    def iniciar(self):
+        """Inicia a thread consumidora"""
+        self.thread.start()
+
+    def parar(self):
+        """Sinaliza a thread consumidora para encerrar"""
+        self.parado.set()
+        self.fila.put(None)
+        self.thread.join(timeout=5)
+
+    def enfileirar(self, caminho_arquivo):
+        """Registra o evento sem bloquear a thread do observer"""
+        self.fila.put(caminho_arquivo)
+
+    def _coletar_janela(self):
+        """Aguarda o primeiro evento e agrupa os caminhos que chegarem durante a janela"""
+        primeiro = self.fila.get()
+        if primeiro is None:
+            return set()
+        caminhos = {primeiro}
+        prazo = time.monotonic() + self.JANELA_AGRUPAMENTO_SEGUNDOS
+        while not self.parado.is_set():
+            restante = prazo - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                caminho = self.fila.get(timeout=restante)
+            except queue.Empty:
+                break
+            if caminho is None:
+                break
+            caminhos.add(caminho)
+        return caminhos
+
+    @staticmethod
+    def _assinatura(caminho):
+        """(tamanho, mtime) do arquivo, ou None se ele não existe mais"""
         try:
-            self.workbook.save(self.arquivo_atual)
-        except PermissionError:
-            self.logger.warning("Não foi possível salvar o log do Excel, talvez esteja aberto.")
+            info = os.stat(caminho)
+        except OSError:
+            return None
+        return info.st_size, info.st_mtime_ns
+
+    # Erros do CreateFileW que indicam outro processo ainda escrevendo no arquivo
+    ERROS_COMPARTILHAMENTO_WINDOWS = (32, 33)  # ERROR_SHARING_VIOLATION, ERROR_LOCK_VIOLATION
+
+    @staticmethod
+    def _liberado(caminho):
+        """Indica se um arquivo já estável pode seguir (sem pedir permissão de escrita)
+
+        No Windows abre só para leitura negando escrita a terceiros: isso falha com violação de
+        compartilhamento enquanto o gerador mantém o arquivo aberto para escrita. Qualquer outra
+        falha (somente leitura, sem permissão, compartilhamento de rede) conta como liberado,
+        já que tamanho e mtime ficaram estáveis.
+        """
+        if os.name != 'nt':
+            return True
+        import ctypes
+        from ctypes import wintypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.CreateFileW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, wintypes.LPVOID,
+                                         wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE]
+        kernel32.CreateFileW.restype = wintypes.HANDLE
+        kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+        # GENERIC_READ, FILE_SHARE_READ, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL
+        handle = kernel32.CreateFileW(caminho, 0x80000000, 0x00000001, None, 3, 0x80, None)
+        if handle is None or handle == ctypes.c_void_p(-1).value:
+            return ctypes.get_last_error() not in ProcessadorEventosPdf.ERROS_COMPARTILHAMENTO_WINDOWS
+        kernel32.CloseHandle(handle)
+        return True
+
+    def _aguardar_arquivos_prontos(self, caminhos):
+        """Acompanha tamanho/mtime de cada arquivo até ficarem estáveis e o arquivo estar liberado,
+        no máximo por limite_espera_segundos. Retorna (prontos, ainda_em_gravacao)"""
+        inicio = time.monotonic()
+        prazo = inicio + self.limite_espera_segundos
+        estado = {caminho: (self._assinatura(caminho), 0) for caminho in caminhos}
+        prontos = set()
+        while estado and not self.parado.wait(self.INTERVALO_VERIFICACAO_SEGUNDOS):
+            for caminho, (anterior, estaveis) in list(estado.items()):
+                atual = self._assinatura(caminho)
+                if atual is None:
+                    # Removido/renomeado nesse meio tempo: o ciclo usa o que restou no índice
+                    prontos.add(caminho)
+                    del estado[caminho]
+                    continue
+                estaveis = estaveis + 1 if atual == anterior and atual[0] > 0 else 0
+                if estaveis >= self.VERIFICACOES_ESTAVEIS and self._liberado(caminho):
+                    prontos.add(caminho)
+                    del estado[caminho]
+                else:
+                    estado[caminho] = (atual, estaveis)
+            if time.monotonic() >= prazo:
+                break
+        if prontos:
+            self.logger.debug(f"{len(prontos)} PDF(s) pronto(s) após {time.monotonic() - inicio:.2f}s")
+        return prontos, set(estado)
+
+    def _reenfileirar(self, caminhos):
+        """Devolve à fila os arquivos que ainda estavam sendo gravados quando o limite de espera estourou"""
+        for caminho in caminhos:
+            vezes = self.reenfileiramentos.get(caminho, 0) + 1
+            if vezes > self.MAX_REENFILEIRAMENTOS:
+                self.reenfileiramentos.pop(caminho, None)
+                self.logger.error(f"{os.path.basename(caminho)} continua em gravação/bloqueado após {vezes - 1} tentativas - será tratado na próxima verificação completa")
+                continue
+            self.reenfileiramentos[caminho] = vezes
+            self.logger.warning(f"{os.path.basename(caminho)} ainda em gravação após {self.limite_espera_segundos}s - aguardando novamente")
+            self.fila.put(caminho)
+
+    def _executar(self):
+        """Executa um ciclo por janela, apenas para os pedidos dos arquivos que já terminaram de ser gravados"""
+        while not self.parado.is_set():
+            caminhos = self._coletar_janela()
+            if not caminhos or self.parado.is_set():
+                continue
+            caminhos, em_gravacao = self._aguardar_arquivos_prontos(caminhos)
+            if self.parado.is_set():
+                continue
+            self._reenfileirar(em_gravacao)
+            numeros = set()
+            for caminho in caminhos:
+                self.reenfileiramentos.pop(caminho, None)
+                identificacao = IndicePdfs.interpretar_nome(os.path.basename(caminho))
+                if identificacao:
+                    numeros.add(identificacao[0])
+                else:
+                    self.logger.debug(f"Arquivo fora do padrão 'PEDIDO nnnnnnn[_N].pdf' ignorado: {os.path.basename(caminho)}")
+            if not numeros:
+                continue
+            self.logger.info(f"{len(caminhos)} PDF(s) alterado(s) e pronto(s) - processando {len(numeros)} pedido(s)")
+            try:
+                self.sistema_emails.executar_ciclo(numeros)
+            except Exception as e:
+                self.logger.error(f"Erro ao executar ciclo disparado por eventos de PDF: {e}")
 
-class PDFEventHandler(FileSystemEventHandler):
-    """Handler para monitorar eventos de arquivos PDF"""
+class PDFEventHandler:
+    """Handler para monitorar eventos de arquivos PDF
+
+    Mesma interface do FileSystemEventHandler do watchdog (dispatch -> on_<tipo>),
+    sem herdar dele, para que o watchdog não precise ser importado junto com o módulo.
+    """
     def __init__(self, sistema_emails):
         self.sistema_emails = sistema_emails
+        # SistemaAguardarSegundosAposArquivo passa a ser o limite de espera pela gravação do arquivo, não um atraso fixo
         self.aguardar_segundos = int(sistema_emails.get_config('SISTEMA', 'aguardar_segundos_apos_arquivo', fallback=5))
         self.logger = sistema_emails.logger
+        self.processador = ProcessadorEventosPdf(sistema_emails, self.aguardar_segundos)
+        self.processador.iniciar()
+
+    def parar(self):
+        """Encerra o processamento de eventos pendentes"""
+        self.processador.parar()
+
+    def dispatch(self, event):
+        """Encaminha o evento do observer ao método on_<tipo> correspondente"""
+        metodo = getattr(self, f"on_{event.event_type}", None)
+        if metodo:
+            metodo(event)
         
     def on_created(self, event):
         """Chamado quando um arquivo é criado"""
         if not event.is_directory and event.src_path.lower().endswith('.pdf'):
             self.logger.info(f"Novo PDF detectado: {os.path.basename(event.src_path)}")
-            time.sleep(self.aguardar_segundos)
-            self.sistema_emails.executar_ciclo()
+            self.sistema_emails.indice_pdfs.registrar(event.src_path)
+            self.processador.enfileirar(event.src_path)
             
     def on_modified(self, event):
         """Chamado quando um arquivo é modificado"""
         if not event.is_directory and event.src_path.lower().endswith('.pdf'):
-            self.logger.info(f"PDF modificado detectado: {os.path.basename(event.src_path)}")
-            time.sleep(self.aguardar_segundos)
-            self.sistema_emails.executar_ciclo()
+            self.logger.debug(f"PDF modificado detectado: {os.path.basename(event.src_path)}")
+            self.sistema_emails.indice_pdfs.registrar(event.src_path)
+            self.processador.enfileirar(event.src_path)
+
+    def on_deleted(self, event):
+        """Chamado quando um arquivo é excluído"""
+        if not event.is_directory and event.src_path.lower().endswith('.pdf'):
+            self.logger.info(f"PDF removido: {os.path.basename(event.src_path)}")
+            self.sistema_emails.indice_pdfs.remover(event.src_path)
+
+    def on_moved(self, event):
+        """Chamado quando um arquivo é renomeado/movido"""
+        if event.is_directory:
+            return
+        if event.src_path.lower().endswith('.pdf'):
+            self.sistema_emails.indice_pdfs.remover(event.src_path)
+        if event.dest_path.lower().endswith('.pdf'):
+            self.logger.info(f"PDF renomeado: {os.path.basename(event.src_path)} -> {os.path.basename(event.dest_path)}")
+            self.sistema_emails.indice_pdfs.registrar(event.dest_path)
+            self.processador.enfileirar(event.dest_path)
 
 def main():
     """Função principal"""
+    encerrando = threading.Event()
+
     def signal_handler(sig, frame):
-        print('\nEncerrando sistema...')
-        sys.exit(0)
+        # Só sinaliza: o encerramento ordenado (threads, métricas, reservas) roda no laço principal.
+        # Um segundo Ctrl+C interrompe sem esperar.
+        if encerrando.is_set():
+            raise KeyboardInterrupt
+        print('\nEncerrando sistema (aguardando o ciclo em andamento)...')
+        encerrando.set()
     
     signal.signal(signal.SIGINT, signal_handler)
     
+    sistema = None
     try:
-        sistema = SistemaEnvioEmails()
-        if len(sys.argv) > 1 and sys.argv[1] == "--teste":
+        modo_teste = len(sys.argv) > 1 and sys.argv[1] == "--teste"
+        importacao = time.perf_counter() - INICIO_PROCESSO
+        with METRICAS.medir('inicializacao') as medicao:
+            sistema = SistemaEnvioEmails(somente_leitura=modo_teste)
+        construcao = time.perf_counter() - medicao.inicio
+        sistema.logger.info(f"Inicialização: {importacao + construcao:.3f}s (importação {importacao:.3f}s, SistemaEnvioEmails {construcao:.3f}s)")
+        if modo_teste:
             print("MODO TESTE: Verificando detecção de versões (SEM ENVIAR EMAILS)")
+            inicio = time.perf_counter()
             sistema.testar_deteccao_versoes()
+            print(f"Tempo de inicialização: {importacao + construcao:.3f}s "
+                  f"(importação {importacao:.3f}s, SistemaEnvioEmails {construcao:.3f}s); "
+                  f"teste de detecção: {time.perf_counter() - inicio:.3f}s")
             return
 
         print("Sistema de Envio de Emails iniciado!")
         caminho_pdfs = sistema.get_config('PDFS', 'caminho')
         print(f"Monitorando pasta: {caminho_pdfs}")
 
+        exportador_metricas = ExportadorMetricas(sistema.logger, int(sistema.get_config('SISTEMA', 'metricas_porta', fallback=0) or 0))
+        exportador_metricas.iniciar()
+        # Diário de status antes da caixa de saída, que consulta as transições recuperadas;
+        # a entrega só começa quando as reservas forem retomadas (se o banco estiver fora, a renovação periódica tenta de novo)
+        sistema.buffer_status.iniciar()
+        sistema.cache_anexos.iniciar()
+        sistema.caixa_saida.iniciar(int(sistema.get_config('SISTEMA', 'trabalhadores_entrega', fallback=2) or 0))
+        renovacao_reservas = RenovacaoReservas(sistema)
+        renovacao_reservas.iniciar()
+
         verificacao_inicial = sistema.get_config('SISTEMA', 'verificacao_inicial', fallback=True)
         if isinstance(verificacao_inicial, str):
             verificacao_inicial = verificacao_inicial.lower() in ('true', '1', 'yes')
@@ -791,6 +3289,12 @@ def main():
             print("Executando verificação inicial...")
             sistema.executar_ciclo()
 
+        sistema.agendador_tentativas.carregar()
+        sistema.agendador_tentativas.iniciar()
+        verificacao_periodica = VerificacaoPeriodica(sistema)
+        verificacao_periodica.iniciar()
+
+        from watchdog.observers import Observer
         event_handler = PDFEventHandler(sistema)
         observer = Observer()
         observer.schedule(event_handler, caminho_pdfs, recursive=False)
@@ -798,11 +3302,25 @@ def main():
         
         print("Pressione Ctrl+C para encerrar.")
         try:
-            while True:
-                time.sleep(1)
+            while not encerrando.wait(1):
+                pass
         except KeyboardInterrupt:
-            observer.stop()
+            pass
+        observer.stop()
         observer.join()
+        event_handler.parar()
+        sistema.agendador_tentativas.parar()
+        verificacao_periodica.parar()
+        exportador_metricas.parar()
+        # As paradas acima esperam poucos segundos; um ciclo ainda em andamento termina antes de os recursos
+        # serem fechados (acquire com timeout para o segundo Ctrl+C continuar interrompendo no Windows)
+        while not sistema.lock_ciclo.acquire(timeout=1):
+            pass
+        try:
+            sistema.encerrar()
+        finally:
+            sistema.lock_ciclo.release()
+        renovacao_reservas.parar()
         print("Sistema encerrado.")
     except Exception as e:
         print(f"Erro fatal ao inicializar: {e}")